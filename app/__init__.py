@@ -1,14 +1,74 @@
+import sqlite3
+from functools import partial
+
 from flask_bootstrap import Bootstrap
 from flask import Flask, request, current_app
 from config import Config
 
+from app.main import helpers, log
+from app.main.cache import TTLCache
+from app.main.db import FineliDatabase
+from app.main.finna_search import FinnaSearch
+from app.main.http_client import HttpClient
+from app.main.jobs import SolveJobQueue
+from app.main.market_data import MarketChartStore
+from app.main.metrics import Metrics
+from app.main.search import create_food_search
+from app.main.wikipedia_pages import WikipediaPages
+
 bootstrap = Bootstrap()
+fineli_db = FineliDatabase()
+solve_jobs = SolveJobQueue()
+metrics = Metrics()
+market_chart = MarketChartStore()
+http_client = HttpClient()
+finna_search = FinnaSearch()
+wikipedia_pages = WikipediaPages(fetch=partial(helpers.get_wikipedia_page, http_client))
 
 def create_app(config_class=Config):
     app = Flask(__name__)
     app.config.from_object(config_class)
 
+    # the solver workers set up their logging the same way when they start
+    solve_jobs.initializer = log.configure_logging
+    solve_jobs.initargs = log.init_app(app)
+
     bootstrap.init_app(app)
+    fineli_db.init_app(app)
+    solve_jobs.init_app(app)
+    # pooled connections with timeouts, retries and circuit breaking for CoinGecko, Finna and Wikipedia
+    http_client.init_app(app)
+    # further pages of Finna search results, fetched in a bounded thread pool
+    finna_search.init_app(app)
+    # summaries and images of the Wikipedia page, refreshed in a background thread
+    wikipedia_pages.init_app(app)
+    # daily bitcoin prices and volumes of the Scrooge page, fetched from CoinGecko only once
+    market_chart.init_app(app)
+    # request latencies, stage timers and sampled profiles, when METRICS_ENABLED is set
+    metrics.init_app(app)
+    if 'metrics' in app.extensions and metrics.record_stage not in helpers.stage_hooks:
+        helpers.stage_hooks.append(metrics.record_stage)
+    # optimization results keyed by (food id, rounded amount, demographic)
+    app.extensions['result_cache'] = TTLCache(maxsize=app.config.get('RESULT_CACHE_SIZE', 1024),
+                                              ttl=app.config.get('RESULT_CACHE_TTL', 24 * 60 * 60),
+                                              path=app.config.get('RESULT_CACHE_PATH'),
+                                              table='solve_results')
+    # parsed Finna search results keyed by (target field, normalized search term, language)
+    app.extensions['finna_cache'] = TTLCache(maxsize=app.config.get('FINNA_CACHE_SIZE', 256),
+                                             ttl=app.config.get('FINNA_CACHE_TTL', 60 * 60),
+                                             path=app.config.get('FINNA_CACHE_PATH'),
+                                             table='finna_searches')
+    # food name search for the autocomplete and the food lookup: an in-memory index built once
+    # here by default (it ignores accents), or the FTS5 table of the database
+    app.config.setdefault('AUTOCOMPLETE_BACKEND', 'memory')
+    app.config.setdefault('AUTOCOMPLETE_TABLES', ('food',))
+    app.config.setdefault('AUTOCOMPLETE_LIMIT', 20)
+    try:
+        app.extensions['food_search'] = create_food_search(fineli_db, app.config['AUTOCOMPLETE_BACKEND'],
+                                                           app.config['AUTOCOMPLETE_TABLES'],
+                                                           app.config['AUTOCOMPLETE_LIMIT'])
+    except sqlite3.Error:
+        app.extensions['food_search'] = None
 
     from app.main import bp as main_bp
     app.register_blueprint(main_bp)
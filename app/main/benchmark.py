@@ -0,0 +1,321 @@
+"""Benchmarks of the optimizer, the food name search and the Scrooge analytics.
+
+Run from the repository root:
+
+    python -m app.main.benchmark [--foods 4000] [--nutrients 55] [--years 5] [--output bench.json]
+    python -m app.main.benchmark --compare bench.json
+
+The benchmarks don't need the network or the real Fineli data: they run on a synthetic
+Fineli-like database of the given size, built with the indexes and the full-text search
+table of db_creation.sql, and on a synthetic hourly bitcoin price series like the ones
+of the CoinGecko API. The data is generated from a fixed seed, so runs with the same
+parameters measure the same work.
+
+The results are written as JSON. With --compare, the fastest times are compared to those
+of an earlier run and the script exits with status 1 if any benchmark got slower than the
+given tolerance, e.g. 1.25 for 25 % slower. The fastest time is the one least disturbed by
+other load on the machine, so it varies the least between runs.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+from app.main.db import FineliDatabase
+from app.main.helpers import get_nutrition_values_of_foods, solve_for_optimal_foods, clear_nutrient_matrix_cache, \
+    export_nutrient_snapshot, collect_stage_times, get_daily_values, get_bear_length, get_highest_volume, \
+    get_buy_and_sell_dates, omitted_food_types
+from app.main.search import FoodNameIndex, FtsFoodSearch
+from app.main import timeseries
+
+SYLLABLES = ("ome", "na", "lei", "pä", "juu", "sto", "mar", "ja", "kas", "vis", "pe", "ru", "na", "kaa",
+             "li", "ma", "ito", "ka", "la", "ri", "sa", "jau", "ho", "hil", "lo", "sie", "ni", "kes", "to")
+PREPARATIONS = ("keitetty", "paistettu", "kuivattu", "pakaste", "sokeroitu", "rasvaton", "täysjyvä", "luomu")
+FUCLASSES = ("fruitot", "vegetot", "meatcuts", "fishtot", "cereal", "milk", "bread", "sugadd")
+
+
+def food_name(rng:random.Random) -> str:
+    """Make up a Finnish-looking food name, e.g. 'omenahillo, sokeroitu'."""
+    name = "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 5)))
+    if rng.random() < 0.5:
+        name += ", " + rng.choice(PREPARATIONS)
+    return name
+
+
+def create_fineli_db(path:str, foods=4000, nutrients=55, density=0.7, seed=0, script="db_creation.sql") -> list:
+    """Create a synthetic database with the tables the app reads from the Fineli database,
+    and the indexes and the full-text search table of db_creation.sql.
+
+    Args:
+        path: path of the database file to create
+        foods: number of foods
+        nutrients: number of nutrients besides energy ('enerc')
+        density: share of the nutrients that have a value for a food
+        seed: seed of the random data
+        script: path of db_creation.sql
+
+    Returns:
+        list: the abbreviations of the nutrients, without 'enerc'
+    """
+    rng = random.Random(seed)
+    nutrient_names = [f"n{i:03d}" for i in range(nutrients)]
+    # every tenth food is of a type the optimizer leaves out
+    food_rows = [(i, food_name(rng), omitted_food_types[i % len(omitted_food_types)] if i % 10 == 0
+                  else rng.choice(FUCLASSES)) for i in range(1, foods + 1)]
+    value_rows = []
+    for food_id, _, _ in food_rows:
+        value_rows.append((food_id, "enerc", rng.uniform(20, 3000)))
+        value_rows.extend((food_id, nutrient, rng.uniform(0, 100)) for nutrient in nutrient_names
+                          if rng.random() < density)
+    with open(script, encoding="utf-8") as sql_file:
+        sql = sql_file.read()
+
+    with sqlite3.connect(path) as conn:
+        conn.execute("CREATE TABLE food (FOODID INTEGER NOT NULL PRIMARY KEY, FOODNAME TEXT NOT NULL, FUCLASS TEXT)")
+        conn.execute("CREATE TABLE component_value (FOODID INTEGER NOT NULL, EUFDNAME TEXT NOT NULL, BESTLOC NUMBER)")
+        for table in ("foodname_FI", "foodname_TX"):
+            conn.execute(f"CREATE TABLE {table} (FOODID INTEGER NOT NULL, FOODNAME TEXT NOT NULL, LANG TEXT)")
+        conn.executemany("INSERT INTO food VALUES (?, ?, ?)", food_rows)
+        conn.executemany("INSERT INTO component_value VALUES (?, ?, ?)", value_rows)
+        # the indexes, ANALYZE and the full-text search table come after the import in the script
+        conn.executescript(sql[sql.index("CREATE INDEX"):])
+    conn.close()
+    return nutrient_names
+
+
+def create_remainder(comp_values:pd.DataFrame, seed=0, foods=10, grams=200) -> pd.DataFrame:
+    """Make up remaining nutrient targets that a diet of the given foods covers,
+    so that the optimization problem always has a solution.
+
+    Args:
+        comp_values: nutrient compositions of foods, from get_nutrition_values_of_foods
+        seed: seed of the random choice of foods
+        foods: number of foods in the diet
+        grams: grams of each food in the diet
+
+    Returns:
+        DataFrame: remainder and max of the nutrients, indexed by EUFDNAME
+    """
+    diet = np.random.default_rng(seed).choice(len(comp_values), size=foods, replace=False)
+    totals = comp_values.drop(columns="enerc").iloc[diet].sum().to_numpy() * grams
+    return pd.DataFrame({"remainder": 0.8 * totals, "max": 3 * totals},
+                        index=comp_values.columns.drop("enerc"))
+
+
+def create_price_data(years=5, seed=0) -> dict:
+    """Make up hourly bitcoin prices and volumes in the format of the CoinGecko market_chart API.
+
+    Args:
+        years: length of the series in years
+        seed: seed of the random walk
+
+    Returns:
+        dict: 'prices' and 'total_volumes' as lists of [timestamp in ms, value]
+    """
+    rng = np.random.default_rng(seed)
+    hours = int(years * 365 * 24)
+    start = datetime(2015, 1, 1, tzinfo=timezone.utc).timestamp() * 1000
+    timestamps = start + np.arange(hours) * 3600 * 1000
+    prices = 300 * np.exp(np.cumsum(rng.normal(0, 0.01, hours)))
+    volumes = rng.lognormal(20, 1, hours)
+    return {"prices": [[float(t), float(p)] for t, p in zip(timestamps, prices)],
+            "total_volumes": [[float(t), float(v)] for t, v in zip(timestamps, volumes)]}
+
+
+def measure(function, repeat=5, setup=None) -> dict:
+    """Time a function.
+
+    Args:
+        function: function to call without arguments
+        repeat: number of calls
+        setup: optional function to call before each call, not included in the time
+
+    Returns:
+        dict: the minimum, median, mean and maximum seconds of the calls and their number
+    """
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return summary(times)
+
+
+def summary(times) -> dict:
+    return {"min": min(times), "median": statistics.median(times), "mean": statistics.mean(times),
+            "max": max(times), "repeat": len(times)}
+
+
+def benchmark_optimizer(path:str, nutrients, directory:str, repeat=5, time_limit=60, gap=0.01) -> dict:
+    """Time loading the nutrient values and the model build and solve of the optimizer.
+    The random data makes harder problems than the real one, so by default the solver
+    stops within 1 % of the optimum instead of running to the time limit.
+    """
+    results = {}
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        nutrient_tuple = tuple(nutrients)
+        load = lambda: get_nutrition_values_of_foods(conn, nutrient_tuple)
+        results["nutrition_values.query"] = measure(load, repeat, setup=clear_nutrient_matrix_cache)
+        results["nutrition_values.cached"] = measure(load, repeat)
+        snapshot = os.path.join(directory, "snapshot")
+        export_nutrient_snapshot(conn, snapshot)
+        results["nutrition_values.snapshot"] = measure(
+            lambda: get_nutrition_values_of_foods(conn, nutrient_tuple, snapshot), repeat,
+            setup=clear_nutrient_matrix_cache)
+        comp_values = get_nutrition_values_of_foods(conn, nutrient_tuple)
+    finally:
+        conn.close()
+
+    # the candidate foods are cached after the first solve, like in the app
+    stages = {"model_build": [], "solve": []}
+    for seed in range(repeat):
+        remainder_df = create_remainder(comp_values, seed)
+        with collect_stage_times() as timings:
+            result = solve_for_optimal_foods(remainder_df, comp_values, time_limit, gap=gap)
+        if result.status != "Optimal":
+            print(f"optimizer: {result.status} with seed {seed}", file=sys.stderr)
+        for stage, times in stages.items():
+            times.append(timings[stage])
+    for stage, times in stages.items():
+        results[f"optimizer.{stage}"] = summary(times)
+    return results
+
+
+def benchmark_search(path:str, repeat=5, queries=200, seed=0) -> dict:
+    """Time the autocomplete searches of both search backends."""
+    rng = random.Random(seed)
+    database = FineliDatabase(path)
+    names = [name for name, _ in database.food_names(("food",))]
+    # prefixes of the lengths people type, and parts from the middle of the names
+    typed = [name[:rng.randint(2, 6)] for name in rng.sample(names, queries // 2)]
+    parts = []
+    for name in rng.sample(names, queries - len(typed)):
+        start = rng.randrange(max(len(name) - 3, 1))
+        parts.append(name[start:start + rng.randint(3, 6)])
+
+    results = {}
+    try:
+        backends = {"fts": FtsFoodSearch(database), "memory": FoodNameIndex.from_database(database)}
+        for backend, search in backends.items():
+            for kind, terms in (("prefix", typed), ("substring", parts)):
+                times = []
+                for _ in range(repeat):
+                    for term in terms:
+                        start = time.perf_counter()
+                        search.search(term)
+                        times.append(time.perf_counter() - start)
+                results[f"autocomplete.{backend}.{kind}"] = summary(times)
+    finally:
+        database.close()
+    return results
+
+
+def benchmark_scrooge(years=5, repeat=5) -> dict:
+    """Time the Scrooge analytics on hourly data of several years, both the list versions
+    of helpers.py and the array versions of timeseries.py used by the app."""
+    data = create_price_data(years)
+    daily_prices = get_daily_values(data["prices"])
+    daily_volumes = get_daily_values(data["total_volumes"])
+    price_series = timeseries.daily_values(data["prices"])
+    volume_series = timeseries.daily_values(data["total_volumes"])
+    return {"scrooge.get_daily_values": measure(lambda: get_daily_values(data["prices"]), repeat),
+            "scrooge.get_bear_length": measure(lambda: get_bear_length(daily_prices), repeat),
+            "scrooge.get_highest_volume": measure(lambda: get_highest_volume(daily_volumes), repeat),
+            "scrooge.get_buy_and_sell_dates": measure(lambda: get_buy_and_sell_dates(daily_prices), repeat),
+            "timeseries.daily_values": measure(lambda: timeseries.daily_values(data["prices"]), repeat),
+            "timeseries.bear_length": measure(lambda: timeseries.bear_length(price_series.values), repeat),
+            "timeseries.highest_volume": measure(lambda: timeseries.highest_volume(volume_series), repeat),
+            "timeseries.buy_and_sell_dates": measure(lambda: timeseries.buy_and_sell_dates(price_series),
+                                                     repeat)}
+
+
+def run(foods=4000, nutrients=55, years=5, repeat=5, time_limit=60, gap=0.01, script="db_creation.sql") -> dict:
+    """Run all the benchmarks.
+
+    Returns:
+        dict: the parameters, the environment and the timings of each benchmark in seconds
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "fineli.db")
+        nutrient_names = create_fineli_db(path, foods, nutrients, script=script)
+        results = benchmark_optimizer(path, nutrient_names, directory, repeat, time_limit, gap)
+        results.update(benchmark_search(path, repeat))
+    results.update(benchmark_scrooge(years, repeat))
+    return {"created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "parameters": {"foods": foods, "nutrients": nutrients, "years": years, "repeat": repeat,
+                           "time_limit": time_limit, "gap": gap},
+            "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                            "numpy": np.__version__, "pandas": pd.__version__,
+                            "sqlite": sqlite3.sqlite_version},
+            "results": results}
+
+
+def compare(baseline:dict, current:dict, tolerance=1.25) -> list:
+    """Compare the fastest times of two runs.
+
+    Args:
+        baseline: results of an earlier run
+        current: results of this run
+        tolerance: the ratio of the times above which a benchmark is slower
+
+    Returns:
+        list: (benchmark, baseline time, current time, ratio, slower) tuples for the
+              benchmarks in both runs
+    """
+    rows = []
+    for name, timing in sorted(current["results"].items()):
+        old = baseline["results"].get(name)
+        if old is None:
+            continue
+        ratio = timing["min"] / old["min"] if old["min"] else float("inf")
+        rows.append((name, old["min"], timing["min"], ratio, ratio > tolerance))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the optimizer, the food search and the Scrooge analytics.')
+    parser.add_argument('--foods', type=int, default=4000, help='number of foods in the synthetic database')
+    parser.add_argument('--nutrients', type=int, default=55, help='number of nutrients in the synthetic database')
+    parser.add_argument('--years', type=float, default=5, help='years of hourly price data')
+    parser.add_argument('--repeat', type=int, default=5, help='number of times to run each benchmark')
+    parser.add_argument('--time-limit', type=float, default=60, help='maximum seconds of each solve')
+    parser.add_argument('--gap', type=float, default=0.01, help='relative gap at which the solver may stop')
+    parser.add_argument('--script', default='db_creation.sql', help='sql script with the indexes to create')
+    parser.add_argument('--output', help='file to write the results to (default: stdout)')
+    parser.add_argument('--compare', help='results of an earlier run to compare to')
+    parser.add_argument('--tolerance', type=float, default=1.25, help='slowdown ratio that counts as a regression')
+    args = parser.parse_args()
+
+    report = run(args.foods, args.nutrients, args.years, args.repeat, args.time_limit, args.gap, args.script)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            rows = compare(json.load(baseline_file), report, args.tolerance)
+        for name, old, new, ratio, slower in rows:
+            print(f"{name:45} {old * 1000:10.3f} ms {new * 1000:10.3f} ms {ratio:6.2f}x"
+                  f"{'  SLOWER' if slower else ''}", file=sys.stderr)
+        if any(slower for *_, slower in rows):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""A small in-process cache with LRU and TTL eviction.
+
+Values can optionally be persisted in an SQLite file, so that they survive restarts
+and can be shared by several worker processes.
+"""
+
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """A thread-safe LRU cache whose entries expire after a time to live.
+
+    Args:
+        maxsize (int): maximum number of entries kept in memory
+        ttl (float): seconds after which an entry expires
+        path (str): optional path of an SQLite file for persisting the entries
+        table (str): name of the table used in the SQLite file
+    """
+
+    def __init__(self, maxsize=1024, ttl=3600, path=None, table='cache'):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.path = path
+        self.table = table
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        if path:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute(f'CREATE TABLE IF NOT EXISTS {table} '
+                               '(key TEXT PRIMARY KEY, expires REAL, value BLOB)')
+            self._conn.commit()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, count=False) is not None
+
+    def get(self, key, default=None, count=True):
+        """Get the value stored for the key, or default if there is none or it has expired.
+
+        Args:
+            key: hashable key, with a repr that identifies it when persisted
+            default: value to return on a miss
+            count (bool): whether to count the lookup as a hit or a miss
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] <= now:
+                del self._data[key]
+                entry = None
+            if entry is None and self._conn is not None:
+                entry = self._load(key, now)
+                if entry is not None:
+                    self._store(key, entry)
+            if entry is None:
+                if count:
+                    self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            if count:
+                self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        """Store a value for the key, evicting the least recently used entries if needed."""
+        entry = (time.time() + self.ttl, value)
+        with self._lock:
+            self._store(key, entry)
+            if self._conn is not None:
+                self._conn.execute(f'DELETE FROM {self.table} WHERE expires <= ?', (time.time(),))
+                self._conn.execute(f'INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?)',
+                                   (repr(key), entry[0], pickle.dumps(value)))
+                self._conn.commit()
+
+    def delete(self, key):
+        """Remove the entry for the key, if there is one."""
+        with self._lock:
+            self._data.pop(key, None)
+            if self._conn is not None:
+                self._conn.execute(f'DELETE FROM {self.table} WHERE key = ?', (repr(key),))
+                self._conn.commit()
+
+    def clear(self):
+        """Remove all entries and reset the counters."""
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+            if self._conn is not None:
+                self._conn.execute(f'DELETE FROM {self.table}')
+                self._conn.commit()
+
+    def stats(self) -> dict:
+        """Get the hit and miss counters and the current size of the cache."""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self._data), 'maxsize': self.maxsize}
+
+    def close(self):
+        """Close the SQLite file, if there is one. The in-memory entries are kept."""
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def _store(self, key, entry):
+        self._data[key] = entry
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def _load(self, key, now):
+        row = self._conn.execute(f'SELECT expires, value FROM {self.table} WHERE key = ? AND expires > ?',
+                                 (repr(key), now)).fetchone()
+        if row is None:
+            return None
+        return (row[0], pickle.loads(row[1]))
@@ -0,0 +1,124 @@
+"""Read-only access to the Fineli database.
+
+Each thread keeps one read-only connection open instead of connecting on every request.
+The connections are opened with immutable=1, which lets SQLite skip file locking and change
+detection, so they are reopened whenever the database file is changed or replaced.
+The queries are module-level constants, so the statements prepared by the sqlite3 module
+are reused from its per-connection statement cache.
+"""
+
+import os
+import sqlite3
+import threading
+
+FIND_FOOD_ID = 'SELECT foodid FROM food WHERE foodname = ?'
+FOOD_NAMES = 'SELECT foodname, foodid FROM {table} ORDER BY foodname'
+FOOD_NAMES_BY_ID = 'SELECT foodid, foodname FROM food WHERE foodid IN ({placeholders})'
+
+
+class FineliDatabase:
+    """A per-thread pool of read-only connections to the Fineli database.
+
+    Args:
+        path (str): path of the database file
+        mmap_size (int): bytes of the database file to memory-map
+        cache_size (int): size of the page cache of each connection in KiB
+        snapshot (str): directory of the nutrient snapshot exported from the database
+            (see helpers.export_nutrient_snapshot), used instead of the database where possible
+    """
+
+    def __init__(self, path='fineli.db', mmap_size=256 * 1024 * 1024, cache_size=16 * 1024,
+                 snapshot='fineli_snapshot'):
+        self.path = path
+        self.mmap_size = mmap_size
+        self.cache_size = cache_size
+        self.snapshot = snapshot
+        self._local = threading.local()
+
+    def init_app(self, app):
+        """Configure the database from the app config and register it in app.extensions."""
+        app.config.setdefault('FINELI_DB', self.path)
+        app.config.setdefault('FINELI_DB_MMAP_SIZE', self.mmap_size)
+        app.config.setdefault('FINELI_DB_CACHE_SIZE', self.cache_size)
+        app.config.setdefault('FINELI_SNAPSHOT', self.snapshot)
+        self.path = app.config['FINELI_DB']
+        self.mmap_size = app.config['FINELI_DB_MMAP_SIZE']
+        self.cache_size = app.config['FINELI_DB_CACHE_SIZE']
+        self.snapshot = app.config['FINELI_SNAPSHOT']
+        app.extensions['fineli_db'] = self
+
+    def _version(self):
+        stat = os.stat(self.path)
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def connection(self) -> sqlite3.Connection:
+        """Get the connection of the current thread, opening it if needed.
+        The connection stays open and must not be closed by the caller.
+
+        Raises:
+            sqlite3.OperationalError: if the database file doesn't exist
+        """
+        try:
+            version = self._version()
+        except OSError:
+            raise sqlite3.OperationalError(f'unable to open database file {self.path}')
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.version == version:
+            return conn
+        if conn is not None:
+            conn.close()
+        conn = sqlite3.connect(f'file:{self.path}?mode=ro&immutable=1', uri=True, cached_statements=256)
+        conn.execute(f'PRAGMA mmap_size = {int(self.mmap_size)}')
+        conn.execute(f'PRAGMA cache_size = {-int(self.cache_size)}')
+        self._local.conn = conn
+        self._local.version = version
+        return conn
+
+    def close(self):
+        """Close the connection of the current thread, if it has one."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def find_food_id(self, name:str):
+        """Get the id of the food with exactly the given name.
+
+        Args:
+            name (str): food name in the food table
+
+        Returns:
+            int: food id, or None if there is no such food
+        """
+        row = self.connection().execute(FIND_FOOD_ID, (name,)).fetchone()
+        return row[0] if row else None
+
+    def food_names(self, tables=('food',)) -> list:
+        """Get the food names of the given tables.
+
+        Args:
+            tables: names of the tables with FOODNAME and FOODID columns
+
+        Returns:
+            list: (food name, food id) tuples in the order of the names within each table
+        """
+        conn = self.connection()
+        rows = []
+        for table in tables:
+            rows.extend(conn.execute(FOOD_NAMES.format(table=table)))
+        return rows
+
+    def food_names_by_id(self, food_ids) -> dict:
+        """Get the names of the given foods.
+
+        Args:
+            food_ids: food ids
+
+        Returns:
+            dict: food names by food id, for the ids found in the food table
+        """
+        food_ids = list(dict.fromkeys(int(food_id) for food_id in food_ids))
+        if not food_ids:
+            return {}
+        stmt = FOOD_NAMES_BY_ID.format(placeholders=', '.join('?' * len(food_ids)))
+        return dict(self.connection().execute(stmt, food_ids))
@@ -0,0 +1,30 @@
+"""Export the nutrient values of the Fineli database as a memory-mapped snapshot.
+
+Run from the repository root after importing the database (python fineli_import.py):
+
+    python -m app.main.export_snapshot [fineli.db] [fineli_snapshot]
+
+The snapshot is a directory of .npy files with the food x nutrient matrix, the food ids,
+names and fuclass codes. The optimizer workers map it instead of querying the database,
+so they share one copy of it in the page cache. A snapshot is only used as long as the
+database is the one it was exported from, so export it again after every import.
+"""
+
+import sqlite3
+import sys
+
+from app.main.helpers import export_nutrient_snapshot
+
+
+def main(path="fineli.db", directory="fineli_snapshot"):
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        snapshot = export_nutrient_snapshot(conn, directory)
+    finally:
+        conn.close()
+    print(f"exported {len(snapshot.food_ids)} foods and {len(snapshot.nutrients)} nutrients "
+          f"({snapshot.values.nbytes} bytes of values) to {directory}")
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:3])
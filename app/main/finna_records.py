@@ -0,0 +1,124 @@
+"""Parsing of the MARC XML records of Finna search results.
+
+Only the language (041), author (100) and title (245) fields of a record are needed, so a
+record is fed to a pull parser in chunks, and parsing stops as soon as all three fields
+have been read. The fields come before the long notes and holdings of most records, so
+usually only the beginning of a record is parsed. lxml is used if it is installed.
+"""
+
+import time
+
+try:
+    from lxml.etree import XMLPullParser
+except ImportError:
+    from xml.etree.ElementTree import XMLPullParser
+
+MARC_NS = '{http://www.loc.gov/MARC21/slim}'
+DATAFIELD = MARC_NS + 'datafield'
+WANTED_TAGS = frozenset(('041', '100', '245'))
+CHUNK_SIZE = 4096
+
+
+class BookRecord:
+    """The language, the original language, the author and the title of a book.
+    Fields the record doesn't have are None."""
+
+    __slots__ = ('lang', 'source_lang', 'author', 'title')
+
+    def __init__(self, lang=None, source_lang=None, author=None, title=None):
+        self.lang = lang
+        self.source_lang = source_lang
+        self.author = author
+        self.title = title
+
+    def key(self) -> tuple:
+        return (self.lang, self.source_lang, self.author, self.title)
+
+    def __eq__(self, other):
+        return isinstance(other, BookRecord) and self.key() == other.key()
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def __repr__(self):
+        return f'BookRecord{self.key()!r}'
+
+
+def parse_record(full_record) -> BookRecord:
+    """Read the language, author and title of a MARC XML record.
+    Only the first of each of the fields is read.
+
+    Args:
+        full_record: the fullRecord of a Finna search result, as str or bytes
+
+    Returns:
+        BookRecord: the fields of the book
+    """
+    if isinstance(full_record, str):
+        full_record = full_record.encode('utf-8')
+    record = BookRecord()
+    missing = set(WANTED_TAGS)
+    parser = XMLPullParser(events=('end',))
+    for start in range(0, len(full_record), CHUNK_SIZE):
+        parser.feed(full_record[start:start + CHUNK_SIZE])
+        for _, element in parser.read_events():
+            if element.tag != DATAFIELD:
+                continue
+            tag = element.get('tag')
+            if tag in missing:
+                missing.discard(tag)
+                _read_field(record, tag, [subfield.text for subfield in element])
+            # the fields already read are not needed any more
+            element.clear()
+        if not missing:
+            break
+    return record
+
+
+def _read_field(record, tag, texts):
+    if not texts or texts[0] is None:
+        return
+    if tag == '041':
+        record.lang = texts[0]
+        if len(texts) > 1:
+            record.source_lang = texts[1]
+    elif tag == '100':
+        record.author = texts[0].rstrip('.,')
+    elif tag == '245':
+        record.title = texts[0].rstrip(' /:.')
+
+
+def iter_books(records, language='all', timings=None):
+    """Parse the books of Finna search results one at a time as the records arrive,
+    leaving out duplicates and the books in other languages. Books without a language
+    code are left out.
+
+    Args:
+        records: iterable of the records of the search results, dicts with the key 'fullRecord'
+        language (str): language code of the books to keep, or 'all'
+        timings (dict): optional dict to which the seconds spent parsing are added as 'parse'
+
+    Yields:
+        BookRecord: the books in the order of the search results
+    """
+    seen = set()
+    for rec in records:
+        start = time.perf_counter()
+        book = parse_record(rec['fullRecord'])
+        if timings is not None:
+            timings['parse'] = timings.get('parse', 0.0) + time.perf_counter() - start
+        if book.lang is None or (language != 'all' and book.lang != language):
+            continue
+        if book.key() not in seen:
+            seen.add(book.key())
+            yield book
+
+
+def parse_records(records, language='all') -> list:
+    """Parse the books of Finna search results, leaving out duplicates and the books
+    in other languages, like iter_books.
+
+    Returns:
+        list: BookRecords in the order of the search results
+    """
+    return list(iter_books(records, language))
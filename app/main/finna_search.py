@@ -0,0 +1,133 @@
+"""Finna searches that return more than one page of results.
+
+The first page of a search is fetched at once, because it tells how many results there
+are. The rest of the pages, up to FINNA_MAX_RESULTS results, are then fetched at the same
+time in a thread pool shared by the requests of the process, while the records of the
+first page are already being shown. The records are given out in the order of the pages.
+
+The settings are read from the app config:
+
+    FINNA_PAGE_SIZE = 50        # records per page, at most 100
+    FINNA_MAX_RESULTS = 300     # records fetched for one search
+    FINNA_WORKERS = 4           # pages fetched at the same time by the process
+"""
+
+import logging
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+
+class FinnaSearch:
+    """Fetches the pages of Finna search results concurrently.
+
+    Args:
+        page_size (int): records per page
+        max_results (int): records fetched for one search
+        workers (int): pages fetched at the same time
+    """
+
+    def __init__(self, page_size=50, max_results=300, workers=4):
+        self.page_size = page_size
+        self.max_results = max_results
+        self.workers = workers
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        app.config.setdefault('FINNA_PAGE_SIZE', self.page_size)
+        app.config.setdefault('FINNA_MAX_RESULTS', self.max_results)
+        app.config.setdefault('FINNA_WORKERS', self.workers)
+        self.page_size = app.config['FINNA_PAGE_SIZE']
+        self.max_results = app.config['FINNA_MAX_RESULTS']
+        self.workers = app.config['FINNA_WORKERS']
+        app.extensions['finna_search'] = self
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='finna')
+            return self._executor
+
+    def search(self, search_page) -> 'SearchResults':
+        """Fetch the first page of results and start fetching the rest.
+
+        Args:
+            search_page: function called with the keyword arguments page and limit,
+                         returning a page of the search results like helpers.finna_search
+
+        Returns:
+            SearchResults: the number of results and the records
+
+        Raises:
+            requests.RequestException: if the first page could not be fetched
+            ValueError: if the first page is not JSON
+        """
+        start = time.perf_counter()
+        first = search_page(page=1, limit=self.page_size)
+        fetch_time = time.perf_counter() - start
+        count = first.get('resultCount', 0)
+        pages = math.ceil(min(count, self.max_results) / self.page_size)
+        later = [self.executor.submit(search_page, page=page, limit=self.page_size) for page in range(2, pages + 1)]
+        return SearchResults(count, first.get('records', []), later, {'fetch': fetch_time})
+
+
+class SearchResults:
+    """The records of a search, with the later pages still being fetched.
+
+    Attributes:
+        count (int): number of results of the search in Finna
+        fetched (int): number of records given out by records() so far
+        incomplete (bool): whether a later page could not be fetched or read
+        timings (dict): seconds spent waiting for the pages as 'fetch'
+    """
+
+    def __init__(self, count, first_records, later_pages, timings=None):
+        self.count = count
+        self.fetched = 0
+        self.incomplete = False
+        self.timings = timings if timings is not None else {'fetch': 0.0}
+        self._first_records = first_records
+        self._later_pages = later_pages
+
+    def records(self):
+        """Give out the records of the pages in order, waiting for each page as needed.
+        A page that is not JSON is skipped, and the pages after one that could not be
+        fetched are left out. The pages not fetched yet are cancelled if the records
+        are not read to the end."""
+        try:
+            yield from self._give_out(self._first_records)
+            for future in self._later_pages:
+                start = time.perf_counter()
+                try:
+                    records = future.result().get('records', [])
+                except requests.RequestException:
+                    logger.warning('a page of Finna results could not be fetched', exc_info=True)
+                    self.incomplete = True
+                    return
+                except ValueError:
+                    # e.g. a truncated response; the rows already sent can't be taken back
+                    logger.warning('a page of Finna results could not be read', exc_info=True)
+                    self.incomplete = True
+                    continue
+                finally:
+                    self.timings['fetch'] += time.perf_counter() - start
+                yield from self._give_out(records)
+        finally:
+            self.close()
+
+    def _give_out(self, records):
+        for record in records:
+            self.fetched += 1
+            yield record
+
+    def close(self):
+        """Cancel fetching the pages that haven't been started yet."""
+        for future in self._later_pages:
+            future.cancel()
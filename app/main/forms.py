@@ -1,7 +1,8 @@
 from datetime import date
 
 from flask_wtf import FlaskForm
-from wtforms import StringField, SubmitField, TextAreaField, SelectField, IntegerField, DecimalField, FloatField, DateField
+from wtforms import Form, StringField, SubmitField, TextAreaField, SelectField, IntegerField, DecimalField, FloatField, DateField, \
+    FieldList, FormField
 from wtforms.validators import Optional, ValidationError, DataRequired, NumberRange
 
 from app.main.helpers import FlexibleFloatField, get_food_names
@@ -39,14 +40,35 @@ class PlottingForm(FlaskForm):
     submit = SubmitField('Piirrä')
     
 
+MAX_EATEN_FOODS = 20
+
+
+class EatenFoodForm(Form):
+    # rows left empty are skipped, so the fields are checked in NutrientForm.validate_foods
+    food = StringField('Ruoka', validators=[Optional()])
+    amount = FlexibleFloatField('Määrä (grammoina)', validators=[Optional(), NumberRange(min=0.1)])
+
+
 class NutrientForm(FlaskForm):
-    food = StringField('Ruoka', validators=[DataRequired(message="Ruoka puuttuu")])
-    amount = FlexibleFloatField('Määrä (grammoina)',
-                                validators=[DataRequired(message="Määrä puuttuu"),
-                                            NumberRange(min=0.1)])
+    foods = FieldList(FormField(EatenFoodForm), min_entries=1, max_entries=MAX_EATEN_FOODS)
     # TODO: add fields for selecting sex & age
     submit = SubmitField('Laske')
 
+    def validate_foods(form, field):
+        rows = form.eaten_rows()
+        if not rows:
+            raise ValidationError('Ruoka puuttuu')
+        for row in rows:
+            if not row.food.data:
+                raise ValidationError('Ruoka puuttuu')
+            if not row.amount.data:
+                raise ValidationError(f'Määrä puuttuu: {row.food.data}')
+
+    def eaten_rows(self) -> list:
+        """Get the rows of the eaten foods that are not empty."""
+        return [entry.form for entry in self.foods.entries
+                if entry.form.food.data or entry.form.amount.data]
+
 
 class ScroogeForm(FlaskForm):
     start = DateField('Ensimmäinen päivä (p.k.vvvv)', format='%d.%m.%Y',
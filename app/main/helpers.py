@@ -1,15 +1,24 @@
+import json
+import logging
+import os
+import shutil
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
 from operator import itemgetter
-from collections import defaultdict
+from types import MappingProxyType
+from collections import defaultdict, namedtuple
 
 from wtforms import FloatField
+import numpy as np
 import pandas as pd
-from pulp import LpMinimize, LpProblem, LpStatus, lpSum, LpVariable
+from pulp import LpMinimize, LpProblem, LpStatus, lpSum, LpVariable, LpAffineExpression, \
+     LpConstraint, LpConstraintGE, LpConstraintLE, LpSolutionOptimal, LpSolutionIntegerFeasible, PULP_CBC_CMD
 import requests
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
 
+logger = logging.getLogger(__name__)
 
 omitted_food_types = ("babyftot",
                       "babmeatd",
@@ -36,6 +45,69 @@ omitted_food_types = ("babyftot",
                       "drsport",
                       "drwater")
 
+MAX_TOTAL_MASS = 4000  # the maximum total mass of the suggested foods in grams
+MAX_FOOD_MASS = 800    # the maximum mass of a single suggested food in grams
+
+# the ways of solving the optimization problem:
+# "milp" solves the integer program exactly, "lp" solves its LP relaxation and rounds the result,
+# and "warm" solves the integer program starting from a solution of a nearby problem
+SOLVE_MODES = ("milp", "lp", "warm")
+
+# the result of an optimization: solver status, total energy of the suggested foods,
+# {food id: grams} for the suggested foods, the solve mode that produced the result,
+# an upper bound for the relative gap between the energy and the optimum (None if not known)
+# and the number of foods left out of the model by reduce_candidate_foods
+SolveResult = namedtuple("SolveResult", ["status", "energy", "amounts", "mode", "gap", "removed"],
+                         defaults=(0,))
+
+# the foods left in the model after removing the ones that can't be in an optimal solution:
+# row numbers of the remaining foods, the rows of the identical foods that each of them stands for,
+# and the numbers of foods removed for having no nutrients, being duplicates or being dominated
+CandidateFoods = namedtuple("CandidateFoods", ["rows", "groups", "zero", "duplicate", "dominated"])
+
+# candidate foods, keyed by the nutrients, the data version and whether dominated foods are removed
+_candidate_foods = {}
+_candidate_foods_lock = threading.Lock()
+
+# functions called with (stage name, seconds) each time a stage is timed with timed_stage,
+# e.g. Metrics.record_stage of the web app
+stage_hooks = []
+
+
+@contextmanager
+def timed_stage(stage:str):
+    """Time the code in the with block and pass the time to the stage hooks.
+    The stages are "db_query", "pivot", "model_build", "solve" and "external_api".
+    """
+    if not stage_hooks:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        for hook in list(stage_hooks):
+            hook(stage, elapsed)
+
+
+@contextmanager
+def collect_stage_times():
+    """Collect the total seconds of each stage timed in the with block into a dict,
+    for sending the timings of a worker process back with its result.
+    """
+    timings = defaultdict(float)
+
+    def collect(stage, seconds):
+        timings[stage] += seconds
+
+    stage_hooks.append(collect)
+    try:
+        yield timings
+    finally:
+        stage_hooks.remove(collect)
+
+
 class FlexibleFloatField(FloatField):
 
     def process_formdata(self, valuelist):
@@ -44,27 +116,85 @@ class FlexibleFloatField(FloatField):
         return super(FlexibleFloatField, self).process_formdata(valuelist)
 
 
-def get_food_names() -> list:
+def get_food_names(conn) -> list:
     """(Not currently used) Get a list of 5 food ids and names from the db.
 
+    Args:
+        conn: database connection
+
     Returns:
         list: list of tuples of food ids and names as in (foodid, foodname)
     """
-    with sqlite3.connect('fineli.db') as conn:
-        curs = conn.cursor()
-        try:
-            stmt = "SELECT foodid, foodname FROM food"
-            #return [(x[0], x[1]) for x in curs.execute(stmt)]
-            curs.execute(stmt)
-            #foods = curs.fetchall()
-            foods = curs.fetchmany(5)
-            print(foods)
-            yield foods
-        except Exception as e:
-            print(e)
-        finally:
-            if curs:
-                curs.close()
+    return conn.execute("SELECT foodid, foodname FROM food LIMIT 5").fetchall()
+
+
+RDA_FILE = "././saantisuositus_2014_with_max.csv"
+RDA_COLUMNS = ["EUFDNAME", "name", "unit", "mnuori", "maikuinen", "mkeski", "miäkäs", "mvanha", "npieni",
+               "nnuori", "naikuinen", "nkeski", "niäkäs", "nvanha", "max"]
+# the sex + age groups, one column each in the csv file
+RDA_GROUPS = tuple(RDA_COLUMNS[3:-1])
+
+# the recommendations for all the groups, parsed once: nutrient abbreviations (lowercase and sorted,
+# like the columns of the nutrient matrix), names and units of the nutrients, a read-only vector of
+# the targets for each group in the order of the nutrients, the vector of maximums and the file version
+RdaTable = namedtuple("RdaTable", ["nutrients", "names", "units", "targets", "maximums", "version"])
+
+# loaded RDA tables keyed by file path
+_rda_tables = {}
+_rda_tables_lock = threading.Lock()
+
+
+def _read_only(array):
+    array.flags.writeable = False
+    return array
+
+
+def load_rda_table(path=RDA_FILE, version=None) -> RdaTable:
+    """Read the RDA (recommended daily allowance) values of all groups of people from a csv file.
+
+    Args:
+        path: path of the csv file
+        version: file version token to store in the table
+
+    Returns:
+        RdaTable: the recommendations, sorted by nutrient
+    """
+    rda_all = pd.read_csv(path, sep=";", header=None, names=RDA_COLUMNS)
+    rda_all = rda_all.assign(EUFDNAME=rda_all["EUFDNAME"].str.lower()).sort_values("EUFDNAME", kind="stable")
+    targets = MappingProxyType({group: _read_only(rda_all[group].to_numpy(dtype=float))
+                                for group in RDA_GROUPS if group in rda_all})
+    return RdaTable(nutrients=tuple(rda_all["EUFDNAME"]), names=tuple(rda_all["name"]),
+                    units=tuple(rda_all["unit"]), targets=targets,
+                    maximums=_read_only(rda_all["max"].to_numpy(dtype=float)), version=version)
+
+
+def get_rda_table(path=RDA_FILE) -> RdaTable:
+    """Get the RDA values of all groups of people, reading the csv file only when it has
+    not been read yet or has changed since.
+
+    Args:
+        path: path of the csv file
+
+    Returns:
+        RdaTable: the recommendations, sorted by nutrient
+    """
+    version = get_database_version(path)
+    if version is None:
+        # without a file to check for changes, don't cache
+        return load_rda_table(path)
+    with _rda_tables_lock:
+        table = _rda_tables.get(path)
+    if table is None or table.version != version:
+        table = load_rda_table(path, version)
+        with _rda_tables_lock:
+            _rda_tables[path] = table
+    return table
+
+
+def clear_rda_cache():
+    """Forget the loaded RDA tables."""
+    with _rda_tables_lock:
+        _rda_tables.clear()
 
 
 def get_rda(age:str) -> pd.DataFrame:
@@ -77,113 +207,803 @@ def get_rda(age:str) -> pd.DataFrame:
     Returns:
         DataFrame: RDAs for a number of nutrients for the specified group of people
     """
-    rda_all = pd.read_csv("././saantisuositus_2014_with_max.csv", sep=";", header=None, names=["EUFDNAME", "name", "unit", "mnuori", "maikuinen", "mkeski", "miäkäs", "mvanha", "npieni","nnuori", "naikuinen", "nkeski", "niäkäs", "nvanha", "max"])
-    rda_selected = rda_all[["EUFDNAME", "name", age, "max"]]
-    rda_selected["EUFDNAME"] = rda_selected["EUFDNAME"].str.lower()
-    rda = rda_selected.rename(columns={age: "target"})
-    return rda
+    table = get_rda_table()
+    return pd.DataFrame({"EUFDNAME": table.nutrients, "name": table.names,
+                         "target": table.targets[age], "max": table.maximums})
+
+
+def get_eaten_totals(matrix, food_ids, amounts) -> np.ndarray:
+    """Add up the nutrients of the eaten foods as a single product of the amounts and
+    the rows of the foods in a nutrient matrix. Foods that are not in the matrix add nothing.
+
+    Args:
+        matrix: NutrientMatrix with the eaten foods, see get_nutrient_matrix
+        food_ids: ids of the eaten foods
+        amounts: grams of each food eaten
+
+    Returns:
+        array: total amounts of the nutrients eaten, in the order of matrix.nutrients
+    """
+    food_ids = np.asarray(food_ids, dtype=np.int64)
+    amounts = np.asarray(amounts, dtype=float)
+    # the food ids of the matrix are sorted, so the rows can be found by binary search
+    rows = np.searchsorted(matrix.food_ids, food_ids)
+    found = rows < len(matrix.food_ids)
+    found[found] = matrix.food_ids[rows[found]] == food_ids[found]
+    return amounts[found] @ matrix.values[rows[found]].astype(float)
+
+
+def get_remainder(rda_table:RdaTable, age:str, nutrients, eaten) -> pd.DataFrame:
+    """Subtract the eaten nutrients from the RDA values of a group of people.
+    Only the nutrients that are in both the RDA table and the eaten nutrients are included.
+
+    Args:
+        rda_table: RdaTable from get_rda_table
+        age: string denoting a combination of sex + age (one of the columns in the csv file)
+        nutrients: sorted nutrient abbreviations of the eaten amounts
+        eaten: total amounts of the nutrients eaten, see get_eaten_totals
+
+    Returns:
+        DataFrame: name, target, eaten_total, remainder and max of the nutrients, indexed and
+                   sorted by EUFDNAME like the columns of the nutrient matrix
+    """
+    rda_nutrients = np.array(rda_table.nutrients, dtype=object)
+    nutrients = np.asarray(nutrients, dtype=object)
+    positions = np.searchsorted(nutrients, rda_nutrients)
+    known = positions < len(nutrients)
+    known[known] = nutrients[positions[known]] == rda_nutrients[known]
+    eaten = np.asarray(eaten, dtype=float)[positions[known]]
+    targets = rda_table.targets[age][known]
+    return pd.DataFrame({"name": np.array(rda_table.names, dtype=object)[known],
+                         "target": targets,
+                         "eaten_total": eaten,
+                         "remainder": targets - eaten,
+                         "max": rda_table.maximums[known]},
+                        index=pd.Index(rda_nutrients[known], name="EUFDNAME"))
+
+
+# a wide nutrient table: one row per food and one column per nutrient, stored as a
+# read-only float32 array with the food ids and nutrient abbreviations as index arrays
+NutrientMatrix = namedtuple("NutrientMatrix", ["values", "food_ids", "nutrients", "version"])
+
+# loaded nutrient matrices, keyed by the omitted food types and the nutrient tuple
+_nutrient_matrices = {}
+_nutrient_matrices_lock = threading.Lock()
+
+
+def get_database_path(conn) -> str:
+    """Get the file path of the main database of the given connection.
+
+    Args:
+        conn: database connection
+
+    Returns:
+        str: path of the database file ('' for in-memory databases)
+    """
+    for _, name, path in conn.execute("PRAGMA database_list"):
+        if name == "main":
+            return path or ""
+    return ""
+
+
+def get_database_version(path:str):
+    """Get a token that changes whenever the database file is changed or replaced.
+
+    Args:
+        path: path of the database file
+
+    Returns:
+        tuple: inode, modification time and size of the file (or None if there is no file)
+    """
+    try:
+        stat = os.stat(path)
+    except (OSError, ValueError):
+        return None
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def nutrition_values_query(nutrient_tuple, omitted=omitted_food_types) -> tuple:
+    """Get the query for the nutrition values of all foods except for the omitted food types.
+    Energy ('enerc') is always included.
+
+    Args:
+        nutrient_tuple: tuple of the abbreviations of nutrients that we want to look at
+        omitted: tuple of the fuclass codes of the foods to leave out
+
+    Returns:
+        tuple: the SQL statement and its parameters
+    """
+    omitted = tuple(omitted)
+    nutrient_tuple = tuple(nutrient_tuple)
+    # dividing bestloc by 100.0 gives the amount of the nutrient in one gram of food
+    stmt = "SELECT component_value.foodid, component_value.eufdname, " + \
+           "IFNULL(component_value.bestloc, 0) / 100.0 " + \
+           "FROM food JOIN component_value ON food.foodid=component_value.foodid " + \
+           f"WHERE food.fuclass NOT IN ({', '.join('?' * len(omitted))}) " + \
+           f"AND component_value.eufdname IN ({', '.join('?' * (len(nutrient_tuple) + 1))})" # an extra question mark for enerc
+    params = omitted + nutrient_tuple + ("enerc",)
+    return stmt, params
+
+
+def load_nutrient_matrix(conn, nutrient_tuple, omitted=omitted_food_types, version=None,
+                         missing=0.0) -> NutrientMatrix:
+    """Query the nutrition values of all foods except for the omitted food types
+    and put them in a NutrientMatrix. Energy ('enerc') is always included.
+
+    Args:
+        conn: database connection
+        nutrient_tuple: tuple of the abbreviations of nutrients that we want to look at
+        omitted: tuple of the fuclass codes of the foods to leave out
+        version: database version token to store in the matrix
+        missing: value for the nutrients that have no value for a food in the database
+
+    Returns:
+        NutrientMatrix: nutrient values for foods
+    """
+    stmt, params = nutrition_values_query(nutrient_tuple, omitted)
+    with timed_stage("db_query"):
+        rows = conn.execute(stmt, params).fetchall()
+    if rows:
+        food_column, nutrient_column, value_column = zip(*rows)
+    else:
+        food_column, nutrient_column, value_column = (), (), ()
+
+    # transpose the data from a form that has a single nutrient in single food per row
+    # to a matrix with all nutrients in one food per row
+    with timed_stage("pivot"):
+        food_ids, food_index = np.unique(np.asarray(food_column, dtype=np.int64), return_inverse=True)
+        nutrients, nutrient_index = np.unique(np.asarray(nutrient_column, dtype=str), return_inverse=True)
+        values = np.full((len(food_ids), len(nutrients)), missing, dtype=np.float32)
+        values[food_index, nutrient_index] = np.asarray(value_column, dtype=np.float32)
+
+    for array in (values, food_ids, nutrients):
+        array.flags.writeable = False
+    return NutrientMatrix(values, food_ids, nutrients, version)
+
+
+def get_nutrient_matrix(conn, nutrient_tuple, omitted=omitted_food_types, snapshot=None) -> NutrientMatrix:
+    """Get the nutrient matrix for the given nutrients from the process-wide cache,
+    loading it first if it is not cached yet or if the database file has changed
+    since it was loaded. It is taken from the snapshot if there is an up-to-date one,
+    and queried from the database otherwise.
+
+    Args:
+        conn: database connection
+        nutrient_tuple: tuple of the abbreviations of nutrients that we want to look at
+        omitted: tuple of the fuclass codes of the foods to leave out
+        snapshot: optional directory of a snapshot written by export_nutrient_snapshot
+
+    Returns:
+        NutrientMatrix: nutrient values for foods
+    """
+    key = (frozenset(omitted), tuple(nutrient_tuple))
+    version = get_database_version(get_database_path(conn))
+    if version is None:
+        # in-memory databases have no file to check for changes, so don't cache them
+        return load_nutrient_matrix(conn, nutrient_tuple, omitted)
+
+    with _nutrient_matrices_lock:
+        matrix = _nutrient_matrices.get(key)
+    if matrix is not None and matrix.version == version:
+        return matrix
+
+    matrix = None
+    if snapshot:
+        nutrient_snapshot = load_nutrient_snapshot(snapshot)
+        # a snapshot exported before the database was changed is not used
+        if nutrient_snapshot is not None and nutrient_snapshot.version == version:
+            matrix = select_from_snapshot(nutrient_snapshot, nutrient_tuple, omitted)
+    if matrix is None:
+        matrix = load_nutrient_matrix(conn, nutrient_tuple, omitted, version)
+    with _nutrient_matrices_lock:
+        # drop the matrices loaded from an older version of the database
+        for old_key in [k for k, m in _nutrient_matrices.items() if m.version != version]:
+            del _nutrient_matrices[old_key]
+        _nutrient_matrices[key] = matrix
+    return matrix
+
+
+def clear_nutrient_matrix_cache():
+    """Forget all cached nutrient matrices and snapshots."""
+    with _nutrient_matrices_lock:
+        _nutrient_matrices.clear()
+        _nutrient_snapshots.clear()
+
+
+# all the nutrient values of all the foods, as arrays memory-mapped from the .npy files
+# of a snapshot directory: values is a float32 matrix with NaN for the missing values,
+# and food_names and fuclass are in the order of food_ids
+NutrientSnapshot = namedtuple("NutrientSnapshot", ["values", "food_ids", "nutrients", "food_names",
+                                                   "fuclass", "version"])
+SNAPSHOT_ARRAYS = ("values", "food_ids", "nutrients", "food_names", "fuclass")
+
+# loaded snapshots and the manifest file versions they were loaded from, keyed by directory
+_nutrient_snapshots = {}
+
+
+def export_nutrient_snapshot(conn, directory:str) -> NutrientSnapshot:
+    """Write all nutrient values of all foods, with the food names and fuclass codes, as
+    .npy files in a directory that the web workers can memory-map instead of querying
+    the database. An existing snapshot in the directory is replaced as a whole.
+
+    Args:
+        conn: database connection
+        directory: directory to write the snapshot in
+
+    Returns:
+        NutrientSnapshot: the exported arrays (in memory, not memory-mapped)
+    """
+    version = get_database_version(get_database_path(conn))
+    nutrients = tuple(row[0] for row in conn.execute("SELECT DISTINCT eufdname FROM component_value"))
+    matrix = load_nutrient_matrix(conn, nutrients, omitted=(), missing=np.nan)
+    foods = dict((food_id, (name, fuclass or "")) for food_id, name, fuclass
+                 in conn.execute("SELECT foodid, foodname, fuclass FROM food"))
+    food_names = np.array([foods.get(f, ("", ""))[0] for f in matrix.food_ids.tolist()], dtype=str)
+    fuclass = np.array([foods.get(f, ("", ""))[1] for f in matrix.food_ids.tolist()], dtype=str)
+    snapshot = NutrientSnapshot(matrix.values, matrix.food_ids, matrix.nutrients, food_names, fuclass,
+                                version)
+
+    # write a complete new directory and swap it in, so that readers never see half a snapshot
+    new_directory = directory.rstrip(os.sep) + ".new"
+    shutil.rmtree(new_directory, ignore_errors=True)
+    os.makedirs(new_directory)
+    for name in SNAPSHOT_ARRAYS:
+        np.save(os.path.join(new_directory, name + ".npy"), getattr(snapshot, name))
+    with open(os.path.join(new_directory, "snapshot.json"), "w") as manifest:
+        json.dump({"version": list(version) if version else None,
+                   "created": datetime.now().isoformat(timespec="seconds")}, manifest)
+    old_directory = directory.rstrip(os.sep) + ".old"
+    if os.path.exists(directory):
+        shutil.rmtree(old_directory, ignore_errors=True)
+        os.rename(directory, old_directory)
+    os.rename(new_directory, directory)
+    # workers that still have the old files mapped keep them until they reload
+    shutil.rmtree(old_directory, ignore_errors=True)
+    return snapshot
+
+
+def load_nutrient_snapshot(directory:str):
+    """Memory-map the arrays of a snapshot written by export_nutrient_snapshot.
+    A snapshot is mapped once per process and remapped when it is replaced, so
+    all processes share the one copy of it in the page cache.
+
+    Args:
+        directory: snapshot directory
+
+    Returns:
+        NutrientSnapshot: the snapshot, or None if there is no snapshot in the directory
+    """
+    manifest_path = os.path.join(directory, "snapshot.json")
+    manifest_version = get_database_version(manifest_path)
+    if manifest_version is None:
+        return None
+    with _nutrient_matrices_lock:
+        loaded = _nutrient_snapshots.get(directory)
+    if loaded is not None and loaded[0] == manifest_version:
+        return loaded[1]
+
+    with open(manifest_path) as manifest:
+        version = json.load(manifest)["version"]
+    arrays = [np.load(os.path.join(directory, name + ".npy"), mmap_mode="r") for name in SNAPSHOT_ARRAYS]
+    snapshot = NutrientSnapshot(*arrays, tuple(version) if version else None)
+    with _nutrient_matrices_lock:
+        _nutrient_snapshots[directory] = (manifest_version, snapshot)
+    return snapshot
+
+
+def select_from_snapshot(snapshot:NutrientSnapshot, nutrient_tuple, omitted=omitted_food_types) -> NutrientMatrix:
+    """Take the nutrient matrix of the given nutrients from a snapshot. The result is the
+    same as the one of load_nutrient_matrix: foods and nutrients without any values are
+    left out and the missing values are set to 0.
+
+    Args:
+        snapshot: NutrientSnapshot
+        nutrient_tuple: tuple of the abbreviations of nutrients that we want to look at
+        omitted: tuple of the fuclass codes of the foods to leave out
+
+    Returns:
+        NutrientMatrix: nutrient values for foods
+    """
+    rows = np.flatnonzero(~np.isin(snapshot.fuclass, list(omitted)))
+    columns = np.flatnonzero(np.isin(snapshot.nutrients, list(nutrient_tuple) + ["enerc"]))
+    with timed_stage("pivot"):
+        # only the selected part of the memory-mapped matrix is copied
+        values = snapshot.values[np.ix_(rows, columns)]
+        present = ~np.isnan(values)
+        keep_columns = present.any(axis=0)
+        keep_rows = present[:, keep_columns].any(axis=1)
+        values = np.nan_to_num(values[np.ix_(keep_rows, keep_columns)], nan=0.0)
+    food_ids = np.array(snapshot.food_ids[rows[keep_rows]])
+    nutrients = np.array(snapshot.nutrients[columns[keep_columns]])
+    for array in (values, food_ids, nutrients):
+        array.flags.writeable = False
+    return NutrientMatrix(values, food_ids, nutrients, snapshot.version)
 
 
-def get_nutrition_values_of_foods(conn, nutrient_tuple) -> pd.DataFrame:
+def get_nutrition_values_of_foods(conn, nutrient_tuple, snapshot=None) -> pd.DataFrame:
     """Use the given database connection to extract the nutrition values for all foods except
     for foods such as baby food, infant formulas, supplements, and weight loss preparations,
     and put them in a Pandas DataFrame with one row per food and nutrients as columns.
+    The values come from the cached nutrient matrix, so the database is only queried
+    when the matrix is first needed or when the database has changed.
     
     Args:
         conn: database connection
         nutrient_tuple: tuple of the abbreviations of nutrients that we want to look at
+        snapshot: optional directory of a snapshot written by export_nutrient_snapshot
 
     Returns:
         DataFrame: nutrient values for foods
     """
-    # the next line prints the full sql query if uncommented
-    #conn.set_trace_callback(print)
-    # multiplying bestloc by 1.0 changes the decimal separator from comma to full stop, avoiding problems down the line...
-    stmt = "SELECT component_value.foodid, component_value.eufdname, component_value.bestloc / 100.0 AS 'BESTLOC' " + \
-           "FROM food JOIN component_value ON food.foodid=component_value.foodid " +\
-            f"WHERE food.fuclass NOT IN ({(len(omitted_food_types)) * '?,'}"[:-1] + ") " +\
-            f"AND component_value.eufdname IN ({(len(nutrient_tuple)) * '?,'}" + "?)" # an extra question mark for enerc
-    params = omitted_food_types + nutrient_tuple + ("enerc",)
-    print(f"params: {params}")
-    long_table = pd.read_sql(stmt, conn, params=params)
-    print(f"energy value for sugar: {long_table.loc[2]['BESTLOC'] * 2}")
-    print(f"long_table.head: {long_table.head()}")
-    print(long_table.shape)
-    # transpose the dataframe from a form that has a single nutrient in single food per row
-    # to a format with all nutrients in one food per row
-    wide_table = pd.pivot(data=long_table, values='BESTLOC', index='FOODID', columns='EUFDNAME')
-    print(f"wide_table.head: {wide_table.head()}")
-    print(f"number of NaN values in wide_table: {wide_table.isnull().sum().sum()}")
-    # change NaN values to 0
-    wide_table = wide_table.fillna(0)
-    print(f"number of NaN values in wide_table 2: {wide_table.isnull().sum().sum()}")
-
+    matrix = get_nutrient_matrix(conn, nutrient_tuple, snapshot=snapshot)
+    wide_table = pd.DataFrame(matrix.values,
+                              index=pd.Index(matrix.food_ids, name="FOODID"),
+                              columns=pd.Index(matrix.nutrients, name="EUFDNAME"))
+    # lets the solver cache work derived from this version of the data
+    wide_table.attrs["version"] = matrix.version
     return wide_table
 
 
-def solve_for_optimal_foods(remainder_df, comp_values):
-    """Given the input dataframes, return the PuLP result that optimises the foods
+def _solver(**options):
+    # the solver log goes to stdout, so it is only shown when this module logs at debug level
+    return PULP_CBC_CMD(msg=logger.isEnabledFor(logging.DEBUG), **options)
+
+
+def build_optimization_model(nutrient_values, energy, minimums, maximums, food_ids, nutrients, cat="Integer",
+                             food_limits=None):
+    """Build the PuLP model that minimises the energy of the suggested foods while keeping
+    the amount of each nutrient between the given minimum and maximum. The constraints
+    are built directly from the nutrient matrix, one nutrient column at a time, and only
+    the foods that contain the nutrient get a term in its constraints.
+
+    Args:
+        nutrient_values: 2D array with one row per food and one column per nutrient (amounts per gram)
+        energy: array of the energy contents of the foods per gram
+        minimums: array of the minimum amounts of the nutrients
+        maximums: array of the maximum amounts of the nutrients
+        food_ids: food ids in the same order as the rows of nutrient_values
+        nutrients: nutrient abbreviations in the same order as the columns of nutrient_values
+        cat: category of the decision variables, "Integer" or "Continuous" for the LP relaxation
+        food_limits: maximum grams of each food (MAX_FOOD_MASS for all foods if None)
+
+    Returns:
+        tuple: the PuLP model and a list of its decision variables in the order of food_ids
+    """
+    with timed_stage("model_build"):
+        nutrient_values = np.asarray(nutrient_values, dtype=float)
+        energy = np.asarray(energy, dtype=float)
+
+        # Define the model
+        model = LpProblem(name="nutrient_optimisation", sense=LpMinimize)
+
+        if food_limits is None:
+            food_limits = np.full(len(food_ids), MAX_FOOD_MASS)
+
+        # Define the decision variables: grams of each food, at most MAX_FOOD_MASS per food
+        x = [LpVariable(name=f"x{f}", lowBound=0, upBound=float(limit), cat=cat)
+             for f, limit in zip(food_ids, food_limits)]
+
+        # Add constraints
+        model += (lpSum(x) <= MAX_TOTAL_MASS, "total_mass_of_food")
+        for j, n in enumerate(nutrients):
+            column = nutrient_values[:, j]
+            contains = np.flatnonzero(column)
+            amount = LpAffineExpression(zip([x[i] for i in contains], column[contains].tolist()))
+            model += LpConstraint(amount, LpConstraintGE, f"min_of_{n}", float(minimums[j]))
+            model += LpConstraint(amount, LpConstraintLE, f"max_of_{n}", float(maximums[j]))
+
+        # Set the objective
+        model.setObjective(LpAffineExpression(zip(x, energy.tolist())))
+    return model, x
+
+
+def optimize_foods(nutrient_values, energy, minimums, maximums, food_ids, nutrients,
+                   mode="milp", time_limit=None, gap=None, initial=None, food_limits=None) -> SolveResult:
+    """Solve the amounts of foods with the least energy that keep the nutrients between
+    the minimums and maximums, using the given solve mode.
+
+    Args:
+        nutrient_values, energy, minimums, maximums, food_ids, nutrients, food_limits:
+            as in build_optimization_model
+        mode: one of SOLVE_MODES
+        time_limit: maximum number of seconds for each solver run (None for no limit)
+        gap: relative gap to the optimum at which the integer solver may stop (None to solve exactly)
+        initial: {food id: grams} of a solution of a nearby problem, used as the start in "warm" mode
+
+    Returns:
+        SolveResult: the suggested foods and how they were found
+    """
+    if mode not in SOLVE_MODES:
+        raise ValueError(f"unknown solve mode: {mode}")
+    nutrient_values = np.asarray(nutrient_values, dtype=float)
+    energy = np.asarray(energy, dtype=float)
+    if food_limits is None:
+        food_limits = np.full(len(food_ids), MAX_FOOD_MASS)
+    if mode == "lp":
+        return _optimize_relaxed(nutrient_values, energy, minimums, maximums, food_ids, nutrients,
+                                 time_limit, gap, food_limits)
+
+    model = NutrientModel(nutrient_values, energy, food_ids, nutrients, food_limits)
+    return model.solve(minimums, maximums, mode, time_limit, gap, initial)
+
+
+class NutrientModel:
+    """The integer program of build_optimization_model for a fixed set of foods and nutrients,
+    built once and then solved for any number of nutrient minimums and maximums. Only the
+    right-hand sides of the nutrient constraints change between the solves.
+
+    Args:
+        nutrient_values, energy, food_ids, nutrients, food_limits: as in build_optimization_model
+    """
+
+    def __init__(self, nutrient_values, energy, food_ids, nutrients, food_limits=None):
+        self.food_ids = np.asarray(food_ids)
+        self.nutrients = list(nutrients)
+        # the bounds are set by solve()
+        zeros = np.zeros(len(self.nutrients))
+        self.model, self.x = build_optimization_model(nutrient_values, energy, zeros, zeros, food_ids,
+                                                      nutrients, food_limits=food_limits)
+
+    def solve(self, minimums, maximums, mode="milp", time_limit=None, gap=None, initial=None) -> SolveResult:
+        """Solve the model with the given bounds for the nutrients.
+
+        Args:
+            minimums: array of the minimum amounts of the nutrients
+            maximums: array of the maximum amounts of the nutrients
+            mode: "milp", or "warm" to start from the initial solution
+            time_limit, gap, initial: as in optimize_foods
+
+        Returns:
+            SolveResult: the suggested foods and how they were found
+        """
+        for n, minimum, maximum in zip(self.nutrients, minimums, maximums):
+            self.model.constraints[f"min_of_{n}"].changeRHS(float(minimum))
+            self.model.constraints[f"max_of_{n}"].changeRHS(float(maximum))
+        warm_start = mode == "warm" and bool(initial)
+        if warm_start:
+            for f, var in zip(self.food_ids, self.x):
+                var.setInitialValue(initial.get(f, 0))
+        with timed_stage("solve"):
+            self.model.solve(_solver(timeLimit=time_limit, gapRel=gap, warmStart=warm_start))
+        # the gap is only known when the solver finished, not when it stopped at the time limit
+        found_gap = (gap or 0.0) if self.model.sol_status == LpSolutionOptimal else None
+        status = LpStatus[self.model.status]
+        if self.model.sol_status == LpSolutionIntegerFeasible:
+            # PuLP reports a solve stopped at the time limit with a solution as "Optimal"
+            status = "Feasible"
+        amounts = np.array([var.varValue or 0.0 for var in self.x])
+        return SolveResult(status, self.model.objective.value(),
+                           _food_amounts(self.food_ids, amounts), mode, found_gap)
+
+
+def _optimize_relaxed(nutrient_values, energy, minimums, maximums, food_ids, nutrients, time_limit, gap,
+                      food_limits):
+    # solve the LP relaxation, which is fast and gives a lower bound for the energy
+    model, x = build_optimization_model(nutrient_values, energy, minimums, maximums, food_ids, nutrients,
+                                        cat="Continuous", food_limits=food_limits)
+    with timed_stage("solve"):
+        model.solve(_solver(timeLimit=time_limit))
+    if model.sol_status != LpSolutionOptimal:
+        return SolveResult(LpStatus[model.status], None, {}, "lp", None)
+    bound = model.objective.value()
+    relaxed = np.array([var.varValue or 0.0 for var in x])
+
+    # rounding up never breaks a minimum because the nutrient values are not negative
+    amounts = np.ceil(relaxed - 1e-6)
+    if not _is_feasible(nutrient_values, minimums, maximums, food_limits, amounts):
+        # repair: solve the integer program with only the foods used by the relaxed solution
+        support = np.flatnonzero(relaxed > 0)
+        repair, repair_x = build_optimization_model(nutrient_values[support], energy[support], minimums,
+                                                    maximums, np.asarray(food_ids)[support], nutrients,
+                                                    food_limits=food_limits[support])
+        with timed_stage("solve"):
+            repair.solve(_solver(timeLimit=time_limit, gapRel=gap))
+        if repair.sol_status not in (LpSolutionOptimal, LpSolutionIntegerFeasible):
+            # the foods of the relaxed solution are not enough, solve the whole integer program instead
+            return optimize_foods(nutrient_values, energy, minimums, maximums, food_ids, nutrients,
+                                  "milp", time_limit, gap, food_limits=food_limits)
+        amounts = np.zeros(len(relaxed))
+        amounts[support] = [var.varValue or 0.0 for var in repair_x]
+
+    total_energy = float(amounts @ energy)
+    found_gap = (total_energy - bound) / bound if bound > 0 else 0.0
+    return SolveResult("Feasible", total_energy, _food_amounts(food_ids, amounts), "lp", found_gap)
+
+
+def _is_feasible(nutrient_values, minimums, maximums, food_limits, amounts, tolerance=1e-6) -> bool:
+    totals = amounts @ nutrient_values
+    return bool(np.all(totals >= np.asarray(minimums) - tolerance)
+                and np.all(totals <= np.asarray(maximums) + tolerance)
+                and amounts.sum() <= MAX_TOTAL_MASS
+                and np.all(amounts <= food_limits))
+
+
+def _food_amounts(food_ids, amounts) -> dict:
+    return {int(f): float(a) for f, a in zip(food_ids, amounts) if a > 0.0}
+
+
+def reduce_candidate_foods(nutrient_values, energy, dominance=False) -> CandidateFoods:
+    """Find the foods that need to be in the optimization model.
+
+    Foods without any of the nutrients are left out, as they would only add energy.
+    Foods with identical compositions are collapsed into one, which may then be eaten as much
+    as all of them together. Both of these keep the optimum unchanged. Optionally, foods that
+    another food dominates (at least as much of every nutrient per unit of energy, more of some)
+    are left out too; this is a heuristic, as the nutrient maximums and per-food limits can make
+    a dominated food necessary.
+
+    Args:
+        nutrient_values: 2D array with one row per food and one column per nutrient
+        energy: array of the energy contents of the foods
+        dominance: whether to leave out dominated foods
+
+    Returns:
+        CandidateFoods: the remaining foods and the numbers of foods left out
+    """
+    nutrient_values = np.asarray(nutrient_values, dtype=float)
+    energy = np.asarray(energy, dtype=float)
+    nonzero = np.flatnonzero(nutrient_values.any(axis=1))
+
+    # collapse identical rows (same nutrients and energy) to their first occurrence
+    compositions = np.column_stack([nutrient_values[nonzero], energy[nonzero]])
+    _, first, inverse = np.unique(compositions, axis=0, return_index=True, return_inverse=True)
+    order = np.argsort(first)
+    rows = nonzero[first[order]]
+    position = np.empty_like(order)
+    position[order] = np.arange(len(order))
+    groups = [[] for _ in rows]
+    for row, unique_index in zip(nonzero, inverse.reshape(-1)):
+        groups[position[unique_index]].append(row)
+
+    dominated = 0
+    if dominance:
+        keep = ~_dominated_rows(nutrient_values[rows], energy[rows])
+        dominated = int(len(rows) - keep.sum())
+        rows = rows[keep]
+        groups = [group for group, kept in zip(groups, keep) if kept]
+
+    return CandidateFoods(rows, [np.array(group) for group in groups],
+                          zero=int(len(energy) - len(nonzero)),
+                          duplicate=int(len(nonzero) - len(first)),
+                          dominated=dominated)
+
+
+def _dominated_rows(nutrient_values, energy, chunk_size=128) -> np.ndarray:
+    # only foods with energy can be compared per unit of energy
+    has_energy = energy > 0
+    per_energy = np.zeros_like(nutrient_values)
+    per_energy[has_energy] = nutrient_values[has_energy] / energy[has_energy, None]
+    candidates = per_energy[has_energy]
+    dominated = np.zeros(len(energy), dtype=bool)
+    for start in range(0, len(energy), chunk_size):
+        chunk = per_energy[start:start + chunk_size]
+        at_least = (candidates[None, :, :] >= chunk[:, None, :]).all(axis=2)
+        more = (candidates[None, :, :] > chunk[:, None, :]).any(axis=2)
+        dominated[start:start + chunk_size] = (at_least & more).any(axis=1)
+    return dominated & has_energy
+
+
+def get_candidate_foods(comp_values, dominance=False) -> CandidateFoods:
+    """Get the candidate foods for the given composition table, from the process-wide cache
+    if the table comes from a cached nutrient matrix (see get_nutrition_values_of_foods).
+
+    Args:
+        comp_values: Pandas dataframe with the nutrient compositions of foods, including 'enerc'
+        dominance: whether to leave out dominated foods
+
+    Returns:
+        CandidateFoods: the remaining foods and the numbers of foods left out
+    """
+    version = comp_values.attrs.get("version")
+    nutrient_values = comp_values.drop(columns="enerc")
+    key = (tuple(nutrient_values.columns), version, dominance)
+    if version is not None:
+        with _candidate_foods_lock:
+            candidates = _candidate_foods.get(key)
+        if candidates is not None:
+            return candidates
+    candidates = reduce_candidate_foods(nutrient_values.to_numpy(), comp_values["enerc"].to_numpy(), dominance)
+    if version is not None:
+        with _candidate_foods_lock:
+            for old_key in [k for k in _candidate_foods if k[1] != version]:
+                del _candidate_foods[old_key]
+            _candidate_foods[key] = candidates
+    return candidates
+
+
+def _split_collapsed_amounts(amounts:dict, food_ids, candidates:CandidateFoods) -> dict:
+    # share the amount of a collapsed food among the identical foods, at most MAX_FOOD_MASS each
+    split = {}
+    for row, group in zip(candidates.rows, candidates.groups):
+        remaining = amounts.get(int(food_ids[row]), 0.0)
+        for member in group:
+            if remaining <= 0.0:
+                break
+            split[int(food_ids[member])] = min(remaining, MAX_FOOD_MASS)
+            remaining -= MAX_FOOD_MASS
+    return split
+
+
+def solve_for_optimal_foods(remainder_df, comp_values, time_limit=None, mode="milp", gap=None, initial=None,
+                            prune=True, dominance=False):
+    """Given the input dataframes, return the result that optimises the foods
     to be eaten to meet daily nutrients while minimising calorie intake
     
     Args:
         remainder_df: Pandas dataframe with the information for the case we want to solve:
                       the target (minimum) nutrient amounts and maximum amounts
         comp_values: Pandas dataframe with the nutrient compositions of various foods
+        time_limit: maximum number of seconds for the solver (None for no limit)
+        mode: one of SOLVE_MODES
+        gap: relative gap to the optimum at which the solver may stop (None to solve exactly)
+        initial: {food id: grams} of a solution of a nearby problem for the "warm" mode
+        prune: whether to leave out the foods that can't be in the optimum (see reduce_candidate_foods)
+        dominance: whether pruning also leaves out dominated foods
 
     Returns:
-        PuLP optimization result
+        SolveResult: the optimization result
     """
-    # create a list of food index numbers
-    foods = comp_values.index.tolist()
-    print(foods[:3])
-    # create a separate dictionary of the energy contents of foods
-    energy = {f: comp_values.loc[f]["enerc"] for f in foods}
-    print(f"energy, sugar: {energy[1]}")
     # create a nutrient composition table without the energy values
     nutrient_values = comp_values.drop(columns="enerc")
-    print(f"nutrient_values after dropping enerc:\n {nutrient_values.head()}")
-    # create a list of nutrient name abbreviations
     nutrients = nutrient_values.columns.tolist()
-    print("nutrients", nutrients[:3])
-    print(f"test:\n {comp_values[['enerc', 'ca']]}")
-    
-    # Define the model
-    model = LpProblem(name="nutrient_optimisation", sense=LpMinimize)
-    print("model defined")
-
-    # Define the decision variables
-    x = {f: LpVariable(name=f"x{f}", lowBound=0, cat="Integer") for f in foods}
-    print("decision variables defined")
-
-    # Add constraints
-    model += (lpSum(x.values()) <= 4000, "total_mass_of_food")
-    for f in x:
-        model += (x[f] <= 800, f"mass_of_food_{f}")
-        #print("bbb")
-    for n in nutrients:
-        print(f"nutrient: {n}")
-        #print(f'remainder value: {remainder_df.loc[n]["remainder"]}')
-        #print(f'nutrient_values.loc[f][n]: {nutrient_values.loc[f][n]}')
-        #print(f'lpSum: {lpSum([nutrient_values.loc[f][n] * x[f] for f in foods])}')
-        #print(f'x[f]: {x[f]}')
-        model += (lpSum([nutrient_values.loc[f][n] * x[f] for f in foods]) >= remainder_df.loc[n]["remainder"], f"min_of_{n}")
-        model += (lpSum([nutrient_values.loc[f][n] * x[f] for f in foods]) <= remainder_df.loc[n]["max"] - remainder_df.loc[n]["remainder"], f"max_of_{n}")
-        #print("cccc")
-    #model += (sum([1 for w in x.values() if w > 0]) <= 50, "max_number_of_foods")
-
-    # Set the objective
-    model += lpSum(energy[f] * x[f] for f in foods)
-
-    # Solve the optimization problem
-    #status = model.solve()
-    model.solve()
-    print(f"status: {model.status}, {LpStatus[model.status]}")
-    print(f"total calories: {model.objective.value()}")
-    for var in model.variables():
-        if var.value() != 0.0:
-            print(f"{var.name}: {var.value()}")
-    print("all done")
-    return model
+    # the remaining nutrients must be covered, but the total may not exceed the maximum
+    minimums = remainder_df.loc[nutrients, "remainder"].to_numpy(dtype=float)
+    maximums = remainder_df.loc[nutrients, "max"].to_numpy(dtype=float) - minimums
+
+    food_ids = comp_values.index.to_numpy()
+    values = nutrient_values.to_numpy()
+    energy = comp_values["enerc"].to_numpy()
+    if not prune:
+        result = optimize_foods(values, energy, minimums, maximums, food_ids, nutrients,
+                                mode, time_limit, gap, initial)
+    else:
+        candidates = get_candidate_foods(comp_values, dominance)
+        rows = candidates.rows
+        # a collapsed food may be eaten as much as all the identical foods together
+        food_limits = np.array([MAX_FOOD_MASS * len(group) for group in candidates.groups])
+        if initial:
+            initial = {int(food_ids[row]): sum(initial.get(int(food_ids[member]), 0) for member in group)
+                       for row, group in zip(rows, candidates.groups)}
+        result = optimize_foods(values[rows], energy[rows], minimums, maximums, food_ids[rows], nutrients,
+                                mode, time_limit, gap, initial, food_limits)
+        result = result._replace(amounts=_split_collapsed_amounts(result.amounts, food_ids, candidates),
+                                 removed=len(food_ids) - len(rows))
+        logger.debug("foods removed: %s without nutrients, %s duplicates, %s dominated",
+                     candidates.zero, candidates.duplicate, candidates.dominated)
+    logger.debug("status: %s, mode: %s, gap: %s", result.status, result.mode, result.gap)
+    logger.debug("total calories: %s", result.energy)
+    logger.debug("suggested foods: %s", result.amounts)
+    return result
+
+
+def quantize_amount(amount:float, step:float) -> float:
+    """Round an amount of food to the nearest multiple of step, so that similar amounts
+    share the same cached optimization result. The result is never less than one step.
+
+    Args:
+        amount: amount of food in grams
+        step: size of the amount buckets in grams (0 or None for no rounding)
+
+    Returns:
+        float: the rounded amount
+    """
+    if not step:
+        return amount
+    return max(round(amount / step), 1) * step
+
+
+def solve_remainder(db_path:str, remainder_df, nutrient_tuple, time_limit=None, mode="milp",
+                    gap=None, initial=None, dominance=False, snapshot=None) -> dict:
+    """Solve the optimal foods for the given remainder in a background worker process.
+    The nutrient values are read from the snapshot or the database (and cached in the
+    worker process), and the result is returned as plain data that can be sent back to
+    the web worker.
+
+    Args:
+        db_path: path of the Fineli database file
+        remainder_df: Pandas dataframe with the remaining nutrient targets and maximums
+        nutrient_tuple: tuple of the abbreviations of nutrients that we want to look at
+        time_limit, mode, gap, initial, dominance: as in solve_for_optimal_foods
+        snapshot: optional directory of a snapshot written by export_nutrient_snapshot
+
+    Returns:
+        dict: solver status, total energy, a list of [food id, grams] pairs, solve mode, gap,
+              the number of foods left out of the model and the seconds spent in each stage
+    """
+    with collect_stage_times() as timings:
+        conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+        try:
+            comp_values = get_nutrition_values_of_foods(conn, nutrient_tuple, snapshot)
+        finally:
+            conn.close()
+        result = solve_for_optimal_foods(remainder_df, comp_values, time_limit, mode, gap, initial,
+                                         dominance=dominance)
+    return dict(_result_data(result), timings=dict(timings))
+
+
+def is_exact_result(result:dict) -> bool:
+    """Check whether a solve result can be reused for the same problem: an infeasible
+    problem, or a solution with a known gap to the optimum. Solves stopped at the time
+    limit (no gap) and the approximate results of the LP relaxation are not exact.
+
+    Args:
+        result: a result dict as returned by solve_remainder
+
+    Returns:
+        bool: whether the result is exact
+    """
+    if result['mode'] == 'lp':
+        return False
+    return result['status'] == 'Infeasible' or (result['status'] == 'Optimal' and result['gap'] is not None)
+
+
+def _result_data(result:SolveResult) -> dict:
+    return {"status": result.status, "energy": result.energy,
+            "foods": [[f, a] for f, a in result.amounts.items()],
+            "mode": result.mode, "gap": result.gap, "removed": result.removed}
+
+
+def solve_batch(db_path:str, remainders, nutrient_tuple, time_limit=None, mode="milp", gap=None,
+                dominance=False, snapshot=None) -> list:
+    """Solve the optimal foods for many remainders in one background worker process.
+    The nutrient values and the candidate foods are loaded once, and one model is built
+    for each set of nutrients and reused for all the remainders with those nutrients.
+    In "warm" mode each solve starts from the previous solution of the same model.
+
+    Args:
+        db_path: path of the Fineli database file
+        remainders: list of Pandas dataframes with the remaining nutrient targets and maximums
+        nutrient_tuple: tuple of the abbreviations of nutrients that we want to look at
+        time_limit: maximum number of seconds for each solve (None for no limit)
+        mode, gap, dominance: as in solve_for_optimal_foods
+        snapshot: optional directory of a snapshot written by export_nutrient_snapshot
+
+    Returns:
+        list: a dict for each remainder, in order, as returned by solve_remainder
+    """
+    with collect_stage_times() as load_timings:
+        conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+        try:
+            comp_values = get_nutrition_values_of_foods(conn, nutrient_tuple, snapshot)
+        finally:
+            conn.close()
+    candidates = get_candidate_foods(comp_values, dominance)
+    rows = candidates.rows
+    food_ids = comp_values.index.to_numpy()
+    nutrient_values = comp_values.drop(columns="enerc")
+    values = nutrient_values.to_numpy()[rows]
+    energy = comp_values["enerc"].to_numpy()[rows]
+    food_limits = np.array([MAX_FOOD_MASS * len(group) for group in candidates.groups])
+
+    models = {}
+    previous = {}
+    results = []
+    for remainder_df in remainders:
+        # the nutrients the eaten foods have no value for are left out of the remainder
+        nutrients = tuple(n for n in nutrient_values.columns if n in remainder_df.index)
+        minimums = remainder_df.loc[list(nutrients), "remainder"].to_numpy(dtype=float)
+        maximums = remainder_df.loc[list(nutrients), "max"].to_numpy(dtype=float) - minimums
+        columns = [nutrient_values.columns.get_loc(n) for n in nutrients]
+        with collect_stage_times() as timings:
+            if mode == "lp":
+                result = optimize_foods(values[:, columns], energy, minimums, maximums, food_ids[rows],
+                                        nutrients, mode, time_limit, gap, food_limits=food_limits)
+            else:
+                model = models.get(nutrients)
+                if model is None:
+                    model = NutrientModel(values[:, columns], energy, food_ids[rows], nutrients, food_limits)
+                    models[nutrients] = model
+                result = model.solve(minimums, maximums, mode, time_limit, gap, previous.get(nutrients))
+                if result.amounts:
+                    previous[nutrients] = result.amounts
+        result = result._replace(amounts=_split_collapsed_amounts(result.amounts, food_ids, candidates),
+                                 removed=len(food_ids) - len(rows))
+        # the time of loading the data is counted in the first result
+        for stage, seconds in load_timings.items():
+            timings[stage] += seconds
+        load_timings = {}
+        results.append(dict(_result_data(result), timings=dict(timings)))
+    return results
 
 
 def create_dfs_from_solution(conn, variables, eaten_df):
@@ -201,37 +1021,94 @@ def create_dfs_from_solution(conn, variables, eaten_df):
     pass
 
 
-def get_api_response(url:str, payload:dict) -> dict:
+def get_api_response(url:str, payload:dict, http) -> dict:
     """Download the content from an API and return a dictionary.
 
     Args:
         url (str): API endpoint
         payload (dict): parameters for the API call
+        http: HttpClient of the app, which retries failed calls
 
     Returns:
         content (dict): the contents of API response (or {} if something went wrong)
     """
-    # retry functionality to avoid timeout errors
-    session = requests.Session()
-    retry = Retry(total=3, backoff_factor=1)
-    adapter = HTTPAdapter(max_retries=retry)
-    session.mount('http://', adapter)
-    session.mount('https://', adapter)
-    
     try:
-        response = session.get(url, params=payload)
+        with timed_stage("external_api"):
+            response = http.get(url, params=payload)
         if response.status_code == 200:
             content = response.json()
-            print(f'content: {content}')
+            logger.debug('content: %s', content)
             return content
         else:
-            print('Something went wrong.')
+            logger.warning('API call to %s failed with status %s', url, response.status_code)
             return {}
-    except MaxRetryError:
-        print('Max retries')
+    except (requests.RequestException, ValueError) as e:
+        logger.warning('API call to %s failed: %s', url, e)
         return {}
 
 
+FINNA_API = 'https://api.finna.fi/api/v1/'
+WIKIPEDIA_API = 'https://{lang}.wikipedia.org/w/api.php'
+
+
+def finna_search(http, lookfor:str, search_type:str, fields=None, filters=None, limit=None, page=None) -> dict:
+    """Search the Finna API, like FinnaClient.search of finna_client but with the HttpClient of the app.
+
+    Args:
+        http: HttpClient of the app
+        lookfor (str): search terms
+        search_type (str): value of a FinnaSearchType, e.g. 'Author'
+        fields: record fields to return
+        filters: search filters, e.g. ['format:0/Book/']
+        limit (int): maximum number of records
+        page (int): page of the results to return, starting from 1
+
+    Returns:
+        dict: the search results
+
+    Raises:
+        requests.RequestException: if the search failed
+    """
+    payload = {'lookfor': lookfor, 'type': search_type}
+    if fields is not None:
+        payload['field[]'] = fields
+    if filters is not None:
+        payload['filter[]'] = filters
+    if limit is not None:
+        payload['limit'] = limit
+    if page is not None:
+        payload['page'] = page
+    with timed_stage("external_api"):
+        return http.get_json(FINNA_API + 'search', payload)
+
+
+def get_wikipedia_page(http, title:str, lang='fi') -> tuple:
+    """Get the summary and the image addresses of a Wikipedia page.
+
+    Args:
+        http: HttpClient of the app
+        title (str): title of the page
+        lang (str): language of the Wikipedia
+
+    Returns:
+        tuple: the summary as plain text and a list of the addresses of the images on the page
+
+    Raises:
+        requests.RequestException: if a request failed
+    """
+    url = WIKIPEDIA_API.format(lang=lang)
+    with timed_stage("external_api"):
+        summary = http.get_json(url, {'action': 'query', 'format': 'json', 'prop': 'extracts',
+                                      'explaintext': 1, 'exintro': 1, 'redirects': 1, 'titles': title})
+        images = http.get_json(url, {'action': 'query', 'format': 'json', 'generator': 'images',
+                                     'gimlimit': 'max', 'prop': 'imageinfo', 'iiprop': 'url',
+                                     'redirects': 1, 'titles': title})
+    extracts = [page.get('extract', '') for page in summary.get('query', {}).get('pages', {}).values()]
+    image_urls = [info['url'] for page in images.get('query', {}).get('pages', {}).values()
+                  for info in page.get('imageinfo', [])]
+    return (extracts[0] if extracts else ''), image_urls
+
+
 def get_daily_values(data:list) -> list:
     """Filter the price/volume data to only keep one value per day.
 
@@ -247,15 +1124,13 @@ def get_daily_values(data:list) -> list:
     # The timestamps include microseconds -> divide by 1000 to get the correct dates.
     # First, get the very first item in the list
     daily_values.append([datetime.utcfromtimestamp(data[0][0] / 1000).date(), data[0][1]])
-    print(f'daily_values list with the first item: {daily_values}')
+    logger.debug('daily_values list with the first item: %s', daily_values)
     # Then, append the first value for each new day
     for item in data[1:]:
         day = datetime.utcfromtimestamp(item[0] / 1000).date()
-        print(f'the next item: {day} {item[1]}')
         if day > daily_values[-1][0]:
-            print(f'day added: {day}')
             daily_values.append([day, item[1]])
-    print(f'daily values to return: {daily_values}')
+    logger.debug('daily values to return: %s', daily_values)
     return daily_values
 
 
@@ -272,15 +1147,13 @@ def get_bear_length(prices:list) -> int:
     counter = 0
     max = 0
     for i in range(len(prices) - 1):
-        print(f'i: {i}')
         if prices[i + 1][1] < prices[i][1]:
             counter += 1
-            print(f'counter = {counter}')
             if counter > max:
                 max = counter
-                print(f'new max = {max}')
         else:
             counter = 0
+    logger.debug('longest bear trend: %s days', max)
     return max
 
 
@@ -295,14 +1168,13 @@ def get_highest_volume(volumes:list) -> list:
     Returns:
         max (list): the date with highest volume and the volume in euros
     """
-    print(f'volumes: {volumes}')
+    logger.debug('volumes: %s', volumes)
     # set the first day as the starting point
     max = volumes[0]
     for day in volumes[1:]:
         if day[1] > max[1]:
-            print(f'new max: {day}')
             max = day
-    print(f'max: {max}')
+    logger.debug('max: %s', max)
     
     return max
 
@@ -337,7 +1209,7 @@ def get_buy_and_sell_dates(prices:list) -> tuple:
         elif day[1] < start[1]:
             start = day
             peak = day
-    print(f'max_so_far to return: {max_so_far}')
+    logger.debug('max_so_far to return: %s', max_so_far)
     return max_so_far[0][0], max_so_far[1][0]
             
             
\ No newline at end of file
@@ -0,0 +1,216 @@
+"""A shared HTTP client for the external APIs of the app (CoinGecko, Finna and Wikipedia).
+
+One requests.Session is kept for the whole process, so connections and TLS sessions are
+reused from a connection pool per host instead of being opened for every call. Every
+call has connect and read timeouts. Failed calls (connection errors, timeouts, 429 and
+5xx responses) are retried after a random wait that grows with each attempt, so that
+clients retrying together don't hit the API at the same moment.
+
+A circuit breaker per host stops calling a host that keeps failing: after the configured
+number of failed calls in a row, calls to it fail at once with CircuitOpenError until
+the reset time has passed. Then one call is let through, and the circuit closes again
+if it succeeds.
+
+The settings are read from the app config:
+
+    HTTP_CONNECT_TIMEOUT = 3.05     # seconds to wait for a connection
+    HTTP_READ_TIMEOUT = 10          # seconds to wait for data from the server
+    HTTP_RETRIES = 2                # retries after a failed attempt
+    HTTP_BACKOFF = 0.5              # base of the wait before a retry in seconds
+    HTTP_POOL_SIZE = 10             # connections kept open to each host
+    HTTP_BREAKER_THRESHOLD = 5      # failed calls in a row that open the circuit of a host
+    HTTP_BREAKER_RESET = 30         # seconds the circuit stays open
+"""
+
+import logging
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+USER_AGENT = 'website_demo (https://github.com/paulal/website_demo)'
+
+
+class CircuitOpenError(requests.RequestException):
+    """The host has failed too many times in a row, so it is not called for a while."""
+
+
+class CircuitBreaker:
+    """Counts the failed calls to a host in a row and tells whether it may be called.
+
+    Args:
+        threshold (int): failed calls in a row after which the circuit opens
+        reset_timeout (float): seconds after which an open circuit lets one call through
+    """
+
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        return 'half-open' if time.monotonic() - self.opened_at >= self.reset_timeout else 'open'
+
+    def allow(self) -> bool:
+        """Whether a call may be made now. Only one trial call is let through a half-open circuit."""
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half-open' and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+            self._trial = False
+
+
+class HttpClient:
+    """Pooled HTTP client with timeouts, retries and a circuit breaker per host.
+
+    Args:
+        connect_timeout (float): seconds to wait for a connection
+        read_timeout (float): seconds to wait for data from the server
+        retries (int): retries after a failed attempt
+        backoff (float): base of the wait before a retry in seconds
+        pool_size (int): connections kept open to each host
+        breaker_threshold (int): failed calls in a row that open the circuit of a host
+        breaker_reset (float): seconds the circuit stays open
+    """
+
+    def __init__(self, connect_timeout=3.05, read_timeout=10, retries=2, backoff=0.5, pool_size=10,
+                 breaker_threshold=5, breaker_reset=30):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset = breaker_reset
+        self._session = None
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        app.config.setdefault('HTTP_CONNECT_TIMEOUT', self.connect_timeout)
+        app.config.setdefault('HTTP_READ_TIMEOUT', self.read_timeout)
+        app.config.setdefault('HTTP_RETRIES', self.retries)
+        app.config.setdefault('HTTP_BACKOFF', self.backoff)
+        app.config.setdefault('HTTP_POOL_SIZE', self.pool_size)
+        app.config.setdefault('HTTP_BREAKER_THRESHOLD', self.breaker_threshold)
+        app.config.setdefault('HTTP_BREAKER_RESET', self.breaker_reset)
+        self.connect_timeout = app.config['HTTP_CONNECT_TIMEOUT']
+        self.read_timeout = app.config['HTTP_READ_TIMEOUT']
+        self.retries = app.config['HTTP_RETRIES']
+        self.backoff = app.config['HTTP_BACKOFF']
+        self.pool_size = app.config['HTTP_POOL_SIZE']
+        self.breaker_threshold = app.config['HTTP_BREAKER_THRESHOLD']
+        self.breaker_reset = app.config['HTTP_BREAKER_RESET']
+        app.extensions['http'] = self
+
+    @property
+    def session(self) -> requests.Session:
+        """The session of the process, created on first use. Retries are done by get()."""
+        with self._lock:
+            if self._session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=10, pool_maxsize=self.pool_size, max_retries=0)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                session.headers['User-Agent'] = USER_AGENT
+                self._session = session
+            return self._session
+
+    def breaker(self, url:str) -> CircuitBreaker:
+        """Get the circuit breaker of the host of the url."""
+        host = urlsplit(url).netloc
+        with self._lock:
+            breaker = self._breakers.get(host)
+            if breaker is None:
+                breaker = self._breakers[host] = CircuitBreaker(self.breaker_threshold, self.breaker_reset)
+            return breaker
+
+    def get(self, url:str, params=None, **kwargs) -> requests.Response:
+        """Make a GET request, retrying failed attempts.
+
+        Args:
+            url (str): address of the resource
+            params: query parameters
+            kwargs: other arguments of requests.Session.get
+
+        Returns:
+            Response: the response of the last attempt, which may have a 429 or 5xx status
+
+        Raises:
+            CircuitOpenError: if the host has failed too often recently
+            requests.RequestException: if the last attempt failed without a response
+        """
+        breaker = self.breaker(url)
+        if not breaker.allow():
+            raise CircuitOpenError(f'too many failed calls to {urlsplit(url).netloc}, not calling it for now')
+        kwargs.setdefault('timeout', (self.connect_timeout, self.read_timeout))
+        for attempt in range(self.retries + 1):
+            error = None
+            try:
+                response = self.session.get(url, params=params, **kwargs)
+                if response.status_code not in RETRY_STATUSES:
+                    breaker.success()
+                    return response
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            except Exception:
+                # other errors (e.g. a broken chunked response) are not retried, but they are
+                # failed calls too, and a half-open circuit must not keep waiting for its trial
+                breaker.failure()
+                raise
+            if attempt < self.retries:
+                # full jitter: a random wait up to the exponential backoff
+                delay = random.uniform(0, self.backoff * 2 ** attempt)
+                logger.info('retrying %s in %.2f s after %s', url, delay,
+                            error or f'status {response.status_code}')
+                time.sleep(delay)
+        breaker.failure()
+        if error is not None:
+            raise error
+        return response
+
+    def get_json(self, url:str, params=None, **kwargs):
+        """Make a GET request and get the JSON content of the response.
+
+        Raises:
+            requests.RequestException: if the request failed or the response has an error status
+            ValueError: if the content is not JSON
+        """
+        response = self.get(url, params, **kwargs)
+        response.raise_for_status()
+        return response.json()
+
+    def close(self):
+        """Close the pooled connections."""
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
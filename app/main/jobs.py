@@ -0,0 +1,204 @@
+"""Background solve jobs for the nutrient optimizer.
+
+The integer programs solved on the nutrients page can take seconds, so instead of
+solving them inside the web worker they are handed to a small process pool.
+The page gets a job id right away and polls for the result.
+
+A job that hasn't started when its time limit runs out is cancelled. A job that is
+already running can't be stopped: it is reported as timed out, but it keeps its worker
+(and its place in the queue) until the solver returns, so the solver itself must be
+given the same time limit. If a worker process dies, the pool is replaced on the next
+submit.
+"""
+
+import logging
+import multiprocessing
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    """Raised when a job is submitted while the queue is already full."""
+
+
+class SolveJob:
+    """A single job in the queue.
+
+    Args:
+        job_id (str): id used to look up the job
+        future: the future of the function running in the pool
+        timeout (float): seconds the job may wait in the queue, and then run, before it is given up
+    """
+
+    def __init__(self, job_id, future, timeout):
+        self.job_id = job_id
+        self.future = future
+        self.timeout = timeout
+        self.submitted = time.monotonic()
+        self.started = None
+        self.finished = None
+        self.cancelled = False
+        self.expired = False
+        future.add_done_callback(self._finish)
+
+    def _finish(self, future):
+        self.finished = time.monotonic()
+
+    def update(self):
+        """Note the time the job started running, when it is first seen running."""
+        if self.started is None and self.future.running():
+            self.started = time.monotonic()
+
+    @property
+    def timed_out(self) -> bool:
+        """Whether the job has waited in the queue, or has been running, for longer than its time limit."""
+        if self.expired:
+            return True
+        if self.future.done():
+            return False
+        self.update()
+        since = self.submitted if self.started is None else self.started
+        return time.monotonic() - since > self.timeout
+
+    @property
+    def status(self) -> str:
+        """One of 'queued', 'running', 'done', 'failed', 'cancelled' or 'timeout'."""
+        if self.cancelled:
+            return 'cancelled'
+        if self.timed_out:
+            return 'timeout'
+        if self.future.cancelled():
+            return 'cancelled'
+        if self.future.done():
+            return 'failed' if self.future.exception() is not None else 'done'
+        return 'running' if self.future.running() else 'queued'
+
+    @property
+    def active(self) -> bool:
+        return self.status in ('queued', 'running')
+
+    def result(self):
+        """Get the return value of a finished job (None if it is not done)."""
+        if self.status != 'done':
+            return None
+        return self.future.result()
+
+
+class SolveJobQueue:
+    """A bounded queue of solve jobs run in a process pool.
+
+    Args:
+        max_workers (int): number of worker processes
+        max_pending (int): number of jobs allowed to wait for a free worker
+        timeout (float): default time limit of a job in seconds
+        keep (float): seconds to keep finished jobs around for polling
+        initializer: optional picklable function run in each worker process when it starts
+        initargs (tuple): arguments for the initializer
+    """
+
+    def __init__(self, max_workers=2, max_pending=8, timeout=80, keep=600, initializer=None, initargs=()):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.keep = keep
+        self.initializer = initializer
+        self.initargs = initargs
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def init_app(self, app):
+        """Configure the queue from the app config and register it in app.extensions."""
+        app.config.setdefault('SOLVE_WORKERS', self.max_workers)
+        app.config.setdefault('SOLVE_MAX_PENDING', self.max_pending)
+        app.config.setdefault('SOLVE_TIMEOUT', self.timeout)
+        self.max_workers = app.config['SOLVE_WORKERS']
+        self.max_pending = app.config['SOLVE_MAX_PENDING']
+        self.timeout = app.config['SOLVE_TIMEOUT']
+        app.extensions['solve_jobs'] = self
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        # the pool is created on first use so that importing the app doesn't start processes;
+        # 'spawn' avoids forking a process that may already be running threads
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                 mp_context=multiprocessing.get_context('spawn'),
+                                                 initializer=self.initializer, initargs=self.initargs)
+        return self._executor
+
+    def submit(self, fn, *args, job_timeout=None, **kwargs) -> str:
+        """Add a job to the queue.
+
+        Every job that hasn't finished counts toward the size of the queue, also one
+        that has timed out but is still running in a worker.
+
+        Args:
+            fn: picklable module-level function to run in a worker process
+            *args, **kwargs: picklable arguments for fn
+            job_timeout (float): time limit of the job, self.timeout by default
+
+        Returns:
+            str: id of the new job
+
+        Raises:
+            QueueFullError: if all workers are busy and max_pending jobs are already waiting
+        """
+        with self._lock:
+            self._prune()
+            unfinished = sum(1 for job in self._jobs.values() if not job.future.done())
+            if unfinished >= self.max_workers + self.max_pending:
+                raise QueueFullError(f'{unfinished} jobs already in the queue')
+            job_id = uuid.uuid4().hex
+            try:
+                future = self.executor.submit(fn, *args, **kwargs)
+            except BrokenProcessPool:
+                # a worker process died (e.g. out of memory), which breaks the whole pool for good
+                logger.warning('the solve worker pool is broken, starting a new one')
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+                future = self.executor.submit(fn, *args, **kwargs)
+            self._jobs[job_id] = SolveJob(job_id, future, self.timeout if job_timeout is None else job_timeout)
+        return job_id
+
+    def get(self, job_id):
+        """Get a job by its id (None if there is no such job)."""
+        with self._lock:
+            self._prune()
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id) -> bool:
+        """Cancel a job. Returns False if there is no such job or it has already finished.
+        A job that is already running is only marked cancelled; it runs to the end in its worker."""
+        job = self.get(job_id)
+        if job is None or not job.active:
+            return False
+        # a job that is already running in a worker can't be interrupted, but its result is dropped
+        job.future.cancel()
+        job.cancelled = True
+        return True
+
+    def shutdown(self):
+        """Stop the worker processes, cancelling the jobs that haven't started."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _prune(self):
+        # a job that has waited in the queue for longer than its time limit is cancelled;
+        # a running job is expected to respect the same limit in the solver itself
+        now = time.monotonic()
+        for job in self._jobs.values():
+            job.update()
+            if job.started is None and not job.future.done() and now - job.submitted > job.timeout:
+                if job.future.cancel():
+                    job.expired = True
+        # forget jobs that finished more than self.keep seconds ago
+        for job_id in [job_id for job_id, job in self._jobs.items()
+                       if job.finished is not None and now - job.finished > self.keep]:
+            del self._jobs[job_id]
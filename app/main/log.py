@@ -0,0 +1,70 @@
+"""Logging setup for the app.
+
+The modules of the app log with logging.getLogger(__name__) and pass the values to
+the logger as arguments, so that messages below the configured level are never
+formatted. The levels are set with the app config:
+
+    LOG_LEVEL = 'INFO'                             # level of the 'app' loggers
+    LOG_LEVELS = {'app.main.helpers': 'DEBUG'}     # levels of single modules
+    LOG_JSON = False                               # one JSON object per line instead of text
+"""
+
+import json
+import logging
+import sys
+
+TEXT_FORMAT = '%(asctime)s %(levelname)s %(name)s [%(process)d] %(message)s'
+
+# attributes of every log record, the other attributes come from the extra argument
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """Format log records as JSON objects with the fields given in extra={...} included."""
+
+    def format(self, record) -> str:
+        entry = {'time': self.formatTime(record), 'level': record.levelname, 'logger': record.name,
+                 'process': record.process, 'message': record.getMessage()}
+        entry.update((key, value) for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging(level='INFO', levels=None, use_json=False, logger_names=('app',)):
+    """Send the log of the app to stderr with the given levels.
+    This is also run in the solver worker processes, which don't inherit the setup.
+
+    Args:
+        level: level of the loggers in logger_names
+        levels: optional {logger name: level} for single modules
+        use_json (bool): whether to write JSON objects instead of text lines
+        logger_names: names of the top-level loggers of the app
+    """
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(JsonFormatter() if use_json else logging.Formatter(TEXT_FORMAT))
+    for name in logger_names:
+        logger = logging.getLogger(name)
+        # replace the handler of an earlier setup, e.g. when the app is created again in tests
+        for old_handler in [h for h in logger.handlers if getattr(h, '_app_handler', False)]:
+            logger.removeHandler(old_handler)
+        handler._app_handler = True
+        logger.addHandler(handler)
+        logger.setLevel(level)
+        logger.propagate = False
+    for name, module_level in (levels or {}).items():
+        logging.getLogger(name).setLevel(module_level)
+
+
+def init_app(app) -> tuple:
+    """Configure logging from the app config.
+
+    Returns:
+        tuple: the arguments of configure_logging, for setting up worker processes the same way
+    """
+    app.config.setdefault('LOG_LEVEL', 'INFO')
+    app.config.setdefault('LOG_LEVELS', {})
+    app.config.setdefault('LOG_JSON', False)
+    args = (app.config['LOG_LEVEL'], dict(app.config['LOG_LEVELS']), app.config['LOG_JSON'])
+    configure_logging(*args)
+    return args
@@ -0,0 +1,117 @@
+"""A local store of the daily prices and volumes of the CoinGecko market_chart API.
+
+The Scrooge analytics only use the first price and volume of each day, so only those are
+stored, in an SQLite file. A request for a date range fetches just the days that are not
+in the store yet, in as few API calls as there are gaps, and the rest comes from the file.
+Past days never change, so they are fetched only once; today's values are fetched again
+on every request until the day is over.
+"""
+
+import sqlite3
+import threading
+import time
+
+MARKET_CHART_URL = 'https://api.coingecko.com/api/v3/coins/{coin}/market_chart/range'
+MS_PER_DAY = 24 * 60 * 60 * 1000
+SERIES = ('prices', 'total_volumes')
+
+
+class MarketChartStore:
+    """Daily market data of coins in an SQLite file, filled from the API as needed.
+
+    Args:
+        path (str): path of the SQLite file
+    """
+
+    def __init__(self, path='coingecko.db'):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        app.config.setdefault('COINGECKO_STORE', self.path)
+        self.path = app.config['COINGECKO_STORE']
+        app.extensions['market_chart'] = self
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute('CREATE TABLE IF NOT EXISTS market_chart (coin TEXT, currency TEXT, series TEXT, '
+                     'day INTEGER, timestamp INTEGER, value REAL, '
+                     'PRIMARY KEY (coin, currency, series, day)) WITHOUT ROWID')
+        # the days that are complete in the store, also the ones the API has no data for
+        conn.execute('CREATE TABLE IF NOT EXISTS fetched_days (coin TEXT, currency TEXT, day INTEGER, '
+                     'PRIMARY KEY (coin, currency, day)) WITHOUT ROWID')
+        return conn
+
+    def market_chart_range(self, start:float, end:float, fetch, coin='bitcoin', currency='eur') -> dict:
+        """Get the first price and volume of each day from the start to the end,
+        fetching the days that are missing from the store.
+
+        Args:
+            start: unix timestamp of the start of the range in seconds
+            end: unix timestamp of the end of the range in seconds
+            fetch: function called like helpers.get_api_response(url, payload), returning
+                   the content of the response or {} if the call failed
+            coin: CoinGecko id of the coin
+            currency: currency of the prices and volumes
+
+        Returns:
+            dict: 'prices' and 'total_volumes' as lists of [timestamp in ms, value] like in
+                  the API response, or {} if fetching a missing range failed
+        """
+        first_day = int(start * 1000) // MS_PER_DAY
+        last_day = int(end * 1000) // MS_PER_DAY
+        today = int(time.time() * 1000) // MS_PER_DAY
+        conn = self._connect()
+        try:
+            fetched = {day for day, in conn.execute(
+                'SELECT day FROM fetched_days WHERE coin = ? AND currency = ? AND day BETWEEN ? AND ?',
+                (coin, currency, first_day, last_day))}
+            # the API is called without holding the lock, so that a slow call doesn't hold up
+            # the requests served from the store; concurrent requests for the same missing days
+            # may both fetch them, which the upsert of _store allows
+            for gap_start, gap_end in missing_ranges(first_day, last_day, fetched):
+                payload = {'vs_currency': currency, 'from': gap_start * MS_PER_DAY // 1000,
+                           'to': (gap_end + 1) * MS_PER_DAY // 1000 - 1}
+                content = fetch(MARKET_CHART_URL.format(coin=coin), payload)
+                if not content:
+                    return {}
+                # one writer at a time
+                with self._lock:
+                    self._store(conn, coin, currency, content, range(gap_start, min(gap_end + 1, today)))
+            return {series: [[timestamp, value] for timestamp, value in conn.execute(
+                        'SELECT timestamp, value FROM market_chart WHERE coin = ? AND currency = ? '
+                        'AND series = ? AND day BETWEEN ? AND ? ORDER BY day',
+                        (coin, currency, series, first_day, last_day))]
+                    for series in SERIES}
+        finally:
+            conn.close()
+
+    def _store(self, conn, coin, currency, content, complete_days):
+        # keep the earliest value of each day, also when the same day is fetched again
+        with conn:
+            for series in SERIES:
+                conn.executemany('INSERT INTO market_chart VALUES (?, ?, ?, ?, ?, ?) '
+                                 'ON CONFLICT (coin, currency, series, day) '
+                                 'DO UPDATE SET timestamp = excluded.timestamp, value = excluded.value '
+                                 'WHERE excluded.timestamp <= market_chart.timestamp',
+                                 ((coin, currency, series, int(timestamp) // MS_PER_DAY, int(timestamp), value)
+                                  for timestamp, value in content.get(series, [])))
+            conn.executemany('INSERT OR IGNORE INTO fetched_days VALUES (?, ?, ?)',
+                             ((coin, currency, day) for day in complete_days))
+
+
+def missing_ranges(first_day:int, last_day:int, fetched) -> list:
+    """Get the runs of consecutive days from first_day to last_day that are not in fetched.
+
+    Returns:
+        list: (first day, last day) tuples of the runs
+    """
+    ranges = []
+    for day in range(first_day, last_day + 1):
+        if day in fetched:
+            continue
+        if ranges and ranges[-1][1] == day - 1:
+            ranges[-1] = (ranges[-1][0], day)
+        else:
+            ranges.append((day, day))
+    return ranges
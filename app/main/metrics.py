@@ -0,0 +1,193 @@
+"""Request timing, stage timers and a sampling profiler for the app.
+
+When METRICS_ENABLED is set, every request is timed into a latency histogram per route,
+and the stages of the work done for it (database queries, building the nutrient tables,
+building and solving the optimization model, rendering templates and calls to external
+APIs) into a histogram per stage. They are shown in the Prometheus text format at /metrics.
+Each process keeps its own numbers, so with several web workers each scrape only sees the
+worker that answered it.
+
+With PROFILE_EVERY = N, one request in N is run under cProfile and its statistics are
+written to PROFILE_DIR, to be read with pstats or snakeviz.
+"""
+
+import cProfile
+import itertools
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from flask import Response, g, request, before_render_template, template_rendered
+
+# upper bounds of the histogram buckets in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+REQUEST_HISTOGRAM = 'http_request_duration_seconds'
+STAGE_HISTOGRAM = 'stage_duration_seconds'
+REQUEST_COUNTER = 'http_requests_total'
+
+HELP = {REQUEST_HISTOGRAM: 'Time spent answering requests, by route and method.',
+        STAGE_HISTOGRAM: 'Time spent in the stages of the work done for requests.',
+        REQUEST_COUNTER: 'Number of requests answered, by route, method and status.'}
+
+
+class Histogram:
+    """Counts of observed values in cumulative buckets, with their sum and count."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value:float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self) -> list:
+        """Get the (upper bound, number of values at most the bound) pairs, ending with +Inf."""
+        return list(zip(self.buckets, itertools.accumulate(self.counts))) + [('+Inf', self.count)]
+
+
+class Metrics:
+    """Latency histograms and request counters of an app.
+
+    Args:
+        buckets: upper bounds of the histogram buckets in seconds
+        profile_every (int): profile one request in this many (0 for no profiling)
+        profile_dir (str): directory for the profiles
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, profile_every=0, profile_dir='profiles'):
+        self.buckets = tuple(buckets)
+        self.profile_every = profile_every
+        self.profile_dir = profile_dir
+        self._histograms = defaultdict(dict)
+        self._counters = defaultdict(lambda: defaultdict(int))
+        self._lock = threading.Lock()
+        self._requests = itertools.count(1)
+        # cProfile can only profile one request at a time
+        self._profiling = threading.Lock()
+
+    def init_app(self, app):
+        """Install the timing hooks and the /metrics endpoint if METRICS_ENABLED is set."""
+        app.config.setdefault('METRICS_ENABLED', False)
+        app.config.setdefault('PROFILE_EVERY', self.profile_every)
+        app.config.setdefault('PROFILE_DIR', self.profile_dir)
+        if not app.config['METRICS_ENABLED']:
+            return
+        self.profile_every = app.config['PROFILE_EVERY']
+        self.profile_dir = app.config['PROFILE_DIR']
+        app.before_request(self._start_request)
+        app.after_request(self._count_request)
+        app.teardown_request(self._end_request)
+        before_render_template.connect(self._start_render, app)
+        template_rendered.connect(self._end_render, app)
+        app.add_url_rule('/metrics', 'metrics', self._metrics_view)
+        app.extensions['metrics'] = self
+
+    def observe(self, name:str, labels:dict, value:float):
+        """Add a value to the histogram with the given name and labels."""
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            histogram = self._histograms[name].get(key)
+            if histogram is None:
+                histogram = self._histograms[name][key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    def increment(self, name:str, labels:dict):
+        """Add one to the counter with the given name and labels."""
+        with self._lock:
+            self._counters[name][tuple(sorted(labels.items()))] += 1
+
+    def record_stage(self, stage:str, seconds:float):
+        """Add the duration of a stage, e.g. 'db_query' or 'solve'."""
+        self.observe(STAGE_HISTOGRAM, {'stage': stage}, seconds)
+
+    def record_stages(self, timings):
+        """Add the durations of stages timed elsewhere, e.g. in a solver worker process.
+
+        Args:
+            timings: {stage: seconds}, or None
+        """
+        for stage, seconds in (timings or {}).items():
+            self.record_stage(stage, seconds)
+
+    @contextmanager
+    def stage(self, stage:str):
+        """Time the code in the with block as a stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_stage(stage, time.perf_counter() - start)
+
+    def render(self) -> str:
+        """Get all the metrics in the Prometheus text format."""
+        lines = []
+        with self._lock:
+            for name, counters in sorted(self._counters.items()):
+                lines += [f'# HELP {name} {HELP.get(name, name)}', f'# TYPE {name} counter']
+                for key, value in sorted(counters.items()):
+                    lines.append(f'{name}{_labels(key)} {value}')
+            for name, histograms in sorted(self._histograms.items()):
+                lines += [f'# HELP {name} {HELP.get(name, name)}', f'# TYPE {name} histogram']
+                for key, histogram in sorted(histograms.items()):
+                    for bound, count in histogram.cumulative_counts():
+                        lines.append(f'{name}_bucket{_labels(key + (("le", bound),))} {count}')
+                    lines.append(f'{name}_sum{_labels(key)} {histogram.sum}')
+                    lines.append(f'{name}_count{_labels(key)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    def _metrics_view(self):
+        return Response(self.render(), mimetype='text/plain; version=0.0.4')
+
+    def _start_request(self):
+        g.metrics_start = time.perf_counter()
+        if not self.profile_every:
+            return
+        number = next(self._requests)
+        if number % self.profile_every == 0 and self._profiling.acquire(blocking=False):
+            g.profile_number = number
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+
+    def _count_request(self, response):
+        self.increment(REQUEST_COUNTER, {'endpoint': request.endpoint or 'unknown', 'method': request.method,
+                                         'status': str(response.status_code)})
+        return response
+
+    def _end_request(self, exception=None):
+        start = g.pop('metrics_start', None)
+        if start is not None:
+            self.observe(REQUEST_HISTOGRAM, {'endpoint': request.endpoint or 'unknown', 'method': request.method},
+                         time.perf_counter() - start)
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            profiler.disable()
+            self._profiling.release()
+            os.makedirs(self.profile_dir, exist_ok=True)
+            name = f"{request.endpoint or 'unknown'}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{g.pop('profile_number')}.prof"
+            profiler.dump_stats(os.path.join(self.profile_dir, name))
+
+    def _start_render(self, app, template, context, **extra):
+        g.setdefault('render_starts', []).append(time.perf_counter())
+
+    def _end_render(self, app, template, context, **extra):
+        starts = g.get('render_starts')
+        if starts:
+            self.record_stage('render', time.perf_counter() - starts.pop())
+
+
+def _labels(key) -> str:
+    # label values are quoted, with backslashes, quotes and newlines escaped
+    if not key:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in key)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(key, escaped)) + '}'
@@ -0,0 +1,94 @@
+"""Print the query plans of the queries the app runs on the Fineli database.
+
+Run from the repository root, after creating the database with db_creation.sql:
+
+    python -m app.main.query_plans [fineli.db]
+
+Every query on the food and component_value tables should search an index. The script
+exits with status 1 if any of them scans a whole table, e.g. when the indexes of
+db_creation.sql are missing from the database.
+"""
+
+import re
+import sqlite3
+import sys
+
+from app.main.db import FIND_FOOD_ID, FOOD_NAMES, FOOD_NAMES_BY_ID
+from app.main.helpers import nutrition_values_query
+from app.main.search import FtsFoodSearch
+
+# the index number and the constraint string the virtual table chose for a plan step
+VIRTUAL_TABLE_INDEX = re.compile(r"VIRTUAL TABLE INDEX (\d+):(.*)$")
+
+# any nutrients will do, the plan doesn't depend on which ones are asked for
+SAMPLE_NUTRIENTS = ("fat", "prot", "vitc", "ca", "fe")
+
+
+def production_queries() -> list:
+    """Get the queries of the app with typical parameters.
+
+    Returns:
+        list: (description, statement, parameters) tuples
+    """
+    return [
+        ("food lookup", FIND_FOOD_ID, ("omena",)),
+        ("food names of the in-memory search", FOOD_NAMES.format(table="food"), ()),
+        ("food names of solutions", FOOD_NAMES_BY_ID.format(placeholders="?, ?, ?"), (1, 2, 3)),
+        ("optimizer nutrition values", *nutrition_values_query(SAMPLE_NUTRIENTS)),
+        ("autocomplete", FtsFoodSearch.SEARCH, {"phrase": '"omena"', "query": "omena", "limit": 20}),
+        ("autocomplete, short query", FtsFoodSearch.SEARCH_SHORT, {"prefix": "om", "limit": 20}),
+        ("autocomplete food lookup", FtsFoodSearch.FIND, ('"omena"', "omena")),
+    ]
+
+
+def query_plan(conn, stmt, params) -> list:
+    """Get the steps of the query plan of a statement.
+
+    Args:
+        conn: database connection
+        stmt (str): SQL statement
+        params: parameters of the statement
+
+    Returns:
+        list: the details of the plan steps, e.g. 'SEARCH food USING INTEGER PRIMARY KEY (rowid=?)'
+    """
+    return [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + stmt, params)]
+
+
+def is_full_scan(step:str) -> bool:
+    """Check whether a plan step reads a whole table instead of searching an index.
+    Scans of covering indexes are not counted, and neither are scans of virtual tables
+    (the FTS5 index) with a constraint, e.g. 'VIRTUAL TABLE INDEX 0:M3' for a MATCH.
+    A virtual table scan without one, 'VIRTUAL TABLE INDEX 0:', reads the whole table."""
+    if not step.startswith("SCAN ") or " USING " in step:
+        return False
+    virtual = VIRTUAL_TABLE_INDEX.search(step)
+    if virtual is not None:
+        return virtual.group(1) == "0" and not virtual.group(2).strip()
+    return True
+
+
+def main(path="fineli.db") -> int:
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    scans = 0
+    for description, stmt, params in production_queries():
+        print(f"{description}:")
+        try:
+            plan = query_plan(conn, stmt, params)
+        except sqlite3.OperationalError as error:
+            print(f"    skipped: {error}")
+            continue
+        for step in plan:
+            if is_full_scan(step):
+                scans += 1
+                print(f"    {step}    <-- full table scan")
+            else:
+                print(f"    {step}")
+    conn.close()
+    if scans:
+        print(f"{scans} full table scans, are the indexes of db_creation.sql missing?")
+    return 1 if scans else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(*sys.argv[1:2]))
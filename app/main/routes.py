@@ -1,14 +1,15 @@
 from datetime import datetime, date, timezone
+import logging
 import re
 from io import BytesIO
 import random
-import sqlite3
 
-from flask import render_template, make_response, request, redirect, flash, url_for, jsonify
-import xml.etree.ElementTree as ET
-import json
+from flask import render_template, make_response, request, redirect, flash, url_for, jsonify, current_app, \
+    Response, stream_with_context
+from concurrent import futures
+from functools import partial
 from finna_client import *
-import wikipedia
+import requests
 from matplotlib.figure import Figure
 import numpy as np
 import base64
@@ -16,9 +17,15 @@ import pandas as pd
 import pulp
 
 from app.main import bp
-from app.main.forms import FinnaForm, PlottingForm, NutrientForm, ScroogeForm
+from app.main.finna_records import iter_books
+from app.main.forms import FinnaForm, PlottingForm, NutrientForm, ScroogeForm, MAX_EATEN_FOODS
+from app.main.jobs import QueueFullError
+from app.main.search import create_food_search
+from app.main.wikipedia_pages import WikipediaPage
 import app.main.helpers as helpers
+import app.main.timeseries as timeseries
 
+logger = logging.getLogger(__name__)
 
 # define routes
 @bp.route('/')
@@ -35,20 +42,15 @@ def other_page(page_name):
 
 @bp.route('/wikipedia_page')
 def wikipedia_page():
-    topics = ['Helsinki', 'Kuopio', 'Turku', 'Maakunta-_ja_soteuudistus',
-    'Tiikeri', 'Sademetsäkäpinkäinen', 'Lineaarinen_regressioanalyysi',
-    'Derivaatta', 'Urho_Kekkosen_kansallispuisto', 'Laama', 
-    'Septimus_Heap']
-    topic = topics[random.randint(0, len(topics)-1)]
-
-    heading = topic.replace('_', ' ')
-    wikipedia.set_lang('fi')
-    page = wikipedia.page(topic)
-
-    summary = wikipedia.summary(topic)
-    images = page.images
-    #print(images)
-    image = images[random.randint(0, len(images)-1)]
+    # the pages are loaded in the background, so no request to Wikipedia is made here
+    pages = current_app.extensions['wikipedia_pages']
+    page = pages.random_page()
+    if page is None:
+        flash('Wikipediaan ei juuri nyt saatu yhteyttä. Yritä hetken kuluttua uudelleen.')
+        topic = random.choice(pages.topics)
+        page = WikipediaPage(topic, topic.replace('_', ' '), '', [])
+    topic, heading, summary, images = page
+    image = random.choice(images) if images else None
     
     return render_template('wikipedia.html', title='Wikipedia',
     topic=topic, heading=heading, summary=summary, image=image)
@@ -58,87 +60,80 @@ def wikipedia_page():
 def finna():
     if request.method == 'GET':
         form = FinnaForm()
-        finna = FinnaClient()
 
         return render_template('finna.html', title='Finna-haku',
                                form=form)
     elif request.method == 'POST':
         form = FinnaForm()
-        finna = FinnaClient()
         
         if form.validate_on_submit():
             # send query to Finna based on the selected field
-            if form.target.data == 'author':
-                result = finna.search(form.search_term.data,
-                              search_type=FinnaSearchType.Author,
-                              fields=['fullRecord'],
-                              filters=['format:0/Book/'], 
-                              limit=50)
-                #print(f'result: {result}')
-            else:
-                result = finna.search(form.search_term.data,
-                              search_type=FinnaSearchType.Title,
-                              fields=['fullRecord'],
-                              filters=['format:0/Book/'], 
-                              limit=50)
-            if result['resultCount'] == 0:
+            search_type = FinnaSearchType.Author if form.target.data == 'author' else FinnaSearchType.Title
+            finna_cache = current_app.extensions['finna_cache']
+            cache_key = finna_cache_key(form.target.data, form.search_term.data, form.language.data)
+            cached = finna_cache.get(cache_key)
+            if cached is not None:
+                logger.info('Finna search %r from the cache, saved %.3f s of fetching and %.3f s of parsing',
+                            cache_key, cached['timings'].get('fetch', 0.0), cached['timings'].get('parse', 0.0))
+                return render_template('finna.html', title='Finna-haku',
+                                       form=form, results=cached, records=cached['books'])
+
+            search_page = partial(helpers.finna_search, current_app.extensions['http'],
+                                  form.search_term.data, search_type.value,
+                                  fields=['fullRecord'], filters=['format:0/Book/'])
+            try:
+                # the first page now, the rest concurrently while the first rows are sent
+                results = current_app.extensions['finna_search'].search(search_page)
+            except (requests.RequestException, ValueError):
+                logger.warning('Finna search failed', exc_info=True)
+                flash('Finnaan ei juuri nyt saatu yhteyttä. Yritä hetken kuluttua uudelleen.')
+                return redirect(url_for('main.finna'))
+            if results.count == 0:
                 flash('Mitään ei löytynyt. Yritä uudelleen.')
-                return redirect(url_for('finna'))
+                return redirect(url_for('main.finna'))
             
-            # save the data for individual books in a set to remove duplicates
-            records_set = set()
-            #print(result)
-
-            # parse book data
-            for rec in result['records']:
-                #print('rec = ', rec)
-                tree = ET.fromstring(rec['fullRecord'])
-                record = {}
-                
-                for datafield in tree.iter('{http://www.loc.gov/MARC21/slim}datafield'):
-                    #print('datafield.attrib =', datafield.attrib)
-                    if datafield.attrib['tag'] == '041':
-                        lang = datafield[0].text
-                        #print(f'lang = {lang}')
-                        record['lang'] = lang
-                        if len(datafield) > 1:
-                            source_lang = datafield[1].text
-                            #print('source lang=', source_lang)
-                            record['source_lang'] = source_lang
-                    elif datafield.attrib['tag'] == '100':
-                        #print('author=', datafield[0].text)
-                        #author_spl = datafield[0].text.rstrip('.').rstrip(',').split(', ')
-                        #author = author_spl[1] + ' ' + author_spl[0]
-                        #print('author =', author)
-                        #record['author'] = author
-                        author = datafield[0].text.rstrip('.,')
-                        record['author'] = author
-                    elif datafield.attrib['tag'] == '245':
-                        #print(datafield[0].text)
-                        title = datafield[0].text.rstrip(' /:.')
-                        #print('title =', title)
-                        record['title'] = title
-                
-                # check the language before adding the book in the set
-                # not all books have a language code, drop those
-                try:
-                    if record['lang'] == form.language.data or form.language.data == 'all':
-                        json_record = json.dumps(record)
-                        #print(json_record)
-                        records_set.add(json_record)
-                except KeyError:
-                    pass
+            # parse the language, author and title of the books as the pages arrive, leaving out duplicates
+            books = iter_books(results.records(), form.language.data, results.timings)
+            records = cache_books(finna_cache, cache_key, results, books)
 
-                
-            records = [json.loads(x) for x in records_set]
-            #print(f'records: {records}')
-            
-            return render_template('finna.html', title='Finna-haku',
-                               form=form, result=result, records=records)
+            response = Response(stream_with_context(stream_template('finna.html', title='Finna-haku',
+                                form=form, results=results, records=records)))
+            # let proxies pass the rows on as they come
+            response.headers['X-Accel-Buffering'] = 'no'
+            return response
         
         return render_template('finna.html', title='Finna-haku', form=form)
 
 
+def finna_cache_key(target, search_term, language):
+    """Get the Finna cache key of a search: the search terms are compared
+    case-insensitively and with the whitespace collapsed."""
+    return (target, ' '.join(search_term.split()).casefold(), language)
+
+
+def cache_books(finna_cache, cache_key, results, books):
+    """Give out the books as they are parsed, and store them in the Finna cache with the
+    fetch and parse timings of the search once all the pages have been read."""
+    found = []
+    for book in books:
+        found.append(book)
+        yield book
+    if results.incomplete:
+        return
+    timings = dict(results.timings)
+    finna_cache.set(cache_key, {'count': results.count, 'books': found, 'timings': timings})
+    metrics = current_app.extensions.get('metrics')
+    if metrics is not None:
+        metrics.record_stages({'finna_' + stage: seconds for stage, seconds in timings.items()})
+
+
+def stream_template(template_name, **context):
+    """Render a template piece by piece, like flask.stream_template of newer Flask versions."""
+    current_app.update_template_context(context)
+    template = current_app.jinja_env.get_template(template_name)
+    return template.generate(context)
+
+
 @bp.route('/plotting', methods=['GET', 'POST'])
 def plotting():
     if request.method == 'GET':
@@ -147,10 +142,9 @@ def plotting():
                                form=form)
     elif request.method == 'POST':
         form = PlottingForm()
-        print('POST')
 
         if form.validate_on_submit():
-            print('form validated')            
+            logger.debug('plotting form validated')
 
             # get the coefficients
             if form.const.data:
@@ -192,7 +186,7 @@ def plotting():
                     else:
                         otsikko = otsikko[:-2] + "- " + str(coeff).lstrip('-') + nome + " + "
             otsikko = f"y = {otsikko.rstrip(' +*')} x:n arvoilla {x_start} ≤ x ≤ {x_end}".replace('.', ',')
-            print('otsikko: ', otsikko)
+            logger.debug('otsikko: %s', otsikko)
 
             # create the data to plot
             x = np.linspace(x_start, x_end, 100)
@@ -234,95 +228,373 @@ def nutrients():
     elif request.method == 'POST':
         form = NutrientForm()
         if form.validate_on_submit():
-            print('form validated')
-            rda = helpers.get_rda("nkeski") # TODO: add a check for user-provided sex & age
-            print(rda.head())
-            nutrient_tuple = tuple(rda["EUFDNAME"])
-            print(f"nutrient_tuple: {nutrient_tuple}")
+            logger.debug('nutrient form validated')
+            age = "nkeski" # TODO: add a check for user-provided sex & age
+            rda_table = helpers.get_rda_table()
+            nutrient_tuple = rda_table.nutrients
+            logger.debug("nutrient_tuple: %s", nutrient_tuple)
             
             # get data from the db
-            with sqlite3.connect('fineli.db') as conn:
-                # the next line prints the full sql query if uncommented
-                #conn.set_trace_callback(print)
-                curs = conn.cursor()
-                try:
-                    # get the food id using sqlite3 cursor
-                    stmt = "SELECT foodid FROM food WHERE foodname = ?"
-                    args = (form.food.data,)
-                    curs.execute(stmt, args)
-                    food = curs.fetchone()
-                    if food:
-                        food_id = food[0]
-                        amount = form.amount.data
-                        # get the nutrient content of the given food using pandas
-                        stmt2 = "SELECT eufdname, bestloc / 100.0 * ? AS eaten_total FROM component_value WHERE foodid = ?"
-                        args2 = (amount, food_id)
-                        eaten_df = pd.read_sql(stmt2, conn, params=args2)
-                        print(eaten_df.head())
-                        # get the remaining portion of rda to be covered by other foods
-                        remainder_df = pd.merge(rda, eaten_df, on='EUFDNAME')
-                        # set EUFDNAME as the new index
-                        remainder_df.set_index("EUFDNAME", inplace=True)
-                        print(f"remainder_df after set_index: {remainder_df.head()}")
-                        # sort by the EUFDNAME column/index to make sure nutrients are in the same order as in the comp_values df
-                        remainder_df = remainder_df.sort_values(by=["EUFDNAME"])
-                        # add a new column with the difference of nutrient target and the nutrients eaten
-                        remainder_df["remainder"] = remainder_df["target"] - remainder_df["eaten_total"]
-                        print(f"remainder_df.head: {remainder_df.head()}")
-                        # get the nutrition values of foods from the database
-                        comp_values = helpers.get_nutrition_values_of_foods(conn, nutrient_tuple)
-                        optimum = helpers.solve_for_optimal_foods(remainder_df, comp_values)
-                        # TODO: create a nice table of the result to be displayed on the webpage
-                        variables = {v.name: [v.name[1:], v.varValue] for v in optimum.variables() if v.varValue > 0.0}
-                        var_table = pd.DataFrame.from_dict(variables, orient='index', columns=['Ruuan id', 'Määrä (grammaa)'])
-                        
-                    else:
-                        flash('Valitse ruoka listasta.')
+            database = current_app.extensions['fineli_db']
+            try:
+                # get the food ids from the food name search index
+                eaten = []
+                entered = []
+                # similar amounts are rounded to the same amount to share cached results
+                amount_step = current_app.config.get('RESULT_CACHE_AMOUNT_STEP', 10)
+                for row in form.eaten_rows():
+                    food_id = food_search().find_food_id(row.food.data)
+                    if food_id is None:
+                        flash(f'Valitse ruoka listasta: {row.food.data}')
                         return render_template('nutrients.html', title='Ravintoaineet',
-                               form=form)
-                    
-                    
-                except Exception as e:
-                    print(e)
-                finally:
-                    if curs:
-                        curs.close()
+                                               form=form)
+                    amount = helpers.quantize_amount(row.amount.data, amount_step)
+                    eaten.append((food_id, amount))
+                    entered.append((row.food.data, amount))
+                eaten = combine_eaten(eaten)
+                # get the remaining portion of rda to be covered by other foods,
+                # with the nutrients in the same order as in the comp_values df
+                remainder_df = eaten_remainder(database, rda_table, age, eaten)
+                logger.debug("remainder_df: %s", remainder_df)
+                # use a cached result if the same case has been solved before,
+                # otherwise solve the optimal foods in the background and let the page poll for the result
+                result_cache = current_app.extensions['result_cache']
+                cache_key = eaten_cache_key(eaten, age)
+                result = result_cache.get(cache_key)
+                job_id = None
+                if result is None:
+                    mode = current_app.config.get('SOLVE_MODE', 'milp')
+                    initial = None
+                    if mode == 'warm' and len(eaten) == 1:
+                        initial = nearby_solution(result_cache, eaten[0][0], eaten[0][1], age, amount_step)
+                    jobs = current_app.extensions['solve_jobs']
+                    job_id = jobs.submit(helpers.solve_remainder, database.path, remainder_df,
+                                         nutrient_tuple, current_app.config['SOLVE_TIMEOUT'],
+                                         mode, current_app.config.get('SOLVE_GAP'), initial,
+                                         current_app.config.get('PRUNE_DOMINATED', False),
+                                         database.snapshot)
+                    jobs.get(job_id).future.add_done_callback(
+                        lambda future: cache_solve_result(result_cache, cache_key, future))
+                    metrics = current_app.extensions.get('metrics')
+                    if metrics is not None:
+                        jobs.get(job_id).future.add_done_callback(
+                            lambda future: record_solve_timings(metrics, future))
+                
+            except QueueFullError:
+                flash('Palvelu on juuri nyt ruuhkautunut. Yritä hetken kuluttua uudelleen.')
+                return render_template('nutrients.html', title='Ravintoaineet',
+                                       form=form), 503
+            except Exception:
+                logger.exception('nutrient optimization failed')
+                flash('Laskenta epäonnistui. Yritä hetken kuluttua uudelleen.')
+                return render_template('nutrients.html', title='Ravintoaineet',
+                                       form=form), 500
             
-            pd_tables = [remainder_df[['name', 'target', 'eaten_total', 'remainder', 'max']],
-                         var_table]
-            html_tables = [t.to_html(classes='data', header = True, index = False) for t in pd_tables]
+            remainder_table = remainder_df[['name', 'target', 'eaten_total', 'remainder', 'max']]
+            html_tables = [remainder_table.to_html(classes='data', header = True, index = False)]
+            if result is not None:
+                html_tables.append(solution_table(result).to_html(classes='data', header = True, index = False))
             return render_template('nutrients.html', title='Ravintoaineet',
-                                   form=form, data_given=(food_id, amount, form.food.data),
-                                   tables=html_tables)
+                                   form=form, data_given=entered,
+                                   tables=html_tables, job_id=job_id)
         
         flash('Tarkista syöttämäsi arvot.')
         return render_template('nutrients.html', title='Ravintoaineet',
                                form=form)
 
+
+def combine_eaten(eaten) -> list:
+    """Add up the amounts of a food entered more than once.
+
+    Args:
+        eaten: list of (food id, grams) pairs
+
+    Returns:
+        list: (food id, grams) pairs with one pair per food, in the order of first appearance
+    """
+    amounts = {}
+    for food_id, amount in eaten:
+        amounts[food_id] = amounts.get(food_id, 0) + amount
+    return list(amounts.items())
+
+
+def eaten_remainder(database, rda_table, age, eaten):
+    """Get the remaining RDA values after the eaten foods, given as (food id, grams) pairs.
+    The eaten nutrients are a single product of the amounts and the cached nutrient
+    matrix of all foods, so there are no queries per food."""
+    matrix = helpers.get_nutrient_matrix(database.connection(), rda_table.nutrients, omitted=(),
+                                         snapshot=database.snapshot)
+    totals = helpers.get_eaten_totals(matrix, [food_id for food_id, _ in eaten], [amount for _, amount in eaten])
+    return helpers.get_remainder(rda_table, age, matrix.nutrients, totals)
+
+
+def eaten_cache_key(eaten, age):
+    """Get the result cache key of the eaten foods: (food id, grams, age) for a single food,
+    as used by nearby_solution, and (sorted (food id, grams) pairs, age) for several foods."""
+    if len(eaten) == 1:
+        return (eaten[0][0], eaten[0][1], age)
+    return (tuple(sorted(eaten)), age)
+
+
+@bp.route('/nutrients/jobs/<job_id>', methods=['GET', 'DELETE'])
+def nutrient_job(job_id):
+    """Report the status of a solve job, with the result table once it is done,
+    or cancel the job with a DELETE request. The result of a job of a batch request
+    is a list of the results of its scenarios, formatted like in the batch response."""
+    jobs = current_app.extensions['solve_jobs']
+    if request.method == 'DELETE':
+        if jobs.cancel(job_id):
+            return jsonify(job_id=job_id, status='cancelled')
+        return jsonify(job_id=job_id, error='Tehtävää ei löydy tai se on jo päättynyt.'), 404
+
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify(job_id=job_id, error='Tehtävää ei löydy.'), 404
+    result = job.result()
+    if result is None:
+        return jsonify(job_id=job_id, status=job.status)
+    if isinstance(result, list):
+        database = current_app.extensions['fineli_db']
+        names = database.food_names_by_id(food_id for scenario in result for food_id, _ in scenario['foods'])
+        return jsonify(job_id=job_id, status=job.status, results=[batch_result(scenario, names)
+                                                                  for scenario in result])
+
+    return jsonify(job_id=job_id, status=job.status, solver_status=result['status'],
+                   energy=result['energy'], foods=result['foods'],
+                   mode=result['mode'], gap=result['gap'], removed=result['removed'],
+                   table=solution_table(result).to_html(classes='data', header = True, index = False))
+
+
+def solution_table(result):
+    """Create a table of the suggested foods from the result of a solve job."""
+    return pd.DataFrame(result['foods'], columns=['Ruuan id', 'Määrä (grammaa)'])
+
+
+def cache_solve_result(result_cache, cache_key, future):
+    """Store the result of a finished solve job in the result cache.
+    Results of cancelled, failed or unfinished (timed out) solves are not cached, and neither
+    are solves stopped at the time limit or the approximate results of the LP relaxation."""
+    if future.cancelled() or future.exception() is not None:
+        return
+    cache_result(result_cache, cache_key, future.result())
+
+
+def cache_result(result_cache, cache_key, result):
+    """Store a solve result in the result cache if it is exact (see helpers.is_exact_result)."""
+    if helpers.is_exact_result(result):
+        # the timings are only for the metrics of the solve that produced the result
+        result_cache.set(cache_key, {key: value for key, value in result.items() if key != 'timings'})
+
+
+def cache_batch_results(result_cache, cache_keys, future):
+    """Store the results of a finished batch solve job in the result cache, like cache_solve_result."""
+    if future.cancelled() or future.exception() is not None:
+        return
+    for cache_key, result in zip(cache_keys, future.result()):
+        cache_result(result_cache, cache_key, result)
+
+
+def record_batch_timings(metrics, future):
+    """Add the stage timings of the scenarios of a finished batch solve job to the metrics."""
+    if future.cancelled() or future.exception() is not None:
+        return
+    for result in future.result():
+        metrics.record_stages(result.get('timings'))
+
+
+def record_solve_timings(metrics, future):
+    """Add the stage timings measured in the worker process of a finished solve job to the metrics."""
+    if future.cancelled() or future.exception() is not None:
+        return
+    metrics.record_stages(future.result().get('timings'))
+
+
+def nearby_solution(result_cache, food_id, amount, age, step, distance=5):
+    """Find a cached solution for the same food and demographic with an amount at most
+    distance steps away, to be used as the starting point of a warm-started solve.
+
+    Returns:
+        dict: {food id: grams} of the nearest cached solution, or None if there is none
+    """
+    for i in range(1, distance + 1):
+        for nearby_amount in (amount - i * step, amount + i * step):
+            result = result_cache.get((food_id, nearby_amount, age), count=False)
+            if result is not None and result['foods']:
+                return {food: grams for food, grams in result['foods']}
+    return None
+
+@bp.route('/nutrients/batch', methods=['POST'])
+def nutrients_batch():
+    """Solve the optimal foods for many scenarios in one request.
+
+    The request is a JSON object with a list of scenarios, each with the eaten food or foods
+    (by name or id, with the amounts in grams) and the sex + age group, e.g.
+    {"scenarios": [{"food": "omena", "amount": 150, "age": "nkeski"},
+                   {"foods": [{"food_id": 1, "amount": 20}, {"food": "omena", "amount": 100}]}]}
+    The scenarios are split among the solve workers, and each worker loads the nutrient
+    values and builds the model once, changing only the nutrient bounds between the scenarios.
+    The response has a result for each scenario in the same order: the suggested foods and
+    amounts, or an error.
+
+    The request waits at most BATCH_WAIT seconds for the solves, so that it doesn't hold
+    a web worker. The result of a scenario still being solved after that is the id of
+    its job and the index of the scenario in the job, e.g. {"job_id": "...", "index": 0,
+    "status": "running"}; /nutrients/jobs/<job_id> then gives the results of the job.
+    """
+    data = request.get_json(silent=True)
+    scenarios = data.get('scenarios') if isinstance(data, dict) else None
+    if not isinstance(scenarios, list) or not scenarios:
+        return jsonify(error='Anna lista skenaarioita (scenarios).'), 400
+    max_scenarios = current_app.config.get('BATCH_MAX_SCENARIOS', 200)
+    if len(scenarios) > max_scenarios:
+        return jsonify(error=f'Enintään {max_scenarios} skenaariota kerralla.'), 413
+
+    rda_table = helpers.get_rda_table()
+    database = current_app.extensions['fineli_db']
+    result_cache = current_app.extensions['result_cache']
+    results = [None] * len(scenarios)
+    # similar amounts are rounded like on the nutrients page, so that the results are the same
+    amount_step = current_app.config.get('RESULT_CACHE_AMOUNT_STEP', 10)
+    parsed = {}
+    for i, scenario in enumerate(scenarios):
+        try:
+            parsed[i] = parse_scenario(scenario, rda_table, amount_step)
+        except ValueError as e:
+            results[i] = {'error': str(e)}
+    known = database.food_names_by_id(food_id for eaten, _ in parsed.values() for food_id, _ in eaten)
+    # the remainders and cache keys of the scenarios that have to be solved, by scenario number
+    pending = {}
+    for i, (eaten, age) in parsed.items():
+        unknown = [food_id for food_id, _ in eaten if food_id not in known]
+        if unknown:
+            results[i] = {'error': f'Ruokaa ei löydy: {unknown[0]}'}
+            continue
+        eaten = combine_eaten(eaten)
+        remainder_df = eaten_remainder(database, rda_table, age, eaten)
+        # the results are shared with the nutrients page
+        cache_key = eaten_cache_key(eaten, age)
+        result = result_cache.get(cache_key)
+        if result is not None:
+            results[i] = result
+        else:
+            pending[i] = (remainder_df, cache_key)
+
+    jobs = current_app.extensions['solve_jobs']
+    mode = current_app.config.get('SOLVE_MODE', 'milp')
+    indices = list(pending)
+    # consecutive scenarios go to the same worker, so that warm starts come from similar scenarios
+    chunks = [chunk.tolist() for chunk in np.array_split(indices, min(jobs.max_workers, len(indices)))
+              if len(chunk)] if indices else []
+    metrics = current_app.extensions.get('metrics')
+    submitted = []
+    try:
+        for chunk in chunks:
+            job_id = jobs.submit(helpers.solve_batch, database.path, [pending[i][0] for i in chunk],
+                                 rda_table.nutrients, current_app.config.get('BATCH_TIME_LIMIT', 10),
+                                 mode, current_app.config.get('SOLVE_GAP'),
+                                 current_app.config.get('PRUNE_DOMINATED', False), database.snapshot,
+                                 job_timeout=current_app.config.get('BATCH_TIMEOUT', 300))
+            submitted.append((chunk, job_id))
+    except QueueFullError:
+        for _, job_id in submitted:
+            jobs.cancel(job_id)
+        return jsonify(error='Palvelu on juuri nyt ruuhkautunut. Yritä hetken kuluttua uudelleen.'), 503
+    # the results are cached when the jobs finish, also after this request has returned
+    for chunk, job_id in submitted:
+        future = jobs.get(job_id).future
+        cache_keys = [pending[i][1] for i in chunk]
+        future.add_done_callback(lambda future, cache_keys=cache_keys:
+                                 cache_batch_results(result_cache, cache_keys, future))
+        if metrics is not None:
+            future.add_done_callback(lambda future: record_batch_timings(metrics, future))
+
+    futures.wait([jobs.get(job_id).future for _, job_id in submitted],
+                 timeout=current_app.config.get('BATCH_WAIT', 10))
+    for chunk, job_id in submitted:
+        job = jobs.get(job_id)
+        if job.active:
+            for index, i in enumerate(chunk):
+                results[i] = {'job_id': job_id, 'index': index, 'status': job.status}
+        elif job.status == 'done':
+            for i, result in zip(chunk, job.result()):
+                results[i] = result
+        elif job.status == 'failed':
+            logger.error('batch solve failed', exc_info=job.future.exception())
+            for i in chunk:
+                results[i] = {'error': 'Laskenta epäonnistui.'}
+        else:
+            for i in chunk:
+                results[i] = {'error': 'Aikaraja ylittyi.'}
+
+    names = database.food_names_by_id(food_id for result in results if 'foods' in result
+                                      for food_id, _ in result['foods'])
+    return jsonify(results=[batch_result(result, names) for result in results])
+
+
+def parse_scenario(scenario, rda_table, amount_step=None):
+    """Check a scenario of a batch request and look up its foods. The amounts are
+    rounded to multiples of amount_step like on the nutrients page, and there can be
+    at most MAX_EATEN_FOODS foods like on the form. Food ids are not checked here.
+
+    Returns:
+        tuple: a list of (food id, grams) of the eaten foods and the sex + age group
+
+    Raises:
+        ValueError: if the scenario is not valid, with a message for the user
+    """
+    if not isinstance(scenario, dict):
+        raise ValueError('Skenaarion pitää olla olio.')
+    age = scenario.get('age', 'nkeski')
+    if age not in rda_table.targets:
+        raise ValueError(f'Tuntematon ryhmä: {age}')
+    foods = scenario.get('foods', [scenario] if 'food' in scenario or 'food_id' in scenario else [])
+    if not isinstance(foods, list) or not foods:
+        raise ValueError('Skenaariosta puuttuu syöty ruoka.')
+    if len(foods) > MAX_EATEN_FOODS:
+        raise ValueError(f'Enintään {MAX_EATEN_FOODS} ruokaa skenaariossa.')
+    eaten = []
+    for food in foods:
+        if not isinstance(food, dict):
+            raise ValueError('Ruuan pitää olla olio.')
+        food_id = food.get('food_id')
+        if food_id is None:
+            food_id = food_search().find_food_id(str(food.get('food', '')))
+        amount = food.get('amount')
+        if not isinstance(food_id, int) or isinstance(food_id, bool):
+            raise ValueError(f"Ruokaa ei löydy: {food.get('food', food_id)}")
+        if not isinstance(amount, (int, float)) or isinstance(amount, bool) or amount <= 0:
+            raise ValueError(f'Virheellinen määrä: {amount}')
+        eaten.append((food_id, helpers.quantize_amount(amount, amount_step)))
+    return eaten, age
+
+
+def batch_result(result, names):
+    """Format the result of a scenario of a batch request for the response."""
+    if 'error' in result or 'job_id' in result:
+        return result
+    return {'status': result['status'], 'energy': result['energy'], 'mode': result['mode'],
+            'gap': result['gap'],
+            'foods': [{'food_id': food_id, 'name': names.get(food_id), 'amount': amount}
+                      for food_id, amount in result['foods']]}
+
+
 @bp.route('/autocomplete_food', methods=['GET'])
 def autocomplete_food():
-    search = request.args.get('q')
-    arg = "%" + str(search) + "%"  # note: no manually added quotes around the argument
-    print("arg:", arg)
-    with sqlite3.connect('fineli.db') as conn:
-        # the next line prints the full sql query if uncommented
-        #conn.set_trace_callback(print)
-        curs = conn.cursor()
-        try:
-            stmt = "SELECT foodname FROM food WHERE foodname LIKE ?"
-            args = (arg,)
-            print(stmt)
-            #return [(x[0], x[1]) for x in curs.execute(stmt)]
-            curs.execute(stmt, args)
-            #foods = curs.fetchall()
-            results = [food[0] for food in curs.fetchall()]
-            #print(results)
-            return jsonify(matching_results=results)
-        except Exception as e:
-            print(e)
-        finally:
-            if curs:
-                curs.close()
+    search = request.args.get('q', '')
+    return jsonify(matching_results=food_search().search(search))
+
+
+def food_search():
+    """Get the food name search of the app, creating it now if the database
+    wasn't available when the app was started."""
+    search = current_app.extensions.get('food_search')
+    if search is None:
+        search = create_food_search(current_app.extensions['fineli_db'],
+                                    current_app.config['AUTOCOMPLETE_BACKEND'],
+                                    current_app.config['AUTOCOMPLETE_TABLES'],
+                                    current_app.config['AUTOCOMPLETE_LIMIT'])
+        current_app.extensions['food_search'] = search
+    return search
 
 
 @bp.route('/scrooge', methods=['GET', 'POST'])
@@ -340,17 +612,17 @@ def scrooge():
             # and then into unix timestamps
             start_timestamp = datetime(start.year, start.month, start.day,
                                        tzinfo=timezone.utc).timestamp()
-            print(f'start: {start_timestamp}')
+            logger.debug('start: %s', start_timestamp)
             end_timestamp = datetime(end.year, end.month, end.day, 1,
                                      tzinfo=timezone.utc).timestamp()
-            print(f'end: {end_timestamp}')
-            params = {'vs_currency': 'eur', 'from': start_timestamp, 'to': end_timestamp}
-            # call a helper function that gets the data from the API
-            data = helpers.get_api_response('https://api.coingecko.com/api/v3/coins/bitcoin/market_chart/range',
-                                    params)
+            logger.debug('end: %s', end_timestamp)
+            # get the data from the local store, which calls the API for the days it doesn't have yet
+            store = current_app.extensions['market_chart']
+            fetch = partial(helpers.get_api_response, http=current_app.extensions['http'])
+            data = store.market_chart_range(start_timestamp, end_timestamp, fetch)
             if data != {}:
                 prices = data['prices']
-                print(f"data['prices']: {prices}")
+                logger.debug("data['prices']: %s", prices)
                 # check if there is data for the given range
                 if prices == []:
                     daily_prices = []
@@ -359,18 +631,18 @@ def scrooge():
                                            daily_prices=daily_prices)
                 else:
                     # calculate the numbers needed
-                    daily_prices = helpers.get_daily_values(prices)
-                    bear_length = helpers.get_bear_length(daily_prices)
-                    daily_volumes = helpers.get_daily_values(data['total_volumes'])
-                    highest_volume = helpers.get_highest_volume(daily_volumes)
-                    buy_sell = helpers.get_buy_and_sell_dates(daily_prices)
+                    daily_prices = timeseries.daily_values(prices)
+                    bear_length = timeseries.bear_length(daily_prices.values)
+                    daily_volumes = timeseries.daily_values(data['total_volumes'])
+                    highest_volume = timeseries.highest_volume(daily_volumes)
+                    buy_sell = timeseries.buy_and_sell_dates(daily_prices)
                     return render_template('scrooge.html', title='Roope',
                                            form=form, dates=[start, end],
-                                           daily_prices=daily_prices,
+                                           daily_prices=timeseries.to_list(daily_prices),
                                            bear_length=bear_length,
                                            highest_volume=highest_volume,
                                            buy_sell=buy_sell,
-                                           daily_volumes=daily_volumes)
+                                           daily_volumes=timeseries.to_list(daily_volumes))
             else:
                 # API call was unsuccessful
                 return render_template('scrooge.html', title='Roope',
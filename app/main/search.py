@@ -0,0 +1,218 @@
+"""Search for the food names used by the autocomplete on the nutrients page.
+
+There are two interchangeable implementations: FoodNameIndex is an in-memory index built
+once from the database, and FtsFoodSearch queries the FTS5 table 'food_search' created by
+db_creation.sql, so that all worker processes share one index on disk. Both support prefix
+and substring matching; the in-memory index also matches word prefixes of short queries
+and ignores accents, so that 'paaryna' finds 'päärynä'. The in-memory index is the default.
+"""
+
+import bisect
+import heapq
+import re
+import unicodedata
+from collections import defaultdict
+
+# ranks of the different kinds of matches, the best first
+EXACT, PREFIX, WORD_PREFIX, SUBSTRING = range(4)
+
+
+def normalize(text:str) -> str:
+    """Remove accents and case differences from a text.
+
+    Args:
+        text (str): text to normalize
+
+    Returns:
+        str: lowercase text without combining marks
+    """
+    decomposed = unicodedata.normalize('NFKD', text)
+    return ''.join(c for c in decomposed if not unicodedata.combining(c)).casefold()
+
+
+def trigrams(text:str) -> set:
+    """Get the set of three character substrings of a text."""
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class FoodNameIndex:
+    """Search index over a list of names.
+
+    Args:
+        names: names to index; duplicates are only indexed once
+        limit (int): default maximum number of results returned by search()
+        food_ids: optional food ids of the names, for find_food_id()
+    """
+
+    def __init__(self, names, limit=20, food_ids=None):
+        self.limit = limit
+        names = list(names)
+        self._food_ids = {}
+        if food_ids is not None:
+            # the first id of each name is kept, as in the names
+            for name, food_id in zip(reversed(names), reversed(list(food_ids))):
+                self._food_ids[name] = food_id
+        self.names = list(dict.fromkeys(names))
+        self._normalized = [normalize(name) for name in self.names]
+        # sorted (word, name number) pairs for finding the names with a word starting with a prefix
+        self._words = sorted({(word, i) for i, name in enumerate(self._normalized)
+                              for word in re.split(r'[\s,.;:()/&+-]+', name) if word})
+        # name numbers by trigram for finding the names containing a substring
+        self._trigrams = defaultdict(set)
+        for i, name in enumerate(self._normalized):
+            for trigram in trigrams(name):
+                self._trigrams[trigram].add(i)
+
+    def __len__(self):
+        return len(self.names)
+
+    @classmethod
+    def from_database(cls, database, tables=('food',), limit=20):
+        """Build an index of the FOODNAME columns of the given tables of the Fineli database.
+
+        Args:
+            database: FineliDatabase
+            tables: names of the tables with a FOODNAME column, e.g. 'food', 'foodname_FI', 'foodname_TX'
+            limit (int): default maximum number of results
+
+        Returns:
+            FoodNameIndex: the index
+        """
+        rows = database.food_names(tables)
+        return cls([row[0] for row in rows], limit, [row[1] for row in rows])
+
+    def find_food_id(self, name:str):
+        """Get the food id of a name exactly as it is in the database (None if not found)."""
+        return self._food_ids.get(name)
+
+    def search(self, query:str, limit=None) -> list:
+        """Find the names matching the query, best matches first.
+
+        Exact matches come first, then names starting with the query, names with a word
+        starting with the query and finally names containing the query elsewhere. Within
+        each group, shorter names and earlier matches come first.
+
+        Args:
+            query (str): text to search for
+            limit (int): maximum number of results (the default limit of the index if None)
+
+        Returns:
+            list: matching names
+        """
+        query = normalize(query).strip()
+        if not query:
+            return []
+        limit = self.limit if limit is None else limit
+
+        if len(query) >= 3:
+            # the names containing every trigram of the query, checked for the whole query below
+            postings = sorted((self._trigrams.get(t, set()) for t in trigrams(query)), key=len)
+            candidates = set.intersection(*postings) if postings else set()
+        else:
+            # too short for trigrams, so only look for words starting with the query
+            start = bisect.bisect_left(self._words, (query,))
+            candidates = set()
+            for word, i in self._words[start:]:
+                if not word.startswith(query):
+                    break
+                candidates.add(i)
+
+        ranked = []
+        for i in candidates:
+            name = self._normalized[i]
+            position = name.find(query)
+            if position < 0:
+                continue
+            if name == query:
+                rank = EXACT
+            elif position == 0:
+                rank = PREFIX
+            elif not name[position - 1].isalnum():
+                rank = WORD_PREFIX
+            else:
+                rank = SUBSTRING
+            ranked.append((rank, position, len(name), self.names[i]))
+        return [match[-1] for match in heapq.nsmallest(limit, ranked)]
+
+
+class FtsFoodSearch:
+    """Food name search using the FTS5 table 'food_search' of the Fineli database.
+
+    The table uses the trigram tokenizer, so queries of three or more characters are
+    answered from the index. Shorter queries only match the beginnings of names, which
+    are looked up in the B-tree index of the table 'food_search_name'. Unlike the
+    in-memory index, this search doesn't ignore accents.
+
+    Args:
+        database: FineliDatabase whose connections are used for the queries
+        limit (int): default maximum number of results returned by search()
+    """
+
+    # names starting with the query first, then names with a word starting with the query,
+    # then other matches; earlier matches and shorter names first within each group
+    SEARCH = ("SELECT foodname FROM food_search WHERE food_search MATCH :phrase "
+              "GROUP BY foodname ORDER BY instr(foodname, :query) > 1, "
+              "instr(' ' || foodname, ' ' || :query) = 0, instr(foodname, :query), length(foodname), foodname "
+              "LIMIT :limit")
+    # the names starting with a short query are a range of the primary key of food_search_name
+    SEARCH_SHORT = ("SELECT DISTINCT foodname FROM food_search_name "
+                    "WHERE foodname >= :prefix AND foodname < :prefix || char(1114111) "
+                    "ORDER BY length(foodname), foodname LIMIT :limit")
+    FIND = 'SELECT foodid FROM food_search WHERE food_search MATCH ? AND foodname = ? LIMIT 1'
+
+    def __init__(self, database, limit=20):
+        self.database = database
+        self.limit = limit
+
+    @staticmethod
+    def _phrase(text:str) -> str:
+        # an FTS5 string, so that the query is matched as is and not parsed as FTS5 syntax
+        return '"' + text.replace('"', '""') + '"'
+
+    def search(self, query:str, limit=None) -> list:
+        """Find the names matching the query, best matches first.
+
+        Args:
+            query (str): text to search for
+            limit (int): maximum number of results (the default limit of the search if None)
+
+        Returns:
+            list: matching names
+        """
+        query = query.strip().lower()
+        if not query:
+            return []
+        limit = self.limit if limit is None else limit
+        conn = self.database.connection()
+        if len(query) >= 3:
+            rows = conn.execute(self.SEARCH, {'phrase': self._phrase(query), 'query': query, 'limit': limit})
+        else:
+            rows = conn.execute(self.SEARCH_SHORT, {'prefix': query, 'limit': limit})
+        return [row[0] for row in rows]
+
+    def find_food_id(self, name:str):
+        """Get the food id of a name exactly as it is in the database (None if not found)."""
+        if len(name) < 3:
+            # too short for the trigram index
+            return self.database.find_food_id(name)
+        row = self.database.connection().execute(self.FIND, (self._phrase(name), name)).fetchone()
+        return row[0] if row else None
+
+
+def create_food_search(database, backend='memory', tables=('food',), limit=20):
+    """Create the food name search used by the app.
+
+    Args:
+        database: FineliDatabase
+        backend (str): 'fts' for the FTS5 table of the database, 'memory' for an in-memory index
+        tables: tables of names for the in-memory index
+        limit (int): default maximum number of results
+
+    Returns:
+        FtsFoodSearch or FoodNameIndex: an object with search() and find_food_id() methods
+    """
+    if backend == 'fts':
+        return FtsFoodSearch(database, limit)
+    if backend == 'memory':
+        return FoodNameIndex.from_database(database, tables, limit)
+    raise ValueError(f'unknown search backend: {backend}')
@@ -3,11 +3,69 @@
 import unittest
 from unittest.mock import patch, Mock
 import datetime
+import json
+import logging
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
+import numpy as np
 import pandas as pd
+import requests
+from pulp import LpSolutionIntegerFeasible, LpStatusOptimal
+
+from cache import TTLCache
+from db import FineliDatabase, FIND_FOOD_ID, FOOD_NAMES_BY_ID
+from finna_records import BookRecord, iter_books, parse_record, parse_records
+from finna_search import FinnaSearch
+from http_client import HttpClient, CircuitOpenError
+from jobs import SolveJobQueue, QueueFullError
+from log import JsonFormatter
+from market_data import MarketChartStore, MS_PER_DAY
+from metrics import Metrics
+from search import FoodNameIndex, FtsFoodSearch, create_food_search
+import timeseries
+from wikipedia_pages import WikipediaPages
 
 from helpers import get_rda, get_nutrition_values_of_foods, solve_for_optimal_foods, \
-     get_daily_values, get_bear_length, get_buy_and_sell_dates
+     get_daily_values, get_bear_length, get_buy_and_sell_dates, get_highest_volume, get_nutrient_matrix, \
+     clear_nutrient_matrix_cache, quantize_amount, optimize_foods, \
+     reduce_candidate_foods, nutrition_values_query, export_nutrient_snapshot, load_nutrient_snapshot, \
+     get_rda_table, clear_rda_cache, get_remainder, get_eaten_totals, NutrientModel, NutrientMatrix, solve_batch, \
+     timed_stage, collect_stage_times, is_exact_result
+
+
+def create_test_db(path, foods, values):
+    """Create a small Fineli-like database with the given foods and component values.
+
+    Args:
+        path: path of the database file
+        foods: list of (foodid, foodname, fuclass) tuples
+        values: list of (foodid, eufdname, bestloc) tuples
+    """
+    with sqlite3.connect(path) as conn:
+        conn.execute("CREATE TABLE food (FOODID INTEGER NOT NULL PRIMARY KEY, FOODNAME TEXT NOT NULL, FUCLASS TEXT)")
+        conn.execute("CREATE TABLE component_value (FOODID INTEGER NOT NULL, EUFDNAME TEXT NOT NULL, BESTLOC NUMBER)")
+        conn.executemany("INSERT INTO food VALUES (?, ?, ?)", foods)
+        conn.executemany("INSERT INTO component_value VALUES (?, ?, ?)", values)
+    conn.close()
+
+
+def marc_record(fields, notes=0) -> str:
+    """Create a MARC XML record with the given (tag, [subfield texts]) fields and some long notes."""
+    datafields = "".join(f'<datafield tag="{tag}" ind1=" " ind2=" ">'
+                         + "".join(f'<subfield code="{chr(97 + i)}">{text}</subfield>' for i, text in enumerate(texts))
+                         + '</datafield>' for tag, texts in fields)
+    datafields += "".join('<datafield tag="500" ind1=" " ind2=" "><subfield code="a">' + "huomautus " * 100 +
+                          '</subfield></datafield>' for _ in range(notes))
+    return ('<?xml version="1.0" encoding="UTF-8"?><record xmlns="http://www.loc.gov/MARC21/slim">'
+            '<leader>00000cam a2200000 i 4500</leader><controlfield tag="001">123</controlfield>'
+            + datafields + '</record>')
 
 
 class HelperTest(unittest.TestCase):
@@ -17,6 +75,7 @@ class HelperTest(unittest.TestCase):
                     ["VITD","D-vitamiini μg","UG",10,11,12,13,20,14,15,16,17,18,21,80],
                     ["VITE","E-vitamiini α–TE","MG",11,12,13,14,15,7,8,9,10,11,12,250]]
         rda_df = pd.DataFrame(data=rda_data, columns=["EUFDNAME", "name", "unit", "mnuori", "maikuinen", "mkeski", "miäkäs", "mvanha", "npieni","nnuori", "naikuinen", "nkeski", "niäkäs", "nvanha", "max"])
+        clear_rda_cache()
         with patch("helpers.pd.read_csv") as csv_mock:
             csv_mock.return_value = rda_df
             actual = get_rda("mnuori")
@@ -25,11 +84,250 @@ class HelperTest(unittest.TestCase):
         self.assertEqual(actual.loc[0, 'target'], 900)
         self.assertEqual(actual.loc[1, 'target'], 10)
         self.assertEqual(actual.loc[2, 'max'], 250)
+
+    def test_get_rda_table(self):
+        """The csv file is read once, and again when it changes"""
+        clear_rda_cache()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "rda.csv")
+            with open(path, "w", encoding="utf-8") as rda_file:
+                rda_file.write("VITC;C-vitamiini;MG;1;2;3;4;5;6;7;8;9;10;11;2000\n"
+                               "CA;Kalsium;MG;10;20;30;40;50;60;70;80;90;100;110;2500\n")
+            first = get_rda_table(path)
+            self.assertIs(get_rda_table(path), first)
+            self.assertEqual(first.nutrients, ("ca", "vitc"))
+            self.assertEqual(first.targets["nkeski"].tolist(), [90, 9])
+            self.assertFalse(first.targets["nkeski"].flags.writeable)
+
+            with open(path, "a", encoding="utf-8") as rda_file:
+                rda_file.write("FE;Rauta;MG;1;1;1;1;1;1;1;1;1;1;1;20\n")
+            os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 1))
+            second = get_rda_table(path)
+
+        self.assertEqual(second.nutrients, ("ca", "fe", "vitc"))
+        self.assertEqual(second.maximums.tolist(), [2500, 20, 2000])
+
+        remainder = get_remainder(second, "mnuori", ["ca", "enerc", "vitc"], [1.0, 30.0, 5.0])
+        self.assertEqual(remainder.index.tolist(), ["ca", "vitc"])
+        self.assertEqual(remainder["remainder"].tolist(), [9, -4])
+        self.assertEqual(remainder["name"].tolist(), ["Kalsium", "C-vitamiini"])
     
-    def get_nutrition_values_of_foods(self):
-        """Make sure unwanted foods are omitted"""
-        pass
+    def test_get_nutrition_values_of_foods(self):
+        """Make sure unwanted foods are omitted and missing values are zeros"""
+        clear_nutrient_matrix_cache()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "fineli.db")
+            create_test_db(path,
+                           [(1, "sokeri", "sugadd"), (2, "vauvanruoka", "babyftot"), (3, "omena", "fruit")],
+                           [(1, "enerc", 1600), (1, "ca", 2), (2, "enerc", 300), (2, "ca", 50),
+                            (3, "enerc", 200), (3, "vitc", 10)])
+            with sqlite3.connect(path) as conn:
+                actual = get_nutrition_values_of_foods(conn, ("ca", "vitc"))
+            conn.close()
+
+        self.assertEqual(actual.index.tolist(), [1, 3])
+        self.assertEqual(actual.columns.tolist(), ["ca", "enerc", "vitc"])
+        self.assertAlmostEqual(actual.loc[1, "enerc"], 16)
+        self.assertAlmostEqual(actual.loc[1, "vitc"], 0)
+        self.assertAlmostEqual(actual.loc[3, "vitc"], 0.1)
+
+    def test_get_nutrient_matrix_cache(self):
+        """The nutrient matrix is loaded once and reloaded when the database changes"""
+        clear_nutrient_matrix_cache()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "fineli.db")
+            create_test_db(path, [(1, "sokeri", "sugadd")], [(1, "enerc", 1600), (1, "ca", 2)])
+            with sqlite3.connect(path) as conn:
+                first = get_nutrient_matrix(conn, ("ca",))
+                self.assertIs(get_nutrient_matrix(conn, ("ca",)), first)
+                conn.execute("INSERT INTO food VALUES (2, 'omena', 'fruit')")
+                conn.execute("INSERT INTO component_value VALUES (2, 'ca', 5)")
+                conn.commit()
+                os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 1))
+                second = get_nutrient_matrix(conn, ("ca",))
+            conn.close()
+
+        self.assertIsNot(second, first)
+        self.assertEqual(second.food_ids.tolist(), [1, 2])
+        self.assertFalse(second.values.flags.writeable)
+
+    def test_nutrient_snapshot(self):
+        """The values from a snapshot are the same as from the database, until the database changes"""
+        clear_nutrient_matrix_cache()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "fineli.db")
+            directory = os.path.join(tmp, "snapshot")
+            create_test_db(path,
+                           [(1, "sokeri", "sugadd"), (2, "vauvanruoka", "babyftot"), (3, "omena", "fruit"),
+                            (4, "vesi", "water")],
+                           [(1, "enerc", 1600), (1, "ca", 2), (2, "enerc", 300), (2, "ca", 50),
+                            (3, "enerc", 200), (3, "vitc", 10), (4, "fe", 1)])
+            with sqlite3.connect(path) as conn:
+                expected = get_nutrition_values_of_foods(conn, ("ca", "vitc"))
+                export_nutrient_snapshot(conn, directory)
+                clear_nutrient_matrix_cache()
+                snapshot = load_nutrient_snapshot(directory)
+                actual = get_nutrition_values_of_foods(conn, ("ca", "vitc"), snapshot=directory)
+
+                self.assertIsInstance(snapshot.values, np.memmap)
+                self.assertEqual(snapshot.food_names.tolist(), ["sokeri", "vauvanruoka", "omena", "vesi"])
+                self.assertIs(load_nutrient_snapshot(directory), snapshot)
+                pd.testing.assert_frame_equal(actual, expected)
+
+                # the database changes, so the snapshot is out of date and not used
+                conn.execute("INSERT INTO component_value VALUES (4, 'ca', 100)")
+                conn.commit()
+                os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 1))
+                changed = get_nutrition_values_of_foods(conn, ("ca", "vitc"), snapshot=directory)
+            conn.close()
+
+        self.assertEqual(changed.index.tolist(), [1, 3, 4])
+        self.assertIsNone(load_nutrient_snapshot(os.path.join(tmp, "missing")))
     
+    def test_solve_for_optimal_foods(self):
+        """Find the combination of foods with the least energy that meets the targets"""
+        comp_values = pd.DataFrame({"ca": [0.1, 0.5, 0.0], "enerc": [1.0, 2.0, 0.5]},
+                                   index=pd.Index([1, 2, 3], name="FOODID"))
+        remainder_df = pd.DataFrame({"remainder": [50.0], "max": [200.0]},
+                                    index=pd.Index(["ca"], name="EUFDNAME"))
+        result = solve_for_optimal_foods(remainder_df, comp_values)
+
+        self.assertEqual(result.status, "Optimal")
+        self.assertEqual(result.amounts, {2: 100})
+        self.assertAlmostEqual(result.energy, 200)
+        self.assertEqual(result.mode, "milp")
+        self.assertEqual(result.gap, 0)
+
+    def test_solve_modes(self):
+        """The relaxed and warm-started modes find feasible solutions and report their gap"""
+        comp_values = pd.DataFrame({"ca": [0.3, 0.5, 0.0], "enerc": [1.0, 2.0, 0.5]},
+                                   index=pd.Index([1, 2, 3], name="FOODID"))
+        remainder_df = pd.DataFrame({"remainder": [50.0], "max": [200.0]},
+                                    index=pd.Index(["ca"], name="EUFDNAME"))
+        relaxed = solve_for_optimal_foods(remainder_df, comp_values, mode="lp")
+        warm = solve_for_optimal_foods(remainder_df, comp_values, mode="warm", initial={1: 170})
+
+        self.assertEqual(relaxed.mode, "lp")
+        self.assertEqual(relaxed.amounts, {1: 167})
+        self.assertAlmostEqual(relaxed.gap, (167 - 500 / 3) / (500 / 3))
+        self.assertEqual(warm.mode, "warm")
+        self.assertAlmostEqual(warm.energy, 167)
+        self.assertRaises(ValueError, solve_for_optimal_foods, remainder_df, comp_values, mode="fast")
+
+    def test_nutrient_model_reuse(self):
+        """A model solved again with new bounds gives the same results as new models"""
+        values = [[0.3, 0.0], [0.5, 0.2], [0.0, 0.4]]
+        energy = [1.0, 2.0, 0.5]
+        model = NutrientModel(values, energy, [1, 2, 3], ["ca", "fe"])
+        for minimums, maximums in [([50, 10], [200, 100]), ([100, 0], [300, 100]), ([30, 60], [100, 200])]:
+            reused = model.solve(minimums, maximums)
+            new = optimize_foods(values, energy, minimums, maximums, [1, 2, 3], ["ca", "fe"])
+            self.assertEqual(reused.status, new.status)
+            self.assertAlmostEqual(reused.energy, new.energy)
+
+    def test_solve_stopped_at_time_limit(self):
+        """A solve stopped at the time limit with a solution is reported as feasible, without a gap"""
+        model = NutrientModel([[0.3], [0.5], [0.0]], [1.0, 2.0, 0.5], [1, 2, 3], ["ca"])
+
+        def stop_early(solver):
+            model.model.status = LpStatusOptimal
+            model.model.sol_status = LpSolutionIntegerFeasible
+            for var, value in zip(model.x, [0, 100, 0]):
+                var.varValue = value
+            return LpStatusOptimal
+        with patch.object(model.model, "solve", side_effect=stop_early):
+            result = model.solve([50], [150], time_limit=1)
+        self.assertEqual(result.status, "Feasible")
+        self.assertIsNone(result.gap)
+        self.assertEqual(result.amounts, {2: 100})
+
+    def test_is_exact_result(self):
+        """Only infeasible results and solutions with a known gap are cached, not time-limited solves"""
+        model = NutrientModel([[0.3], [0.5], [0.0]], [1.0, 2.0, 0.5], [1, 2, 3], ["ca"])
+        exact = model.solve([50], [150])
+        self.assertTrue(is_exact_result({"status": exact.status, "mode": exact.mode, "gap": exact.gap}))
+        # PuLP reports "Optimal" for a solve stopped at the time limit, but the gap is not known
+        self.assertFalse(is_exact_result({"status": "Optimal", "mode": "milp", "gap": None}))
+        self.assertFalse(is_exact_result({"status": "Feasible", "mode": "milp", "gap": None}))
+        self.assertFalse(is_exact_result({"status": "Feasible", "mode": "lp", "gap": 0.01}))
+        self.assertTrue(is_exact_result({"status": "Infeasible", "mode": "milp", "gap": None}))
+
+    def test_solve_batch(self):
+        """Many remainders are solved with the same results as one at a time"""
+        clear_nutrient_matrix_cache()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "fineli.db")
+            create_test_db(path, [(1, "maito", "milk"), (2, "juusto", "cheese"), (3, "omena", "fruit")],
+                           [(1, "enerc", 60), (1, "ca", 120), (2, "enerc", 350), (2, "ca", 700),
+                            (3, "enerc", 50), (3, "vitc", 10), (3, "ca", 5)])
+            remainders = [pd.DataFrame({"remainder": [ca, vitc], "max": [3000.0, 2000.0]},
+                                       index=pd.Index(["ca", "vitc"], name="EUFDNAME"))
+                          for ca, vitc in [(800.0, 50.0), (400.0, 70.0), (0.0, 0.0)]]
+            # a remainder without vitamin C, as when the eaten food has no value for it
+            remainders.append(remainders[0].loc[["ca"]])
+            results = solve_batch(path, remainders, ("ca", "vitc"))
+            with sqlite3.connect(path) as conn:
+                comp_values = get_nutrition_values_of_foods(conn, ("ca", "vitc"))
+            conn.close()
+
+        self.assertEqual(len(results), 4)
+        for remainder_df, result in zip(remainders[:3], results):
+            single = solve_for_optimal_foods(remainder_df, comp_values)
+            self.assertEqual(result["status"], single.status)
+            self.assertAlmostEqual(result["energy"], single.energy)
+        self.assertEqual(results[2]["foods"], [])
+        self.assertEqual(results[3]["status"], "Optimal")
+        self.assertNotIn(3, dict(results[3]["foods"]))
+
+    def test_get_eaten_totals(self):
+        """The nutrients of several foods are added up, foods missing from the matrix add nothing"""
+        matrix = NutrientMatrix(np.array([[1.0, 0.5, 0.0], [2.0, 0.0, 0.1], [3.0, 3.0, 3.0]], dtype=np.float32),
+                                np.array([1, 4, 7]), np.array(["ca", "vitc", "fe"]), None)
+        eaten = get_eaten_totals(matrix, [4, 1, 9], [10, 100, 1000])
+        np.testing.assert_allclose(eaten, [120.0, 50.0, 1.0])
+        self.assertEqual(get_eaten_totals(matrix, [], []).tolist(), [0.0, 0.0, 0.0])
+
+    def test_reduce_candidate_foods(self):
+        """Foods without nutrients are removed, identical foods collapsed and dominated foods optionally removed"""
+        values = [[0.0, 0.0], [1.0, 2.0], [1.0, 2.0], [0.5, 1.0], [1.0, 3.0]]
+        energy = [1.0, 2.0, 2.0, 2.0, 2.0]
+        candidates = reduce_candidate_foods(values, energy)
+        pruned = reduce_candidate_foods(values, energy, dominance=True)
+
+        self.assertEqual(candidates.rows.tolist(), [1, 3, 4])
+        self.assertEqual([group.tolist() for group in candidates.groups], [[1, 2], [3], [4]])
+        self.assertEqual((candidates.zero, candidates.duplicate, candidates.dominated), (1, 1, 0))
+        self.assertEqual(pruned.rows.tolist(), [4])
+        self.assertEqual(pruned.dominated, 2)
+
+    def test_solve_with_collapsed_foods(self):
+        """Identical foods give the same optimum when collapsed, shared within the per-food limit"""
+        comp_values = pd.DataFrame({"ca": [1.0, 1.0, 0.0, 0.5], "enerc": [1.0, 1.0, 1.0, 3.0]},
+                                   index=pd.Index([1, 2, 3, 4], name="FOODID"))
+        remainder_df = pd.DataFrame({"remainder": [1200.0], "max": [4000.0]},
+                                    index=pd.Index(["ca"], name="EUFDNAME"))
+        pruned = solve_for_optimal_foods(remainder_df, comp_values)
+        full = solve_for_optimal_foods(remainder_df, comp_values, prune=False)
+
+        self.assertEqual(pruned.removed, 2)
+        self.assertAlmostEqual(pruned.energy, full.energy)
+        self.assertEqual(pruned.amounts, {1: 800, 2: 400})
+
+    def test_relaxed_mode_fallback(self):
+        """When the rounded relaxed solution can't be repaired, the exact solution is returned"""
+        result = optimize_foods([[0.3], [0.7]], [1.0, 2.4], [50.0], [50.05], [1, 2], ["ca"], mode="lp")
+
+        self.assertEqual(result.mode, "milp")
+        self.assertEqual(result.amounts, {1: 162, 2: 2})
+        self.assertAlmostEqual(result.energy, 166.8)
+
+    def test_quantize_amount(self):
+        """Similar amounts are rounded to the same bucket, but never to zero"""
+        self.assertEqual(quantize_amount(203, 10), 200)
+        self.assertEqual(quantize_amount(206, 10), 210)
+        self.assertEqual(quantize_amount(2, 10), 10)
+        self.assertEqual(quantize_amount(203.5, 0), 203.5)
+
     def test_get_daily_values(self):
         """Get the first and only the first value for each day"""
         data = [
@@ -89,5 +387,573 @@ class HelperTest(unittest.TestCase):
         self.assertEqual(actual, (datetime.date(2021, 3, 3), datetime.date(2021, 3, 5)))
         
 
+class TTLCacheTest(unittest.TestCase):
+    def test_lru_eviction(self):
+        """The least recently used entry is evicted when the cache is full"""
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual(cache.stats(), {"hits": 3, "misses": 1, "size": 2, "maxsize": 2})
+
+    def test_ttl_expiry(self):
+        """Entries are not returned after their time to live"""
+        cache = TTLCache(maxsize=2, ttl=60)
+        with patch("cache.time.time") as time_mock:
+            time_mock.return_value = 1000
+            cache.set(("food", 200), [1, 2])
+            time_mock.return_value = 1059
+            self.assertEqual(cache.get(("food", 200)), [1, 2])
+            time_mock.return_value = 1061
+            self.assertIsNone(cache.get(("food", 200)))
+
+    def test_persistence(self):
+        """Entries stored in the SQLite file are found by a new cache instance"""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "cache.db")
+            first = TTLCache(path=path)
+            first.set((1, 200.0, "nkeski"), {"foods": [[1, 100.0]]})
+            first.close()
+            cache = TTLCache(path=path)
+            self.assertEqual(cache.get((1, 200.0, "nkeski")), {"foods": [[1, 100.0]]})
+            self.assertIsNone(cache.get((1, 210.0, "nkeski")))
+            cache.close()
+
+
+class FoodNameIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = FoodNameIndex(["kaurapuuro, vesi", "puuro, kaura", "kaura", "päärynä, kuorittu",
+                                    "kaurahiutale", "ruiskaurakeksi", "kaurapuuro, vesi"], limit=10)
+
+    def test_ranking(self):
+        """Exact matches come first, then prefixes, word prefixes and other substrings"""
+        self.assertEqual(self.index.search("kaura"),
+                         ["kaura", "kaurahiutale", "kaurapuuro, vesi", "puuro, kaura", "ruiskaurakeksi"])
+        self.assertEqual(len(self.index), 6)
+
+    def test_accents_and_case(self):
+        """Matching ignores accents and case"""
+        self.assertEqual(self.index.search("PAARYNA"), ["päärynä, kuorittu"])
+        self.assertIsNone(self.index.find_food_id("kaura"))
+        self.assertEqual(self.index.search("kuori"), ["päärynä, kuorittu"])
+
+    def test_short_query_and_limit(self):
+        """Short queries match word prefixes and the number of results can be limited"""
+        self.assertEqual(self.index.search("ku"), ["päärynä, kuorittu"])
+        self.assertEqual(self.index.search("kaura", limit=2), ["kaura", "kaurahiutale"])
+        self.assertEqual(self.index.search(" "), [])
+
+
+class FtsFoodSearchTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        path = os.path.join(self.tmp.name, "fineli.db")
+        create_test_db(path, [(1, "kaura", "cereal"), (2, "kaurapuuro, vesi", "porrid"),
+                              (3, "puuro, kaura", "porrid"), (4, "ruiskaurakeksi", "biscuit"),
+                              (5, "päärynä", "fruit")], [])
+        with sqlite3.connect(path) as conn:
+            conn.execute("CREATE VIRTUAL TABLE food_search USING fts5(FOODNAME, FOODID UNINDEXED, "
+                         "LANG UNINDEXED, tokenize = 'trigram')")
+            conn.execute("INSERT INTO food_search SELECT foodname, foodid, 'fi' FROM food")
+            conn.execute("INSERT INTO food_search VALUES ('havre', 1, 'sv')")
+            conn.execute("CREATE TABLE food_search_name (FOODNAME TEXT NOT NULL, FOODID INTEGER NOT NULL, "
+                         "PRIMARY KEY (FOODNAME, FOODID)) WITHOUT ROWID")
+            conn.execute("INSERT INTO food_search_name SELECT DISTINCT foodname, foodid FROM food_search")
+        conn.close()
+        self.database = FineliDatabase(path)
+        self.search = FtsFoodSearch(self.database, limit=10)
+
+    def tearDown(self):
+        self.database.close()
+        self.tmp.cleanup()
+
+    def test_search(self):
+        """Prefix matches come before other substrings, short queries match prefixes"""
+        self.assertEqual(self.search.search("KAURA"),
+                         ["kaura", "kaurapuuro, vesi", "puuro, kaura", "ruiskaurakeksi"])
+        self.assertEqual(self.search.search("pu"), ["puuro, kaura"])
+        self.assertEqual(self.search.search('"au'), [])
+
+    def test_short_query_uses_index(self):
+        """Queries shorter than three characters are looked up in the B-tree index, not scanned"""
+        plan = [row[3] for row in self.database.connection().execute(
+            "EXPLAIN QUERY PLAN " + FtsFoodSearch.SEARCH_SHORT, {"prefix": "ka", "limit": 10})]
+        self.assertTrue(any(step.startswith("SEARCH food_search_name") for step in plan), plan)
+        self.assertEqual(self.search.search("Ka"), ["kaura", "kaurapuuro, vesi"])
+
+    def test_default_backend_ignores_accents(self):
+        """The default food search is the in-memory index, which ignores accents"""
+        search = create_food_search(self.database)
+        self.assertIsInstance(search, FoodNameIndex)
+        self.assertEqual(search.search("paaryna"), ["päärynä"])
+
+    def test_find_food_id(self):
+        """Food ids are found by exact names in any language"""
+        self.assertEqual(self.search.find_food_id("puuro, kaura"), 3)
+        self.assertEqual(self.search.find_food_id("havre"), 1)
+        self.assertIsNone(self.search.find_food_id("puuro"))
+
+
+class FineliDatabaseTest(unittest.TestCase):
+    def test_queries(self):
+        """Typed queries return food ids and names"""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "fineli.db")
+            create_test_db(path, [(1, "sokeri", "sugadd"), (2, "omena", "fruit")],
+                           [(1, "enerc", 1600), (2, "enerc", 200), (2, "vitc", 10)])
+            database = FineliDatabase(path)
+
+            self.assertEqual(database.find_food_id("omena"), 2)
+            self.assertIsNone(database.find_food_id("päärynä"))
+            self.assertEqual(database.food_names_by_id([2, 3, 2]), {2: "omena"})
+            self.assertEqual(database.food_names(), [("omena", 2), ("sokeri", 1)])
+            self.assertIs(database.connection(), database.connection())
+            database.close()
+
+    def test_read_only_and_reopened(self):
+        """Connections can't write and are reopened when the database file changes"""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "fineli.db")
+            create_test_db(path, [(1, "sokeri", "sugadd")], [])
+            database = FineliDatabase(path)
+            first = database.connection()
+            self.assertRaises(sqlite3.OperationalError, first.execute, "DELETE FROM food")
+
+            with sqlite3.connect(path) as conn:
+                conn.execute("INSERT INTO food VALUES (2, 'omena', 'fruit')")
+            conn.close()
+            os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 1))
+
+            self.assertEqual(database.find_food_id("omena"), 2)
+            self.assertIsNot(database.connection(), first)
+            database.close()
+
+    def test_missing_file(self):
+        """A missing database file is an error and is not created"""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "fineli.db")
+            self.assertRaises(sqlite3.OperationalError, FineliDatabase(path).connection)
+            self.assertFalse(os.path.exists(path))
+
+    def test_queries_use_indexes(self):
+        """The queries search the indexes created by db_creation.sql instead of scanning the tables"""
+        with open(os.path.join(os.path.dirname(__file__), "..", "..", "db_creation.sql")) as sql_file:
+            indexes = re.findall(r"CREATE INDEX [^;]+;", sql_file.read())
+        self.assertTrue(indexes)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "fineli.db")
+            create_test_db(path, [(1, "sokeri", "sugadd")], [(1, "enerc", 1600)])
+            conn = sqlite3.connect(path)
+            conn.executescript("\n".join(indexes))
+            queries = [(FIND_FOOD_ID, ("sokeri",)), (FOOD_NAMES_BY_ID.format(placeholders="?, ?"), (1, 2)),
+                       nutrition_values_query(("fat", "vitc"))]
+            for stmt, params in queries:
+                for row in conn.execute("EXPLAIN QUERY PLAN " + stmt, params):
+                    self.assertRegex(row[3], "USING (COVERING INDEX|INTEGER PRIMARY KEY)")
+            conn.close()
+
+
+
+class SolveJobQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.release = threading.Event()
+        self.queue = SolveJobQueue(max_workers=1, max_pending=1, timeout=10)
+        # threads instead of worker processes, so that the jobs can wait for the test
+        self.queue._executor = ThreadPoolExecutor(max_workers=1)
+
+    def tearDown(self):
+        self.release.set()
+        self.queue.shutdown()
+
+    def test_unfinished_jobs_fill_the_queue(self):
+        """Jobs that have timed out but haven't finished still count toward the size of the queue"""
+        running = self.queue.submit(self.release.wait)
+        queued = self.queue.submit(self.release.wait)
+        with self.assertRaises(QueueFullError):
+            self.queue.submit(self.release.wait)
+        with patch("jobs.time.monotonic", return_value=time.monotonic() + 11):
+            # the queued job is given up and cancelled, the running one keeps its worker
+            self.assertEqual(self.queue.get(queued).status, "timeout")
+            self.assertTrue(self.queue.get(queued).future.cancelled())
+            self.assertFalse(self.queue.get(running).future.done())
+            self.queue.submit(self.release.wait)
+            with self.assertRaises(QueueFullError):
+                self.queue.submit(self.release.wait)
+
+    def test_broken_pool_is_replaced(self):
+        """A pool broken by a dead worker process is replaced with a new one on the next submit"""
+        broken = Mock()
+        broken.submit.side_effect = BrokenProcessPool("a worker process died")
+        self.queue._executor.shutdown()
+        self.queue._executor = broken
+        with patch("jobs.ProcessPoolExecutor", return_value=ThreadPoolExecutor(max_workers=1)):
+            job = self.queue.submit(time.sleep, 0)
+        self.queue.get(job).future.result(timeout=5)
+        broken.shutdown.assert_called_once()
+        self.assertIsNot(self.queue._executor, broken)
+
+    def test_timeout_starts_when_running(self):
+        """The time limit of a job is counted from when it starts running, not from when it was queued"""
+        second_release = threading.Event()
+        self.addCleanup(second_release.set)
+        now = time.monotonic()
+        first = self.queue.submit(self.release.wait)
+        second = self.queue.submit(second_release.wait)
+        with patch("jobs.time.monotonic", return_value=now + 9):
+            self.release.set()
+            self.queue.get(first).future.result(timeout=5)
+            while not self.queue.get(second).future.running():
+                time.sleep(0.01)
+        with patch("jobs.time.monotonic", return_value=now + 15):
+            self.assertEqual(self.queue.get(second).status, "running")
+        with patch("jobs.time.monotonic", return_value=now + 20):
+            self.assertEqual(self.queue.get(second).status, "timeout")
+
+
+class LoggingTest(unittest.TestCase):
+    def test_json_formatter(self):
+        """Log records are formatted as JSON objects with their extra fields"""
+        record = logging.getLogger("app.test").makeRecord("app.test", logging.INFO, __file__, 1,
+                                                          "solved %s foods", (3,), None,
+                                                          extra={"mode": "milp"})
+        entry = json.loads(JsonFormatter().format(record))
+        self.assertEqual(entry["message"], "solved 3 foods")
+        self.assertEqual(entry["level"], "INFO")
+        self.assertEqual(entry["mode"], "milp")
+
+
+class MetricsTest(unittest.TestCase):
+    def test_render_prometheus_text(self):
+        """Histograms are rendered with cumulative buckets, sum and count, and counters with their labels"""
+        metrics = Metrics(buckets=(0.1, 1))
+        metrics.observe("http_request_duration_seconds", {"endpoint": "main.nutrients", "method": "POST"}, 0.05)
+        metrics.observe("http_request_duration_seconds", {"endpoint": "main.nutrients", "method": "POST"}, 0.5)
+        metrics.observe("http_request_duration_seconds", {"endpoint": "main.nutrients", "method": "POST"}, 5)
+        metrics.increment("http_requests_total", {"endpoint": "main.index", "method": "GET", "status": "200"})
+        lines = metrics.render().splitlines()
+        labels = 'endpoint="main.nutrients",method="POST"'
+        self.assertIn("# TYPE http_request_duration_seconds histogram", lines)
+        self.assertIn(f'http_request_duration_seconds_bucket{{{labels},le="0.1"}} 1', lines)
+        self.assertIn(f'http_request_duration_seconds_bucket{{{labels},le="1"}} 2', lines)
+        self.assertIn(f'http_request_duration_seconds_bucket{{{labels},le="+Inf"}} 3', lines)
+        self.assertIn(f"http_request_duration_seconds_count{{{labels}}} 3", lines)
+        self.assertIn(f"http_request_duration_seconds_sum{{{labels}}} 5.55", lines)
+        self.assertIn('http_requests_total{endpoint="main.index",method="GET",status="200"} 1', lines)
+
+    def test_collect_stage_times(self):
+        """Stages timed in the with block are summed per stage, and not collected after it"""
+        with collect_stage_times() as timings:
+            with timed_stage("solve"):
+                pass
+            with timed_stage("solve"):
+                pass
+        with timed_stage("pivot"):
+            pass
+        self.assertEqual(set(timings), {"solve"})
+        self.assertGreaterEqual(timings["solve"], 0)
+
+
+class TimeseriesTest(unittest.TestCase):
+    def assert_same_analytics(self, data):
+        daily = get_daily_values(data)
+        series = timeseries.daily_values(data)
+        self.assertEqual(timeseries.to_list(series), daily)
+        self.assertEqual(timeseries.bear_length(series.values), get_bear_length(daily))
+        self.assertEqual(timeseries.highest_volume(series), get_highest_volume(daily))
+        self.assertEqual(timeseries.buy_and_sell_dates(series), tuple(get_buy_and_sell_dates(daily)))
+
+    def test_same_as_helpers(self):
+        """The array versions give the same results as the list versions of helpers.py"""
+        day = 24 * 60 * 60 * 1000
+        start = 1638396252313
+        # rising, falling, flat and repeating prices, several values per day and a day going back
+        cases = [[[start + i * 3600 * 1000, 100 + (i % 7) * (-1) ** i] for i in range(24 * 40)],
+                 [[start + i * day, 100 - i] for i in range(30)],
+                 [[start + i * day, 5.0] for i in range(10)],
+                 [[start, 3], [start + day, 1], [start + 2 * day, 4], [start + 3 * day, 1], [start + 4 * day, 4]],
+                 [[start, 2], [start + 2 * day, 5], [start + day, 9], [start + 3 * day, 1]],
+                 [[start, 7]]]
+        rng = np.random.default_rng(0)
+        steps = rng.choice([0, 1, 3600 * 1000, day, -day], size=(20, 50))
+        cases += [[[float(t), float(p)] for t, p in zip(start + np.cumsum(s), rng.integers(1, 5, len(s)))]
+                  for s in steps]
+        for data in cases:
+            self.assert_same_analytics(data)
+
+
+class MarketChartStoreTest(unittest.TestCase):
+    def fake_api(self, calls):
+        """A fetch function returning hourly prices and volumes for the requested range."""
+        def fetch(url, payload):
+            calls.append((payload["from"], payload["to"]))
+            hours = range(payload["from"] * 1000, (payload["to"] + 1) * 1000, 60 * 60 * 1000)
+            return {"prices": [[t, t / MS_PER_DAY] for t in hours],
+                    "total_volumes": [[t, 2 * t / MS_PER_DAY] for t in hours]}
+        return fetch
+
+    def test_fetch_missing_days_only(self):
+        """Days in the store are not fetched again, and the first value of each day is returned"""
+        calls = []
+        fetch = self.fake_api(calls)
+        day = MS_PER_DAY // 1000
+        with tempfile.TemporaryDirectory() as tmp, patch("market_data.time.time", return_value=100 * day):
+            store = MarketChartStore(os.path.join(tmp, "coingecko.db"))
+            data = store.market_chart_range(10 * day, 20 * day + 3600, fetch)
+            self.assertEqual(calls, [(10 * day, 21 * day - 1)])
+            self.assertEqual(data["prices"], [[d * MS_PER_DAY, d] for d in range(10, 21)])
+            self.assertEqual(data["total_volumes"], [[d * MS_PER_DAY, 2 * d] for d in range(10, 21)])
+
+            self.assertEqual(store.market_chart_range(12 * day, 15 * day, fetch)["prices"],
+                             [[d * MS_PER_DAY, d] for d in range(12, 16)])
+            self.assertEqual(len(calls), 1)
+
+            data = store.market_chart_range(5 * day, 25 * day, fetch)
+            self.assertEqual(calls[1:], [(5 * day, 10 * day - 1), (21 * day, 26 * day - 1)])
+            self.assertEqual(data["prices"], [[d * MS_PER_DAY, d] for d in range(5, 26)])
+
+    def test_today_is_fetched_again(self):
+        """Today's values are fetched on every request, and a failed fetch returns {}"""
+        calls = []
+        fetch = self.fake_api(calls)
+        day = MS_PER_DAY // 1000
+        with tempfile.TemporaryDirectory() as tmp, patch("market_data.time.time", return_value=20 * day + 60):
+            store = MarketChartStore(os.path.join(tmp, "coingecko.db"))
+            store.market_chart_range(18 * day, 20 * day, fetch)
+            store.market_chart_range(18 * day, 20 * day, fetch)
+            self.assertEqual(calls[1], (20 * day, 21 * day - 1))
+            self.assertEqual(store.market_chart_range(18 * day, 20 * day, lambda url, payload: {}), {})
+
+    def test_slow_fetch_does_not_block_stored_ranges(self):
+        """A range in the store is returned while another request is still waiting for the API"""
+        calls = []
+        fetch = self.fake_api(calls)
+        started, release = threading.Event(), threading.Event()
+        released = []
+
+        def slow_fetch(url, payload):
+            started.set()
+            # times out if the other request waits for this one to finish
+            released.append(release.wait(2))
+            return fetch(url, payload)
+        day = MS_PER_DAY // 1000
+        with tempfile.TemporaryDirectory() as tmp, patch("market_data.time.time", return_value=100 * day):
+            store = MarketChartStore(os.path.join(tmp, "coingecko.db"))
+            store.market_chart_range(10 * day, 20 * day, fetch)
+            slow = threading.Thread(target=store.market_chart_range, args=(30 * day, 40 * day, slow_fetch))
+            slow.start()
+            try:
+                self.assertTrue(started.wait(5))
+                self.assertEqual(len(store.market_chart_range(10 * day, 20 * day, fetch)["prices"]), 11)
+            finally:
+                release.set()
+                slow.join()
+            self.assertEqual(len(store.market_chart_range(30 * day, 40 * day, fetch)["prices"]), 11)
+            self.assertEqual(released, [True])
+            self.assertEqual(len(calls), 2)
+
+
+class HttpClientTest(unittest.TestCase):
+    def client_with_responses(self, *outcomes, **kwargs):
+        """An HttpClient whose session returns responses with the given statuses or raises the given errors."""
+        client = HttpClient(**kwargs)
+        client._session = Mock()
+        client._session.get.side_effect = [outcome if isinstance(outcome, Exception) else Mock(status_code=outcome)
+                                           for outcome in outcomes]
+        return client
+
+    @patch("http_client.time.sleep")
+    def test_retry_with_timeouts(self, sleep_mock):
+        """Failed attempts are retried after a wait, and every attempt has the timeouts"""
+        client = self.client_with_responses(503, requests.ConnectionError(), 200,
+                                            connect_timeout=1, read_timeout=5, retries=2)
+        self.assertEqual(client.get("https://api.example.com/x").status_code, 200)
+        self.assertEqual(client._session.get.call_count, 3)
+        self.assertEqual(sleep_mock.call_count, 2)
+        self.assertEqual(client._session.get.call_args.kwargs["timeout"], (1, 5))
+
+    @patch("http_client.time.sleep")
+    def test_circuit_opens_after_failures(self, sleep_mock):
+        """A host that keeps failing is not called until the reset time has passed"""
+        client = self.client_with_responses(requests.Timeout(), requests.Timeout(), 200,
+                                            retries=0, breaker_threshold=2, breaker_reset=30)
+        for _ in range(2):
+            with self.assertRaises(requests.Timeout):
+                client.get("https://api.example.com/x")
+        with self.assertRaises(CircuitOpenError):
+            client.get("https://api.example.com/y")
+        self.assertEqual(client._session.get.call_count, 2)
+        # the circuit lets one call through after the reset time, and closes when it succeeds
+        with patch("http_client.time.monotonic", return_value=time.monotonic() + 31):
+            self.assertEqual(client.get("https://api.example.com/x").status_code, 200)
+        self.assertEqual(client.breaker("https://api.example.com/").state, "closed")
+
+    def test_other_error_in_half_open_trial(self):
+        """An error that is not retried fails the trial call, and the circuit lets another trial through later"""
+        client = self.client_with_responses(requests.Timeout(), requests.exceptions.ChunkedEncodingError(), 200,
+                                            retries=0, breaker_threshold=1, breaker_reset=30)
+        with self.assertRaises(requests.Timeout):
+            client.get("https://api.example.com/x")
+        with patch("http_client.time.monotonic", return_value=time.monotonic() + 31):
+            with self.assertRaises(requests.exceptions.ChunkedEncodingError):
+                client.get("https://api.example.com/x")
+            self.assertEqual(client.breaker("https://api.example.com/").state, "open")
+        with patch("http_client.time.monotonic", return_value=time.monotonic() + 62):
+            self.assertEqual(client.get("https://api.example.com/x").status_code, 200)
+        self.assertEqual(client.breaker("https://api.example.com/").state, "closed")
+
+
+class FinnaRecordsTest(unittest.TestCase):
+    def test_parse_record(self):
+        """The language, original language, author and title are read and cleaned"""
+        record = parse_record(marc_record([("041", ["fin", "eng"]), ("100", ["Waltari, Mika,"]),
+                                           ("245", ["Sinuhe egyptiläinen :"])], notes=50))
+        self.assertEqual(record, BookRecord("fin", "eng", "Waltari, Mika", "Sinuhe egyptiläinen"))
+        self.assertEqual(parse_record(marc_record([("245", ["Nimetön /"])])), BookRecord(title="Nimetön"))
+
+    def test_parse_records(self):
+        """Duplicates, books in other languages and books without a language are left out"""
+        records = [{"fullRecord": marc_record(fields)} for fields in [
+            [("041", ["fin"]), ("100", ["Jansson, Tove."]), ("245", ["Muumipeikko ja pyrstötähti."])],
+            [("041", ["swe"]), ("100", ["Jansson, Tove."]), ("245", ["Kometjakten"])],
+            [("041", ["fin"]), ("100", ["Jansson, Tove,"]), ("245", ["Muumipeikko ja pyrstötähti /"])],
+            [("100", ["Tuntematon"]), ("245", ["Ei kieltä"])],
+            [("041", ["fin", "swe"]), ("100", ["Jansson, Tove."]), ("245", ["Taikurin hattu"])]]]
+        books = parse_records(records, "fin")
+        self.assertEqual([(book.author, book.title) for book in books],
+                         [("Jansson, Tove", "Muumipeikko ja pyrstötähti"), ("Jansson, Tove", "Taikurin hattu")])
+        self.assertEqual(len(parse_records(records, "all")), 3)
+
+    def test_cached_books(self):
+        """The parse time is measured and the books can be stored in a persisted cache"""
+        timings = {}
+        records = [{"fullRecord": marc_record([("041", ["fin"]), ("100", ["Waltari, Mika,"]),
+                                               ("245", ["Sinuhe egyptiläinen :"])])}]
+        books = list(iter_books(records, "fin", timings))
+        self.assertGreater(timings["parse"], 0)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "cache.db")
+            cache = TTLCache(path=path, table="finna_searches")
+            cache.set(("author", "mika waltari", "fin"), {"count": 1, "books": books, "timings": timings})
+            cache.close()
+            cached = TTLCache(path=path, table="finna_searches").get(("author", "mika waltari", "fin"))
+        self.assertEqual(cached["books"], books)
+
+
+class FinnaSearchTest(unittest.TestCase):
+    def search_page(self, count, fail_page=None, bad_page=None):
+        """A fake search of count results, returning the page numbers of the records"""
+        calls = []
+
+        def search_page(page, limit):
+            calls.append(page)
+            if page == fail_page:
+                raise requests.ConnectionError("no connection")
+            if page == bad_page:
+                raise ValueError("Expecting value: line 1 column 1 (char 0)")
+            first = (page - 1) * limit
+            return {"resultCount": count, "records": [{"page": page} for _ in range(first, min(first + limit, count))]}
+        return search_page, calls
+
+    def test_pages_in_order(self):
+        """The later pages are fetched up to max_results and the records come in the order of the pages"""
+        search_page, calls = self.search_page(1000)
+        results = FinnaSearch(page_size=50, max_results=300, workers=3).search(search_page)
+        self.assertEqual(results.count, 1000)
+        pages = [record["page"] for record in results.records()]
+        self.assertEqual(pages, sorted(pages))
+        self.assertEqual(len(pages), 300)
+        self.assertEqual(sorted(calls), [1, 2, 3, 4, 5, 6])
+        self.assertFalse(results.incomplete)
+        self.assertGreater(results.timings["fetch"], 0)
+
+        search_page, calls = self.search_page(70)
+        results = FinnaSearch(page_size=50).search(search_page)
+        self.assertEqual(len(list(results.records())), 70)
+        self.assertEqual(sorted(calls), [1, 2])
+
+    def test_failed_page(self):
+        """The records before a page that could not be fetched are given out, and the first page must succeed"""
+        search_page, _ = self.search_page(200, fail_page=3)
+        results = FinnaSearch(page_size=50).search(search_page)
+        self.assertEqual(len(list(results.records())), 100)
+        self.assertTrue(results.incomplete)
+
+        search_page, _ = self.search_page(200, fail_page=1)
+        with self.assertRaises(requests.RequestException):
+            FinnaSearch(page_size=50).search(search_page)
+
+    def test_page_not_json(self):
+        """A later page that is not JSON is skipped and logged, and the other pages are given out"""
+        search_page, _ = self.search_page(200, bad_page=2)
+        results = FinnaSearch(page_size=50).search(search_page)
+        with self.assertLogs("finna_search", level="WARNING"):
+            pages = [record["page"] for record in results.records()]
+        self.assertEqual(pages, [1] * 50 + [3] * 50 + [4] * 50)
+        self.assertTrue(results.incomplete)
+
+    def test_books_across_pages(self):
+        """Duplicates are left out across pages as the books arrive"""
+        book = {"fullRecord": marc_record([("041", ["fin"]), ("100", ["Jansson, Tove."]), ("245", ["Taikurin hattu"])])}
+        other = {"fullRecord": marc_record([("041", ["swe"]), ("100", ["Jansson, Tove."]), ("245", ["Trollkarlens hatt"])])}
+
+        def search_page(page, limit):
+            return {"resultCount": 4, "records": [book, other] if page == 1 else [other, book]}
+        books = iter_books(FinnaSearch(page_size=2).search(search_page).records(), "all")
+        self.assertEqual([b.title for b in books], ["Taikurin hattu", "Trollkarlens hatt"])
+
+
+
+class WikipediaPagesTest(unittest.TestCase):
+    def test_refresh(self):
+        """Pages are loaded by refresh, and a page that fails keeps its earlier contents"""
+        available = {"Helsinki": ("Pääkaupunki.", ["https://example.com/helsinki.jpg"]), "Laama": ("Eläin.", [])}
+
+        def fetch(title):
+            if title not in available:
+                raise requests.ConnectionError("no connection")
+            return available[title]
+        pages = WikipediaPages(topics=["Helsinki", "Laama", "Urho_Kekkosen_kansallispuisto"], fetch=fetch)
+        pages.prefetch = False
+        self.assertIsNone(pages.random_page())
+        with self.assertLogs("wikipedia_pages", level="WARNING") as logs:
+            self.assertEqual(pages.refresh(), ["Urho_Kekkosen_kansallispuisto"])
+        # a network error is logged on one line without a traceback
+        self.assertEqual(logs.output, ["WARNING:wikipedia_pages:Wikipedia page Urho_Kekkosen_kansallispuisto "
+                                       "could not be fetched: no connection"])
+        self.assertIsNone(logs.records[0].exc_info)
+        self.assertIn(pages.random_page().topic, ("Helsinki", "Laama"))
+
+        available = {"Urho_Kekkosen_kansallispuisto": ("Kansallispuisto.", [])}
+        self.assertEqual(pages.refresh(), ["Helsinki", "Laama"])
+        loaded = {page.topic: page for page in (pages.random_page() for _ in range(100))}
+        self.assertEqual(loaded["Helsinki"].summary, "Pääkaupunki.")
+        self.assertEqual(loaded["Urho_Kekkosen_kansallispuisto"].heading, "Urho Kekkosen kansallispuisto")
+
+    def test_background_thread(self):
+        """The background thread loads the pages and retries the failed ones"""
+        calls = []
+
+        def fetch(title):
+            calls.append(title)
+            if calls.count(title) == 1 and title == "Laama":
+                raise requests.Timeout("timed out")
+            return "Tiivistelmä.", []
+        pages = WikipediaPages(topics=["Helsinki", "Laama"], retry=0.01, fetch=fetch)
+        pages.start()
+        try:
+            for _ in range(200):
+                if calls.count("Laama") > 1:
+                    break
+                time.sleep(0.01)
+        finally:
+            pages.stop()
+        self.assertEqual(calls[:3], ["Helsinki", "Laama", "Laama"])
+
+
 if __name__ == '__main__':
-    unittest.main(verbosity=2)
\ No newline at end of file
+    unittest.main(verbosity=2)
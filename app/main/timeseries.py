@@ -0,0 +1,93 @@
+"""Daily price and volume analytics of the Scrooge page over NumPy arrays.
+
+These give the same results as get_daily_values, get_bear_length, get_highest_volume and
+get_buy_and_sell_dates of helpers.py, which walk the lists of [timestamp, value] pairs of
+the CoinGecko API one item at a time. For ranges of several years the API returns tens
+of thousands of points, so here the days are found with integer division of the
+millisecond timestamps and the rest with array operations.
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+US_PER_DAY = 24 * 60 * 60 * 1000 * 1000
+
+# the first value of each day: dates as datetime64[D] and the values as floats
+DailySeries = namedtuple("DailySeries", ["days", "values"])
+
+
+def daily_values(data) -> DailySeries:
+    """Keep the first value of each day, like helpers.get_daily_values. An item is kept
+    if its day is later than the day of every item before it.
+
+    Args:
+        data: [timestamp in milliseconds, value] pairs, as a list or an array
+
+    Returns:
+        DailySeries: the days and their values
+    """
+    data = np.asarray(data, dtype=float).reshape(-1, 2)
+    # datetime rounds timestamps to whole microseconds, so round before dividing
+    microseconds = np.round(data[:, 0] * 1000).astype(np.int64)
+    days = microseconds // US_PER_DAY
+    keep = np.ones(len(days), dtype=bool)
+    keep[1:] = days[1:] > np.maximum.accumulate(days)[:-1]
+    return DailySeries(days[keep].astype("datetime64[D]"), data[keep, 1])
+
+
+def to_list(series:DailySeries) -> list:
+    """Get the days and values as [date, value] lists, like helpers.get_daily_values."""
+    return [[day, value] for day, value in zip(series.days.astype(object), series.values.tolist())]
+
+
+def bear_length(values) -> int:
+    """Get the length of the longest streak of diminishing values, like helpers.get_bear_length.
+
+    Args:
+        values: array of daily values
+
+    Returns:
+        int: the largest number of days in a row with a lower value than the day before
+    """
+    falling = np.asarray(values)[1:] < np.asarray(values)[:-1]
+    # the streaks start where falling turns True and end where it turns False
+    edges = np.flatnonzero(np.diff(np.concatenate(([False], falling, [False])).astype(np.int8)))
+    if not len(edges):
+        return 0
+    return int((edges[1::2] - edges[::2]).max())
+
+
+def highest_volume(series:DailySeries) -> list:
+    """Get the first day with the highest volume, like helpers.get_highest_volume.
+
+    Args:
+        series: DailySeries of the daily volumes
+
+    Returns:
+        list: the date and the volume
+    """
+    i = int(np.argmax(series.values))
+    return [series.days[i].astype(object), float(series.values[i])]
+
+
+def buy_and_sell_dates(series:DailySeries) -> tuple:
+    """Get the buy and sell dates with the largest price difference, like
+    helpers.get_buy_and_sell_dates: the first sell day with the largest profit over
+    the lowest price before it, and the first day with that lowest price. Both are
+    the first day if the price never rises.
+
+    Args:
+        series: DailySeries of the daily prices
+
+    Returns:
+        tuple: the dates on which to buy and sell
+    """
+    prices = series.values
+    lowest = np.minimum.accumulate(prices)
+    profit = prices - lowest
+    sell = int(np.argmax(profit))
+    if not profit[sell] > 0:
+        sell = 0
+    buy = int(np.argmax(prices[:sell + 1] == lowest[sell]))
+    return series.days[buy].astype(object), series.days[sell].astype(object)
@@ -0,0 +1,137 @@
+"""The Wikipedia articles shown on the Wikipedia page of the app, loaded in the background.
+
+The page shows one of a fixed list of topics, so the summaries and image addresses of
+all of them are fetched by a background thread when the app starts and again every
+WIKIPEDIA_REFRESH seconds, and a request only picks one of the loaded pages. A page that
+can't be fetched keeps its earlier contents, and the failed topics are tried again after
+WIKIPEDIA_RETRY seconds.
+
+The settings are read from the app config:
+
+    WIKIPEDIA_TOPICS = TOPICS       # titles of the pages in the Finnish Wikipedia
+    WIKIPEDIA_REFRESH = 6 * 60 * 60 # seconds between loading all the pages again
+    WIKIPEDIA_RETRY = 60            # seconds before trying failed pages again
+    WIKIPEDIA_PREFETCH = True       # whether to start the background thread with the app
+"""
+
+import logging
+import os
+import random
+import threading
+from collections import namedtuple
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+TOPICS = ('Helsinki', 'Kuopio', 'Turku', 'Maakunta-_ja_soteuudistus',
+          'Tiikeri', 'Sademetsäkäpinkäinen', 'Lineaarinen_regressioanalyysi',
+          'Derivaatta', 'Urho_Kekkosen_kansallispuisto', 'Laama',
+          'Septimus_Heap')
+
+# a loaded page: the title, the heading shown, the summary and the image addresses
+WikipediaPage = namedtuple("WikipediaPage", ["topic", "heading", "summary", "images"])
+
+
+class WikipediaPages:
+    """The pages of the topics, kept up to date by a background thread.
+
+    Args:
+        topics: titles of the pages
+        refresh (float): seconds between loading all the pages again
+        retry (float): seconds before trying failed pages again
+        fetch: function called with a title, returning the summary and the image
+               addresses like helpers.get_wikipedia_page; set by the app
+    """
+
+    def __init__(self, topics=TOPICS, refresh=6 * 60 * 60, retry=60, fetch=None):
+        self.topics = tuple(topics)
+        self.refresh_interval = refresh
+        self.retry_interval = retry
+        self.fetch = fetch
+        self.prefetch = True
+        self._pages = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def init_app(self, app):
+        app.config.setdefault('WIKIPEDIA_TOPICS', self.topics)
+        app.config.setdefault('WIKIPEDIA_REFRESH', self.refresh_interval)
+        app.config.setdefault('WIKIPEDIA_RETRY', self.retry_interval)
+        app.config.setdefault('WIKIPEDIA_PREFETCH', self.prefetch)
+        self.topics = tuple(app.config['WIKIPEDIA_TOPICS'])
+        self.refresh_interval = app.config['WIKIPEDIA_REFRESH']
+        self.retry_interval = app.config['WIKIPEDIA_RETRY']
+        self.prefetch = app.config['WIKIPEDIA_PREFETCH']
+        app.extensions['wikipedia_pages'] = self
+        if self.prefetch:
+            self.start()
+
+    def start(self):
+        """Start the background thread, unless it is already running in this process.
+        Threads don't survive a fork, so a forked worker process starts its own."""
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='wikipedia-pages', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop the background thread after the page it is loading."""
+        self._stop.set()
+
+    def _run(self):
+        failed = self.refresh()
+        while not self._stop.is_set():
+            if failed:
+                self._stop.wait(self.retry_interval)
+                failed = self.refresh(failed)
+            else:
+                self._stop.wait(self.refresh_interval)
+                failed = self.refresh()
+
+    def refresh(self, topics=None) -> list:
+        """Load the pages of the topics, keeping the earlier contents of the pages that fail.
+
+        Args:
+            topics: titles of the pages to load, all the topics by default
+
+        Returns:
+            list: the titles of the pages that could not be loaded
+        """
+        failed = []
+        for topic in self.topics if topics is None else topics:
+            if self._stop.is_set():
+                break
+            try:
+                summary, images = self.fetch(topic)
+            except requests.RequestException as e:
+                # network errors are expected during an outage, so no tracebacks for them
+                logger.warning('Wikipedia page %s could not be fetched: %s', topic, e)
+                failed.append(topic)
+                continue
+            except Exception:
+                # e.g. a response that is not JSON; the thread keeps running for the other pages
+                logger.warning('Wikipedia page %s could not be fetched', topic, exc_info=True)
+                failed.append(topic)
+                continue
+            page = WikipediaPage(topic, topic.replace('_', ' '), summary, images)
+            with self._lock:
+                self._pages[topic] = page
+        return failed
+
+    def random_page(self):
+        """Get a random one of the loaded pages without calling Wikipedia.
+
+        Returns:
+            WikipediaPage: the page, or None if no page has been loaded yet
+        """
+        if self.prefetch and self._pid != os.getpid():
+            self.start()
+        with self._lock:
+            pages = list(self._pages.values())
+        return random.choice(pages) if pages else None
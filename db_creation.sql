@@ -1,5 +1,7 @@
 /* run this script with ".read db_creation.sql" when you are already connected to Sqlite and have the db open */
 /* or, you can also do "cat db_creation.sql | sqlite3 fineli.db" in a terminal without connecting to Sqlite first. */
+/* usually it is easier to run "python fineli_import.py", which runs this script and imports the original csv files in db/ directly */
+/* (the .import commands below need the converted _import files instead) */
 
 /* commands for creating the tables for fineli db */
 
@@ -251,4 +253,42 @@ CREATE TABLE foodunit_FI (
 .import db/acqtype_FI_import.csv acqtype_FI
 .import db/methind_FI_import.csv methind_FI
 .import db/foodtype_FI_import.csv foodtype_FI
-.import db/compunit_FI_import.csv compunit_FI
\ No newline at end of file
+.import db/compunit_FI_import.csv compunit_FI
+
+/* indexes for the queries of the app, created after the import so that the rows are not indexed one by one */
+/* the component_value indexes cover the queries, so the table itself is never read by them */
+/* (to add the indexes to an existing database, run the commands below on it) */
+
+CREATE INDEX component_value_eufdname ON component_value (EUFDNAME, FOODID, BESTLOC);
+CREATE INDEX component_value_foodid ON component_value (FOODID, EUFDNAME, BESTLOC);
+CREATE INDEX food_foodname ON food (FOODNAME);
+CREATE INDEX food_fuclass ON food (FUCLASS);
+ANALYZE;
+
+/* full-text search index over the food names in all languages, used by the autocomplete and the food lookup */
+/* the trigram tokenizer (SQLite 3.34 or later) matches any part of a name that is at least three characters long */
+/* (to add the index to an existing database, run the commands below on it) */
+
+CREATE VIRTUAL TABLE food_search USING fts5(
+    FOODNAME,
+    FOODID UNINDEXED,
+    LANG UNINDEXED,
+    tokenize = 'trigram'
+);
+
+INSERT INTO food_search (FOODNAME, FOODID, LANG)
+    SELECT FOODNAME, FOODID, 'fi' FROM food
+    UNION SELECT FOODNAME, FOODID, LANG FROM foodname_FI
+    UNION SELECT FOODNAME, FOODID, LANG FROM foodname_TX;
+
+/* the same names in a table with a B-tree index, for the queries shorter than three characters, */
+/* which the trigram index can't answer; the names are all in lower case */
+
+CREATE TABLE food_search_name (
+    FOODNAME TEXT NOT NULL,
+    FOODID INTEGER NOT NULL,
+    PRIMARY KEY (FOODNAME, FOODID)
+) WITHOUT ROWID;
+
+INSERT INTO food_search_name (FOODNAME, FOODID)
+    SELECT DISTINCT FOODNAME, FOODID FROM food_search;
@@ -0,0 +1,241 @@
+"""Fineli database importer
+
+This script creates the Sqlite database of the app from the Fineli csv files in one go.
+Run it in the directory where this script is:
+
+    python fineli_import.py [--source db] [--database fineli.db] [--jobs 4]
+
+It reads the Latin-1 csv files in 'db/' line by line, skipping the first row (column
+names), lowercasing the contents and changing the decimal separator in
+component_value.csv into a decimal point, and inserts the rows straight into the
+database without writing any intermediate files. Only the tables of the .import lines
+of db_creation.sql are imported. The tables are created with the commands of
+db_creation.sql before its .import lines and the commands after them (indexes and the
+full-text search table) are run once all the data is in.
+
+Unlike the sqlite3 .import command, which stored empty fields as '', this stores them as
+NULL. Like .import, rows with too few fields (e.g. the parts of a row broken by a line
+break inside a field of publication.csv) are filled up with NULLs and extra fields are
+left out, with a warning giving the file and the line.
+
+With more than one job, the files are parsed in parallel into temporary databases of one
+table each, which are then copied into the database. The new database is built next to
+the old one and only replaces it when it is complete, so the app can keep running while
+a new Fineli release is imported.
+"""
+
+import argparse
+import csv
+import glob
+import logging
+import os
+import sqlite3
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# fast but unsafe settings: a failed import leaves a broken file, which is thrown away anyway
+BULK_PRAGMAS = ("PRAGMA journal_mode = OFF",
+                "PRAGMA synchronous = OFF",
+                "PRAGMA locking_mode = EXCLUSIVE",
+                "PRAGMA temp_store = MEMORY",
+                "PRAGMA cache_size = -65536")
+
+
+def split_script(path:str) -> tuple:
+    """Split db_creation.sql into the commands to run before and after importing the data.
+
+    Args:
+        path (str): path of the sql script
+
+    Returns:
+        tuple: the sql before the first and after the last sqlite shell (dot) command,
+               and the names of the tables of the .import commands
+    """
+    with open(path, encoding='utf-8') as script:
+        lines = script.readlines()
+    dot_commands = [i for i, line in enumerate(lines) if line.startswith('.')]
+    tables = [lines[i].split()[2] for i in dot_commands
+              if lines[i].startswith('.import') and len(lines[i].split()) == 3]
+    if not dot_commands:
+        return ''.join(lines), '', tables
+    return ''.join(lines[:dot_commands[0]]), ''.join(lines[dot_commands[-1] + 1:]), tables
+
+
+def read_rows(source:str, width=None):
+    """Read the rows of a Fineli csv file, converted for importing.
+
+    Args:
+        source (str): path of the csv file
+        width (int): number of fields of a row, the number of column names if None;
+            shorter rows are filled up with None and longer ones cut, with a warning
+
+    Returns:
+        tuple: the column names and an iterator over the rows, with empty values as None
+    """
+    decimal_comma = os.path.basename(source) == 'component_value.csv'
+    source_file = open(source, encoding='latin-1', newline='')
+
+    def lines():
+        with source_file:
+            for line in source_file:
+                # change decimal separator to full stop to avoid problems with sqlite
+                if decimal_comma:
+                    line = line.replace(',', '.')
+                yield line.lower()
+
+    reader = csv.reader(lines(), delimiter=';')
+    columns = next(reader, [])
+    width = len(columns) if width is None else width
+
+    def rows():
+        for row in reader:
+            if not row:
+                continue
+            if len(row) != width:
+                logger.warning('%s, line %d: expected %d fields but found %d', source, reader.line_num,
+                               width, len(row))
+                row = (row + [''] * width)[:width]
+            yield [value if value != '' else None for value in row]
+
+    return columns, rows()
+
+
+def load_csv(conn, source:str, table:str) -> int:
+    """Insert the rows of a csv file into a table in a single transaction.
+    The table is created from the column names of the file if it doesn't exist.
+
+    Args:
+        conn: database connection
+        source (str): path of the csv file
+        table (str): name of the table
+
+    Returns:
+        int: number of rows inserted
+    """
+    width = len(conn.execute(f"PRAGMA table_info({table})").fetchall()) or None
+    columns, rows = read_rows(source, width)
+    if width is None:
+        conn.execute(f"CREATE TABLE {table} ({', '.join(f'{column} TEXT' for column in columns)})")
+        width = len(columns)
+    count = conn.execute(f"SELECT count(*) FROM {table}").fetchone()[0]
+    conn.executemany(f"INSERT INTO {table} VALUES ({', '.join('?' * width)})", rows)
+    conn.commit()
+    return conn.execute(f"SELECT count(*) FROM {table}").fetchone()[0] - count
+
+
+def load_shard(source:str, table:str, create_sql, shard:str) -> int:
+    """Load a csv file into a table of its own temporary database (run in a worker process).
+
+    Args:
+        source (str): path of the csv file
+        table (str): name of the table
+        create_sql (str): CREATE TABLE statement of the table, or None to create it from the file
+        shard (str): path of the temporary database
+
+    Returns:
+        int: number of rows inserted
+    """
+    conn = sqlite3.connect(shard)
+    try:
+        for pragma in BULK_PRAGMAS:
+            conn.execute(pragma)
+        if create_sql:
+            conn.execute(create_sql)
+        return load_csv(conn, source, table)
+    finally:
+        conn.close()
+
+
+def copy_shard(conn, table:str, shard:str):
+    """Copy a table from a temporary database into the database in a single transaction."""
+    conn.execute("ATTACH DATABASE ? AS shard", (shard,))
+    try:
+        exists = conn.execute("SELECT 1 FROM main.sqlite_master WHERE type = 'table' AND name = ?",
+                              (table,)).fetchone()
+        if exists:
+            conn.execute(f"INSERT INTO main.{table} SELECT * FROM shard.{table}")
+        else:
+            conn.execute(f"CREATE TABLE main.{table} AS SELECT * FROM shard.{table}")
+        conn.commit()
+    finally:
+        conn.execute("DETACH DATABASE shard")
+
+
+def import_fineli(source_dir='db', database='fineli.db', script='db_creation.sql', jobs=None) -> dict:
+    """Create the database from the Fineli csv files, replacing the old database if there is one.
+
+    Args:
+        source_dir (str): directory of the Fineli csv files
+        database (str): path of the database to create
+        script (str): path of db_creation.sql
+        jobs (int): number of worker processes, 1 to import in this process only
+            (the number of CPUs if None)
+
+    Returns:
+        dict: number of rows imported by table name
+    """
+    before, after, tables = split_script(script)
+    sources = {os.path.basename(path)[:-4]: path
+               for path in sorted(glob.glob(os.path.join(source_dir, '*.csv')))
+               if not path.endswith('_import.csv')}
+    for table in sorted(set(sources) - set(tables)):
+        logger.info('%s is not a table of %s, skipping it', sources[table], script)
+    for table in tables:
+        if table not in sources:
+            logger.warning('%s has no csv file in %s', table, source_dir)
+    sources = {table: path for table, path in sources.items() if table in tables}
+    building = database + '.new'
+    if os.path.exists(building):
+        os.remove(building)
+
+    conn = sqlite3.connect(building)
+    counts = {}
+    try:
+        for pragma in BULK_PRAGMAS:
+            conn.execute(pragma)
+        conn.executescript(before)
+        schema = dict(conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'table'"))
+        jobs = jobs or os.cpu_count() or 1
+
+        if jobs == 1 or len(sources) < 2:
+            for table, source in sources.items():
+                counts[table] = load_csv(conn, source, table)
+        else:
+            with tempfile.TemporaryDirectory() as shard_dir, \
+                 ProcessPoolExecutor(max_workers=min(jobs, len(sources))) as pool:
+                shards = {table: os.path.join(shard_dir, table + '.db') for table in sources}
+                # the biggest files first, so that they don't end up being loaded last
+                order = sorted(sources, key=lambda table: os.path.getsize(sources[table]), reverse=True)
+                futures = {table: pool.submit(load_shard, sources[table], table,
+                                              schema.get(table), shards[table])
+                           for table in order}
+                for table in order:
+                    counts[table] = futures[table].result()
+                    copy_shard(conn, table, shards[table])
+
+        # indexes, statistics and the search table are built in one go now that the data is in
+        conn.executescript(after)
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(building, database)
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import the Fineli csv files into an Sqlite database.')
+    parser.add_argument('--source', default='db', help='directory of the Fineli csv files')
+    parser.add_argument('--database', default='fineli.db', help='database file to create')
+    parser.add_argument('--script', default='db_creation.sql', help='sql script creating the tables')
+    parser.add_argument('--jobs', type=int, default=None, help='number of worker processes')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s %(message)s')
+
+    start = time.perf_counter()
+    counts = import_fineli(args.source, args.database, args.script, args.jobs)
+    for table, count in sorted(counts.items()):
+        print(f'{table}: {count} rows')
+    print(f'imported {sum(counts.values())} rows into {args.database} in {time.perf_counter() - start:.2f} s')